@@ -216,6 +216,52 @@ from breezy.revisionspec import RevisionSpec_dwim
 RevisionSpec_dwim.append_possible_lazy_revspec(
     "breezy.plugins.hg.revspec", "RevisionSpec_hg")
 
+from breezy.config import (
+    Option,
+    int_SI_from_store,
+    int_from_store,
+    option_registry,
+    )
+option_registry.register(
+    Option('hg.fetch_workers', default=1, from_unicode=int_from_store,
+           help="""\
+Number of worker processes used to reconstruct file texts when fetching
+from Mercurial.
+
+Values lower than 2 reconstruct the texts in the main process.
+"""))
+option_registry.register(
+    Option('hg.fetch_cache_size', default='50M',
+           from_unicode=int_SI_from_store,
+           help="""\
+Maximum size, in bytes, of the changeset, manifest and file texts to keep
+in memory as delta bases when fetching from Mercurial.
+"""))
+option_registry.register(
+    Option('hg.fetch_batch_size', default=0, from_unicode=int_from_store,
+           help="""\
+Number of revisions to import per write group when fetching from a local
+Mercurial repository.
+
+Fetching in batches keeps memory usage bounded for large pulls. 0 imports
+all revisions in a single write group.
+"""))
+option_registry.register(
+    Option('hg.push_cache_size', default='50M',
+           from_unicode=int_SI_from_store,
+           help="""\
+Maximum size, in bytes, of the manifests to keep in memory as parents of
+the next revisions when pushing to Mercurial.
+"""))
+option_registry.register(
+    Option('hg.push_workers', default=1, from_unicode=int_from_store,
+           help="""\
+Number of worker processes used to hash and delta file texts when pushing
+to Mercurial.
+
+Values lower than 2 process the texts in the main process.
+"""))
+
 def test_suite():
     from unittest import TestSuite, TestLoader
     from breezy.plugins.hg import tests
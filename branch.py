@@ -379,10 +379,39 @@ class HgLocalBranch(HgBranch):
             mapping=self.mapping)
 
     def _read_last_revision_info(self):
-        last_revid = self.last_revision()
-        graph = self.repository.get_graph()
-        revno = graph.find_distance_to_null(last_revid, [(_mod_revision.NULL_REVISION, 0)])
-        return revno, last_revid
+        tip = self._tip()
+        last_revid = self.repository.lookup_foreign_revision_id(tip,
+            mapping=self.mapping)
+        return self.repository._get_revno(tip), last_revid
+
+    def _gen_revision_history(self):
+        with self.lock_read():
+            return self.repository._get_left_hand_history(self._tip())
+
+    def _get_left_hand_history(self):
+        if self._revision_history_cache is None:
+            self._cache_revision_history(self._gen_revision_history())
+        return self._revision_history_cache
+
+    def revision_id_to_revno(self, revision_id):
+        """Given a revision id, return its revno"""
+        if _mod_revision.is_null(revision_id):
+            return 0
+        with self.lock_read():
+            try:
+                return self._get_left_hand_history().index(revision_id) + 1
+            except ValueError:
+                raise errors.NoSuchRevision(self, revision_id)
+
+    def get_rev_id(self, revno, history=None):
+        """Find the revision id of the specified revno."""
+        if revno == 0:
+            return _mod_revision.NULL_REVISION
+        with self.lock_read():
+            history = self._get_left_hand_history()
+            if revno < 0 or revno > len(history):
+                raise errors.NoSuchRevision(self, revno)
+            return history[revno - 1]
 
     def _write_last_revision_info(self, revno, revid):
         (hgid, mapping) = self.repository.lookup_bzr_revision_id(revid)
@@ -16,10 +16,11 @@
 
 """Push support."""
 
-from cStringIO import StringIO
 from collections import (
     defaultdict,
+    deque,
     )
+import itertools
 
 from mercurial.changegroup import (
     chunkheader,
@@ -29,15 +30,21 @@ from mercurial.revlog import (
     hash as hghash,
     )
 import struct
+import tempfile
 
 from breezy import (
+    config as _mod_config,
     debug,
+    lru_cache,
     revision as _mod_revision,
+    trace,
+    tsort,
     )
 
 from breezy.plugins.hg.mapping import (
     as_hg_parents,
     files_from_delta,
+    manifest_and_flags_from_delta,
     manifest_and_flags_from_tree,
     )
 from breezy.plugins.hg.parsers import (
@@ -46,12 +53,89 @@ from breezy.plugins.hg.parsers import (
     pack_chunk_iter,
     )
 from breezy.plugins.hg.util import (
+    imap_bounded,
     lazydict,
+    terminate_pool,
     )
 
 
+# Number of revisions to retrieve at once
+CHANGEGROUP_REVISION_BATCH_SIZE = 100
+
+# Number of Revision objects and revision trees to keep around while
+# generating a changegroup
+CHANGEGROUP_REVISION_CACHE_SIZE = 1000
+CHANGEGROUP_TREE_CACHE_SIZE = 20
+
+# Number of file texts to look ahead for one that follows on from the
+# previous text
+TEXT_REORDER_WINDOW = 32
+
+
+def manifest_size((manifest, flags)):
+    """Estimate the size of a manifest in bytes.
+
+    This is about the size of the manifest text: a path and a hex node per
+    entry.
+
+    :param manifest: Tuple with manifest and flags dictionaries
+    :return: Size in bytes
+    """
+    return sum(len(path) + 42 for path in manifest) + len(flags)
+
+
+class ChangegroupCache(object):
+    """Revisions, trees and manifests used while generating a changegroup.
+
+    Revisions are retrieved in batches, in the order in which they will be
+    processed. The trees and manifests of recently processed revisions are
+    kept, as they are likely to be the parents of the next revision.
+    """
+
+    def __init__(self, repo, revids):
+        self.repo = repo
+        self._order = dict((revid, i) for (i, revid) in enumerate(revids))
+        self._revids = revids
+        self._revisions = lru_cache.LRUCache(CHANGEGROUP_REVISION_CACHE_SIZE)
+        self._trees = lru_cache.LRUCache(CHANGEGROUP_TREE_CACHE_SIZE)
+        # Manifests that are evicted have to be rebuilt from those of their
+        # parents, so keep as many as fit in the configured size
+        self.manifests = lru_cache.LRUSizeCache(
+            max_size=_mod_config.GlobalStack().get('hg.push_cache_size'),
+            compute_size=manifest_size)
+
+    def get_revision(self, revid):
+        try:
+            return self._revisions[revid]
+        except KeyError:
+            pass
+        try:
+            i = self._order[revid]
+        except KeyError:
+            todo = [revid]
+        else:
+            todo = [r for r in
+                    self._revids[i:i+CHANGEGROUP_REVISION_BATCH_SIZE]
+                    if r != _mod_revision.NULL_REVISION and
+                       r not in self._revisions]
+        for rev in self.repo.get_revisions(todo):
+            self._revisions[rev.revision_id] = rev
+        return self._revisions[revid]
+
+    def add_tree(self, tree):
+        self._trees[tree.get_revision_id()] = tree
+
+    def revision_trees(self, revids):
+        """Return the revision trees for a list of revision ids."""
+        missing = [revid for revid in revids if revid not in self._trees]
+        if missing:
+            for tree in self.repo.revision_trees(missing):
+                self.add_tree(tree)
+        return [self._trees[revid] for revid in revids]
+
+
 def drevisions(repo, mapping, revids, files, changelog_ids, manifest_ids,
-               overlay, fileids={}, lossy=True):
+               overlay, fileids={}, lossy=True, cache=None):
     """Serialize a series of Bazaar revisions as Mercurial changesets.
 
     :param repo: Bazaar repository
@@ -59,13 +143,17 @@ def drevisions(repo, mapping, revids, files, changelog_ids, manifest_ids,
     :param revids: Iterable over revision ids
     :param files: Dictionary for looking up the set of changed files by revid
     :param manifest_ids: Dictionary for looking up the manifest id by revid
+    :param cache: Optional ChangegroupCache to retrieve revisions through
     :return: Iterable over changeset fulltexts
     """
+    if cache is None:
+        revids = list(revids)
+        cache = ChangegroupCache(repo, revids)
     for revid in revids:
         if revid == _mod_revision.NULL_REVISION:
             yield "", (mercurial.node.nullid, mercurial.node.nullid), mercurial.node.nullid
             continue
-        rev = repo.get_revision(revid)
+        rev = cache.get_revision(revid)
         (manifest_id, user, date, desc, extra) = mapping.export_revision(rev,
             lossy=lossy, fileids=fileids.get(revid, {}))
         if manifest_id is None:
@@ -81,7 +169,7 @@ def drevisions(repo, mapping, revids, files, changelog_ids, manifest_ids,
 
 
 def dinventories(repo, mapping, revids, manifest_ids, files, overlay, texts,
-                 fileids, lossy=True):
+                 fileids, lossy=True, cache=None):
     """Generate manifests from a series of revision trees.
 
     :param repo: Bazaar repository to fetch revisions from
@@ -95,43 +183,57 @@ def dinventories(repo, mapping, revids, manifest_ids, files, overlay, texts,
         for any "unusual" file ids (not matching that predicted by the mapping).
         (only relevant for non-lossy conversions)
     :param lossy: Whether or not to do a lossy conversion.
+    :param cache: Optional ChangegroupCache to retrieve revisions, trees and
+        manifests through
     """
     def get_manifest(revid):
-        if revid in manifest_ids:
-            try:
-                return manifests[manifest_ids[revid]]
-            except KeyError:
-                pass
-        return overlay.get_manifest_and_flags_by_revid(revid)
+        try:
+            return manifests[revid]
+        except KeyError:
+            return overlay.get_manifest_and_flags_by_revid(revid)
     if revids == []:
         return
+    if cache is None:
+        cache = ChangegroupCache(repo, revids)
     skip_revid = revids[0]
     if revids[0] == _mod_revision.NULL_REVISION:
         yield "", (mercurial.node.nullid, mercurial.node.nullid), revids[0]
         revids = revids[1:]
-    manifests = {}
-    # TODO: Very naive and slow:
+    manifests = cache.manifests
     for tree in repo.revision_trees(revids):
+        cache.add_tree(tree)
         revid = tree.get_revision_id()
-        rev = repo.get_revision(revid)
+        rev = cache.get_revision(revid)
+        parent_manifests = [get_manifest(parent)
+                            for parent in rev.parent_ids[:2]]
         lookup_text_node = []
-        for parent in rev.parent_ids[:2]:
-            lookup_text_node.append(get_manifest(parent)[0].__getitem__)
+        for (parent_manifest, parent_flags) in parent_manifests:
+            lookup_text_node.append(parent_manifest.__getitem__)
         while len(lookup_text_node) < 2:
             lookup_text_node.append(lambda path: mercurial.node.nullid)
-        # TODO: This refetches the parent trees, which we'll likely have seen
-        # earlier in this loop.
-        parent_trees = list(repo.revision_trees(rev.parent_ids[:2]))
-        (manifest, flags, extrafileids) = manifest_and_flags_from_tree(
-            parent_trees, tree, mapping, lookup_text_node)
-        fileids[revid] = extrafileids
-        manifests[revid] = (manifest, flags)
+        parent_trees = cache.revision_trees(rev.parent_ids[:2])
         try:
             base_tree = parent_trees[0]
         except IndexError:
             base_tree = repo.revision_tree(_mod_revision.NULL_REVISION)
-        files[revid] = files_from_delta(tree.changes_from(base_tree),
-            tree, revid)
+            base = ({}, {})
+        else:
+            base = parent_manifests[0]
+        delta = tree.changes_from(base_tree)
+        # Only the paths that changed relative to the left-hand parent
+        # need to be looked at
+        (manifest, flags, extrafileids) = manifest_and_flags_from_delta(
+            parent_trees, tree, mapping, lookup_text_node, base, delta)
+        if 'check' in debug.debug_flags:
+            expected = manifest_and_flags_from_tree(parent_trees, tree,
+                mapping, lookup_text_node)
+            if expected != (manifest, flags, extrafileids):
+                raise AssertionError("incremental manifest for %s differs: "
+                    "%r != %r" % (revid, (manifest, flags, extrafileids),
+                                  expected))
+        fileids[revid] = extrafileids
+        manifests[revid] = (manifest, flags)
+        files[revid] = files_from_delta(delta, tree, revid)
         # Avoid sending texts for first revision, it's listed so we get the
         # base text for the manifest delta's.
         if revid != skip_revid:
@@ -151,6 +253,43 @@ def dinventories(repo, mapping, revids, manifest_ids, files, overlay, texts,
         yield text, node_parents, revid
 
 
+def _text_parents(repo, path, keys, overlay):
+    """Sort the texts of a single file and find their external parents.
+
+    :param repo: Bazaar repository
+    :param path: UTF8 path
+    :param keys: (fileid, revision) tuples of texts
+    :param overlay: Overlay
+    :return: Tuple with keys in topological order and dictionary with the
+        nodes of the parent texts outside of keys, by revision
+    """
+    parent_map = repo.get_file_graph().get_parent_map(keys)
+    # Look up the nodes of the parents that are not part of keys in one go
+    external_parents = set()
+    for parents in parent_map.itervalues():
+        external_parents.update(parents[:2])
+    external_parents.difference_update(parent_map)
+    text_nodes = overlay.lookup_text_nodes_by_revids_and_path(
+        [revision for (fileid, revision) in external_parents], path)
+    # Parents outside of parent_map are left out of the sorted keys
+    keys = [key for key in tsort.topo_sort(parent_map) if key in parent_map]
+    return keys, text_nodes
+
+
+def _text_base(repo, parents):
+    """Return the fulltext the first delta of a file is against.
+
+    :param repo: Bazaar repository
+    :param parents: Parent keys of the first text
+    :return: Fulltext of the first parent, or an empty string
+    """
+    if not parents:
+        return ""
+    base_stream = repo.texts.get_record_stream([parents[0]], 'unordered',
+        True)
+    return base_stream.next().get_bytes_as("fulltext")
+
+
 def text_contents(repo, path, keys, overlay):
     """Generate revlog text tuples.
 
@@ -169,17 +308,11 @@ def text_contents(repo, path, keys, overlay):
             return text_nodes[revision]
         except KeyError:
             return overlay.lookup_text_node_by_revid_and_path(revision, path)
-    text_nodes = {}
-    base_reported = False
-    file_graph = repo.get_file_graph()
-    first_parents = file_graph.get_parent_map([keys[0]])[keys[0]]
-    if len(first_parents) == 0:
-        yield ""
-    else:
-        base_stream = repo.texts.get_record_stream([first_parents[0]], 'unordered', True)
-        yield base_stream.next().get_bytes_as("fulltext")
-
-    for record in repo.texts.get_record_stream(keys, 'topological', True):
+    (keys, text_nodes) = _text_parents(repo, path, keys, overlay)
+    records = repo.texts.get_record_stream(keys, 'topological', True)
+    first = records.next()
+    yield _text_base(repo, first.parents)
+    for record in itertools.chain([first], records):
         fulltext = record.get_bytes_as('fulltext')
         parents = as_hg_parents(record.parents, text_as_node)
         node = hghash(fulltext, parents[0], parents[1])
@@ -187,6 +320,83 @@ def text_contents(repo, path, keys, overlay):
         yield (record, parents, node)
 
 
+def text_chain(repo, path, keys, overlay, changelog_ids):
+    """Prepare the texts of a single file to be packed by pack_text_chain.
+
+    Only the keys and nodes are collected; the texts themselves are read
+    by pack_text_chain, so they don't have to be sent to worker processes.
+
+    :param repo: Bazaar repository
+    :param path: UTF8 path
+    :param keys: (fileid, revision) tuples of texts to convert
+    :param overlay: Overlay
+    :param changelog_ids: Dictionary mapping revision ids to changeset ids
+    :return: Tuple with path, keys in topological order, dictionary with
+        the nodes of the parent texts outside of keys, by revision, and
+        dictionary with the changeset ids of the revisions in keys
+    """
+    (keys, text_nodes) = _text_parents(repo, path, keys, overlay)
+    links = dict((revision, changelog_ids[revision])
+                 for (fileid, revision) in keys)
+    return (path, keys, text_nodes, links)
+
+
+def _iter_text_chain_chunks(repo, keys, text_nodes, links, stats):
+    text_nodes = dict(text_nodes)
+    def text_as_node((fileid, revision)):
+        return text_nodes[revision]
+    if not keys:
+        return
+    records = repo.texts.get_record_stream(keys, 'topological', True)
+    first = records.next()
+    def contents():
+        for record in itertools.chain([first], records):
+            fulltext = record.get_bytes_as('fulltext')
+            parents = as_hg_parents(record.parents, text_as_node)
+            text_nodes[record.key[1]] = hghash(fulltext, parents[0],
+                parents[1])
+            yield (fulltext, parents, links[record.key[1]])
+    for chunk in pack_chunk_iter(contents(), _text_base(repo, first.parents),
+            reorder_window=TEXT_REORDER_WINDOW, stats=stats):
+        yield chunk
+
+
+def pack_text_chain(repo, path, keys, text_nodes, links):
+    """Hash and delta-pack the texts of a single file.
+
+    :param repo: Bazaar repository
+    :param path: UTF8 path
+    :param keys: (fileid, revision) tuples of the texts, in topological
+        order
+    :param text_nodes: Dictionary with the nodes of the parent texts
+        outside of keys, by revision
+    :param links: Dictionary with the changeset ids of the revisions in
+        keys
+    :return: Tuple with path, list of chunks and dictionary with the
+        sizes of the texts and deltas, as accumulated by pack_chunk_iter
+    """
+    stats = {}
+    chunks = list(_iter_text_chain_chunks(repo, keys, text_nodes, links,
+        stats))
+    return path, chunks, stats
+
+
+# Repository the texts are read from in the worker processes of
+# _pack_text_chains_parallel
+_worker_repository = None
+
+
+def _open_worker_repository(url):
+    global _worker_repository
+    from breezy.repository import Repository
+    _worker_repository = Repository.open(url)
+    _worker_repository.lock_read()
+
+
+def _pack_text_chain_in_worker(chain):
+    return pack_text_chain(_worker_repository, *chain)
+
+
 def chunkify(buffer):
     return chunkheader(len(buffer)) + buffer
 
@@ -198,6 +408,49 @@ def extract_base(entries):
         return (entries, "")
 
 
+def spool_manifests(manifests, spool, stats=None):
+    """Pack a series of manifests into a file.
+
+    The changesets the manifests link to are only known once the
+    changelog has been generated, so the link node is left as a
+    placeholder to be filled in by unspool_manifests().
+
+    :param manifests: Iterator over (fulltext, (p1, p2), revid) tuples; the
+        first one is only used as base text
+    :param spool: File to write the chunks to
+    :param stats: Optional dictionary to accumulate sizes in, see
+        pack_chunk_iter()
+    :return: List with the revision id and size of each chunk
+    """
+    ret = []
+    current = [None]
+    def placeholder_links(entries):
+        for (text, ps, revid) in entries:
+            current[0] = revid
+            yield text, ps, mercurial.node.nullid
+    (manifests, textbase) = extract_base(manifests)
+    for blob in pack_chunk_iter(placeholder_links(manifests), textbase,
+            stats=stats):
+        spool.write(blob)
+        ret.append((current[0], len(blob)))
+    return ret
+
+
+def unspool_manifests(spool, chunks, changelog_ids):
+    """Read back the chunks written by spool_manifests().
+
+    :param spool: File the chunks were written to
+    :param chunks: List with the revision id and size of each chunk
+    :param changelog_ids: Dictionary mapping revision ids to changeset ids
+    :return: Iterator over chunks
+    """
+    spool.seek(0)
+    for (revid, size) in chunks:
+        chunk = spool.read(size)
+        # Chunks start with the node, p1, p2 and link node
+        yield chunk[:60] + changelog_ids[revid] + chunk[80:]
+
+
 def bzr_changegroup(repo, overlay, changelog_ids, mapping, revids, lossy=True):
     """Create a changegroup based on (a derivation) of a set of revisions.
 
@@ -213,48 +466,112 @@ def bzr_changegroup(repo, overlay, changelog_ids, mapping, revids, lossy=True):
     assert revids[0] != _mod_revision.NULL_REVISION
     base_revid = repo.get_parent_map([revids[0]])[revids[0]][0]
     todo = [base_revid] + revids # add base text revid
+    # Look up the changeset ids of the parents outside of todo in one go
+    external_parents = set()
+    for parents in repo.get_parent_map(todo).itervalues():
+        external_parents.update(parents[:2])
+    external_parents.difference_update(todo)
+    external_parents.difference_update(changelog_ids)
+    for revid, (csid, csid_mapping) in overlay.lookup_changeset_ids_by_revids(
+            external_parents).iteritems():
+        changelog_ids[revid] = csid
 
     fileids = {}
-    manifests = list(dinventories(repo, mapping, todo, manifest_ids, files,
-        overlay, texts, fileids, lossy=lossy))
-    # 00changelog.i
-    revs = drevisions(repo, mapping, todo, files, changelog_ids, manifest_ids,
-        overlay, fileids=fileids, lossy=lossy)
-    (revs, textbase) = extract_base(revs)
-    for blob in pack_chunk_iter(revs, textbase):
-        yield blob
-    yield ""
-    del files
-    del manifest_ids
-
-    # 00manifest.i
-    manifests = ((text, ps, changelog_ids[revid]) for (text, ps, revid) in manifests)
-    (manifests, textbase) = extract_base(manifests)
-    for blob in pack_chunk_iter(manifests, textbase):
-        yield blob
-    yield ""
+    stats = {}
+    cache = ChangegroupCache(repo, todo)
+    # The manifests have to be generated before the changelog, as the
+    # changesets refer to them. They are packed as they are generated, so
+    # only the previous manifest text has to be kept around.
+    manifest_spool = tempfile.TemporaryFile()
+    try:
+        manifest_chunks = spool_manifests(dinventories(repo, mapping, todo,
+            manifest_ids, files, overlay, texts, fileids, lossy=lossy,
+            cache=cache), manifest_spool, stats)
+        # 00changelog.i
+        revs = drevisions(repo, mapping, todo, files, changelog_ids,
+            manifest_ids, overlay, fileids=fileids, lossy=lossy, cache=cache)
+        (revs, textbase) = extract_base(revs)
+        for blob in pack_chunk_iter(revs, textbase, stats=stats):
+            yield blob
+        yield ""
+        del files
+        del manifest_ids
+        del cache
 
-    del manifests
+        # 00manifest.i
+        for blob in unspool_manifests(manifest_spool, manifest_chunks,
+                                      changelog_ids):
+            yield blob
+        yield ""
+    finally:
+        manifest_spool.close()
     # texts
-    for path, keys in texts.iteritems():
+    workers = _mod_config.GlobalStack().get('hg.push_workers')
+    if workers > 1:
+        chains = _pack_text_chains_parallel(repo, overlay, changelog_ids,
+            texts, workers, stats)
+    else:
+        chains = _pack_text_chains(repo, overlay, changelog_ids, texts, stats)
+    for path, blobs in chains:
         # FIXME: Mangle path in the same way that mercurial does
         yield path
-        dtexts = text_contents(repo, path, keys, overlay)
-        textbase = dtexts.next()
-        content_chunks = ((record.get_bytes_as('fulltext'), parents,
-            changelog_ids[record.key[1]]) for (record, parents, node) in
-            dtexts)
-        for blob in pack_chunk_iter(content_chunks, textbase):
+        for blob in blobs:
             yield blob
         yield ""
     yield ""
+    texts_size = stats.get("texts", 0)
+    deltas_size = stats.get("deltas", 0)
+    trace.mutter("changegroup: %d bytes of deltas for %d bytes of texts "
+                 "(%d bytes saved)", deltas_size, texts_size,
+                 texts_size - deltas_size)
+
+
+def _pack_text_chains(repo, overlay, changelog_ids, texts, stats):
+    for path, keys in texts.iteritems():
+        (path, keys, text_nodes, links) = text_chain(repo, path, keys,
+            overlay, changelog_ids)
+        yield path, _iter_text_chain_chunks(repo, keys, text_nodes, links,
+            stats)
+
+
+def _pack_text_chains_parallel(repo, overlay, changelog_ids, texts, workers,
+                               stats):
+    """Pack file texts using a pool of worker processes.
+
+    Every worker opens the repository itself and reads the texts from it,
+    so only keys and nodes are sent to the workers. The hashing and delta
+    generation for different files happen concurrently. Results are
+    returned in the same order as texts is iterated over.
+    """
+    import multiprocessing
+    chains = (text_chain(repo, path, keys, overlay, changelog_ids)
+              for (path, keys) in texts.iteritems())
+    pool = multiprocessing.Pool(workers, _open_worker_repository,
+        (repo.user_url,))
+    try:
+        for path, blobs, chain_stats in imap_bounded(pool,
+                _pack_text_chain_in_worker, chains, workers * 2):
+            for key, value in chain_stats.iteritems():
+                stats[key] = stats.get(key, 0) + value
+            yield path, blobs
+    finally:
+        terminate_pool(pool)
 
 
 class ChunkStringIO(object):
+    """File-like object that reads from an iterator over changegroup chunks.
+
+    Chunks are only pulled from the iterator when they are needed, and
+    only the data that has not been read yet is kept around. A partially
+    read piece is kept together with an offset into it rather than being
+    sliced, so every byte is copied at most once, into the returned string.
+    """
 
     def __init__(self, chunkiter):
         self.chunkiter = chunkiter
-        self._stream = StringIO()
+        self._pieces = deque()
+        self._offset = 0
+        self._exhausted = False
 
     def chunk(self):
         return self.chunkiter.next()
@@ -268,22 +585,49 @@ class ChunkStringIO(object):
         data = chunk[80:]
         return dict(node=node, p1=p1, p2=p2, cs=cs, data=data)
 
-    def read(self, l):
-        while len(self._stream.getvalue()) < l:
-            try:
-                self._stream.write(chunkify(self.chunk()))
-            except StopIteration:
+    def _fill(self):
+        """Queue the next chunk, returning False if there are none left."""
+        if self._exhausted:
+            return False
+        try:
+            chunk = self.chunk()
+        except StopIteration:
+            self._exhausted = True
+            return False
+        self._pieces.append(chunkheader(len(chunk)))
+        if chunk:
+            self._pieces.append(chunk)
+        return True
+
+    def read(self, l=-1):
+        ret = []
+        while l != 0:
+            if not self._pieces and not self._fill():
+                break
+            piece = self._pieces[0]
+            available = len(piece) - self._offset
+            if 0 < l < available:
+                ret.append(piece[self._offset:self._offset+l])
+                self._offset += l
                 break
-        return self._stream.read(l)
+            if self._offset:
+                piece = piece[self._offset:]
+            ret.append(piece)
+            self._pieces.popleft()
+            self._offset = 0
+            if l > 0:
+                l -= available
+        return "".join(ret)
 
     def seek(self, pos):
-        raise NotImplementedError(self.see)
+        raise NotImplementedError(self.seek)
 
     def tell(self):
         raise NotImplementedError(self.tell)
 
     def close(self):
-        return self._stream.close()
+        self._pieces.clear()
+        self._offset = 0
 
 
 def dchangegroup(repo, mapping, revids, lossy=True):
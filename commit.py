@@ -53,7 +53,7 @@ class HgCommitBuilder(CommitBuilder):
                 csid = self.repository.lookup_bzr_revision_id(self.parents[i])[0]
                 hgchange = self._hgrepo.changelog.read(csid)
                 manifest_id = hgchange[0]
-                manifest = self._hgrepo.manifestlog[manifest_id].read()
+                manifest = self.repository._get_manifest(manifest_id)
                 self._parent_manifest_ids.append(manifest_id)
                 self._parent_manifests.append(manifest)
                 self._parent_changeset_ids.append(csid)
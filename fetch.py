@@ -30,8 +30,10 @@ from collections import (
     )
 import mercurial.node
 import os
+import struct
 
 from breezy import (
+    config as _mod_config,
     debug,
     errors,
     lru_cache,
@@ -74,6 +76,10 @@ from breezy.plugins.hg.parsers import (
     parse_manifest,
     unpack_chunk_iter,
     )
+from breezy.plugins.hg.util import (
+    imap_bounded,
+    terminate_pool,
+    )
 
 INVENTORY_CACHE_SIZE = 25
 
@@ -239,6 +245,27 @@ def manifest_to_inventory_delta(lookup_file_id, basis_inv, other_inv,
                     maybe_empty_dirs[dirname].add(basis_inv[file_id].name)
 
 
+def unpack_text_chain((path, chunks, basetext)):
+    """Reconstruct the fulltexts for the delta chain of a single file.
+
+    This is run in worker processes, so it should only rely on its
+    arguments.
+
+    :param path: Path of the file
+    :param chunks: List with the delta chunks for the file
+    :param basetext: Fulltext of the base of the first delta
+    :return: Tuple with path and a list of (fulltext, node, (p1, p2), link,
+        sha1) tuples. sha1 is the SHA1 of the text without copy metadata.
+    """
+    ret = []
+    for (fulltext, node, parents, link) in unpack_chunk_iter(chunks,
+            lambda node: basetext):
+        (meta, bzr_fulltext) = deserialize_file_text(str(fulltext))
+        ret.append((fulltext, node, parents, link,
+                    osutils.sha_string(bzr_fulltext)))
+    return path, ret
+
+
 def create_directory_texts(texts, invdelta):
     """Create the texts for directories mentioned in an inventory delta.
 
@@ -319,6 +346,9 @@ class FromHgRepository(InterRepository):
         self._symlink_targets = {}
         # Map mapping manifest ids to bzr revision ids
         self._manifest2rev_map = defaultdict(set)
+        # Recently reconstructed changeset, manifest and file texts, by node
+        self._fulltext_cache = lru_cache.LRUSizeCache(
+            max_size=_mod_config.GlobalStack().get('hg.fetch_cache_size'))
 
     @classmethod
     def _get_repo_format_to_test(self):
@@ -379,44 +409,114 @@ class FromHgRepository(InterRepository):
             except errors.NoSuchRevision:
                 yield self._target_overlay.get_manifest_and_flags_by_revid(revid)[0]
 
-    def _create_text_record(self, fileid, revision, parents, kind, fulltext):
+    def _create_text_record(self, fileid, revision, parents, kind, fulltext,
+                            sha1=None):
         key = (fileid, revision)
         if kind == "symlink":
             self._symlink_targets[key] = fulltext
             bzr_fulltext = ""
+            sha1 = None
         else:
             (meta, bzr_fulltext) = deserialize_file_text(str(fulltext))
+        if sha1 is None:
+            sha1 = osutils.sha_string(bzr_fulltext)
         return FulltextContentFactory(key,
-            [(fileid, p) for p in parents],
-            osutils.sha_string(bzr_fulltext), bzr_fulltext)
+            [(fileid, p) for p in parents], sha1, bzr_fulltext)
 
-    def _unpack_texts(self, cg, mapping, kind_map, pb):
+    def _get_text_base(self, path, node, kind_map):
+        try:
+            key, kind, text_parents = kind_map[(path, node)][0]
+        except KeyError:
+            return self._target_overlay.get_text_by_path_and_node(path, node)
+        else:
+            return self._get_target_fulltext(key)
+
+    def _iter_text_chains(self, cg, kind_map, pb):
+        """Iterate over the per-file delta chains in a changegroup.
+
+        :return: Iterator over (path, chunk iterator) tuples
+        """
         i = 0
-        # Texts
         while True:
             path = mercurial.changegroup.getchunk(cg)
             if not path:
                 break
             i += 1
             pb.update("fetching texts", i, len(kind_map))
-            itertextchunks = chunkiter(cg)
-            def get_text(node):
-                try:
-                    key, kind, text_parents = kind_map[(path, node)][0]
-                except KeyError:
-                    return self._target_overlay.get_text_by_path_and_node(path, node)
-                else:
-                    return self._get_target_fulltext(key)
-            for fulltext, hgkey, hgparents, csid in unpack_chunk_iter(
-                itertextchunks, get_text):
-                for (fileid, revision), kind, text_parents in kind_map[(path, hgkey)]:
-                    record = self._create_text_record(fileid, revision,
-                            text_parents, kind, fulltext)
-                    self._target_overlay.idmap.insert_text(path, hgkey,
-                        fileid, revision)
-                    self._text_metadata[record.key] = (record.sha1,
-                        len(record.get_bytes_as("fulltext")))
-                    yield record
+            yield path, chunkiter(cg)
+
+    def _unpack_text_chains(self, cg, kind_map, pb):
+        for path, itertextchunks in self._iter_text_chains(cg, kind_map, pb):
+            get_text = lambda node: self._get_text_base(path, node, kind_map)
+            yield path, ((fulltext, hgkey, hgparents, csid, None) for
+                (fulltext, hgkey, hgparents, csid) in unpack_chunk_iter(
+                    itertextchunks, get_text, self._fulltext_cache))
+
+    def _unpack_text_chains_parallel(self, cg, kind_map, pb, workers):
+        """Reconstruct file texts using a pool of worker processes.
+
+        The delta chains for different files don't depend on each other,
+        so they can be patched concurrently. Results are returned in the
+        same order as the chains appear in the changegroup.
+        """
+        import multiprocessing
+        def prepare_chains():
+            for path, itertextchunks in self._iter_text_chains(cg, kind_map,
+                    pb):
+                chunks = list(itertextchunks)
+                basetext = ""
+                if chunks:
+                    # The first delta in a chain is against its first parent
+                    base = struct.unpack("20s", chunks[0][20:40])[0]
+                    if base != mercurial.node.nullid:
+                        basetext = self._get_text_base(path, base, kind_map)
+                yield (path, chunks, basetext)
+        pool = multiprocessing.Pool(workers)
+        try:
+            for path, fulltexts in imap_bounded(pool, unpack_text_chain,
+                    prepare_chains(), workers * 2):
+                yield path, fulltexts
+        finally:
+            terminate_pool(pool)
+
+    def _unpack_texts(self, cg, mapping, kind_map, pb):
+        workers = _mod_config.GlobalStack().get('hg.fetch_workers')
+        if workers > 1:
+            chains = self._unpack_text_chains_parallel(cg, kind_map, pb,
+                workers)
+        else:
+            chains = self._unpack_text_chains(cg, kind_map, pb)
+        idmap = self._target_overlay.idmap
+        # The source may already know the SHA1s of the texts. If it
+        # doesn't, let it cache them so its trees don't have to read the
+        # texts again.
+        get_source_text_metadata = getattr(self.source,
+            "_get_text_metadata", None)
+        add_source_text_metadata = getattr(self.source,
+            "_add_text_metadata", None)
+        with idmap.batch():
+            # Texts
+            for path, fulltexts in chains:
+                for fulltext, hgkey, hgparents, csid, sha1 in fulltexts:
+                    cached = False
+                    if get_source_text_metadata is not None:
+                        try:
+                            sha1 = get_source_text_metadata(path, hgkey)[0]
+                        except KeyError:
+                            pass
+                        else:
+                            cached = True
+                    for (fileid, revision), kind, text_parents in kind_map[(path, hgkey)]:
+                        record = self._create_text_record(fileid, revision,
+                                text_parents, kind, fulltext, sha1)
+                        idmap.insert_text(path, hgkey, fileid, revision)
+                        metadata = (record.sha1,
+                            len(record.get_bytes_as("fulltext")))
+                        self._text_metadata[record.key] = metadata
+                        if (kind != "symlink" and not cached and
+                            add_source_text_metadata is not None):
+                            add_source_text_metadata(path, hgkey, *metadata)
+                        yield record
 
     def _add_inventories(self, todo, mapping, pb):
         assert isinstance(todo, list)
@@ -466,7 +566,8 @@ class FromHgRepository(InterRepository):
             revid = lookup_foreign_revid(hgid)
             return self._target_overlay.get_changeset_text_by_revid(revid)
         for i, (fulltext, hgkey, hgparents, csid) in enumerate(
-                unpack_chunk_iter(chunkiter, get_hg_revision)):
+                unpack_chunk_iter(chunkiter, get_hg_revision,
+                    self._fulltext_cache)):
             pb.update("fetching changesets", i)
             if limit is not None and i >= limit:
                 continue
@@ -584,7 +685,7 @@ class FromHgRepository(InterRepository):
         :param pb: Progress bar
         """
         chunks = unpack_chunk_iter(chunkiter,
-            self._target_overlay.get_manifest_text)
+            self._target_overlay.get_manifest_text, self._fulltext_cache)
         for i, (fulltext, hgkey, hgparents, csid) in enumerate(chunks):
             pb.update("fetching manifests", i, len(self._revisions))
             (manifest, flags) = parse_manifest(fulltext)
@@ -628,9 +729,15 @@ class FromHgRepository(InterRepository):
         # Adding actual data
         pb = ui.ui_factory.nested_progress_bar()
         try:
-            self._add_inventories(todo, mapping, pb)
+            with self._target_overlay.idmap.batch():
+                self._add_inventories(todo, mapping, pb)
         finally:
             pb.finished()
+        # Everything that was looked up by (fileid, revision) or manifest id
+        # has been added to the target now.
+        self._manifest2rev_map.clear()
+        self._text_metadata.clear()
+        self._symlink_targets.clear()
 
     def heads(self, fetch_spec, revision_id):
         """Determine the Mercurial heads to fetch. """
@@ -674,6 +781,10 @@ class FromHgRepository(InterRepository):
         unknowns = remote.branches(unknowns)
         while unknowns:
             r = []
+            known = set()
+            for n in unknowns:
+                known.update(n[1:4])
+            known = self._target_overlay.has_hgids(known)
             while unknowns:
                 n = unknowns.pop(0)
                 if n[0] in seen:
@@ -685,19 +796,19 @@ class FromHgRepository(InterRepository):
                 elif n in seenbranch:
                     trace.mutter("branch already found")
                     continue
-                elif n[1] and self._target_overlay.has_hgid(n[1]): # do we know the base?
+                elif n[1] and n[1] in known: # do we know the base?
                     trace.mutter("found incomplete branch %s:%s",
                         mercurial.node.short(n[0]), mercurial.node.short(n[1]))
                     search.append(n[0:2]) # schedule branch range for scanning
                     seenbranch.add(n)
                 else:
                     if n[1] not in seen and n[1] not in fetch:
-                        if self._target_overlay.has_hgid(n[2]) and self._target_overlay.has_hgid(n[3]):
+                        if n[2] in known and n[3] in known:
                             trace.mutter("found new changeset %s",
                                          mercurial.node.short(n[1]))
                             fetch.add(n[1]) # earliest unknowns
                     for p in n[2:4]:
-                        if p not in req and not self._target_overlay.has_hgid(p):
+                        if p not in req and p not in known:
                             r.append(p)
                             req.add(p)
                 seen.add(n[0])
@@ -713,14 +824,19 @@ class FromHgRepository(InterRepository):
         # do binary search on the branches we found
         while search:
             newsearch = []
-            for n, l in zip(search, remote.between(search)):
+            between = remote.between(search)
+            known = set([n[1] for n in search])
+            for l in between:
+                known.update(l)
+            known = self._target_overlay.has_hgids(known)
+            for n, l in zip(search, between):
                 l.append(n[1])
                 p = n[0]
                 f = 1
                 for i in l:
                     trace.mutter("narrowing %d:%d %s", f, len(l),
                                  mercurial.node.short(i))
-                    if self._target_overlay.has_hgid(i):
+                    if i in known:
                         if f <= 2:
                             trace.mutter("found new branch changeset %s",
                                          mercurial.node.short(p))
@@ -745,6 +861,61 @@ class FromHgRepository(InterRepository):
                 trace.mutter('Ignoring basis argument %r', basis)
             self.target.fetch(self.source, revision_id=revision_id)
 
+    def _find_batches(self, missing, heads, batch_size, limit=None):
+        """Split the revisions to fetch into topologically ordered batches.
+
+        :param missing: Roots of the missing revisions
+        :param heads: Heads to fetch
+        :param batch_size: Maximum number of revisions per batch
+        :param limit: Optional maximum number of revisions to fetch
+        :return: Iterator over (bases, heads) tuples for each batch
+        """
+        changelog = self.source._hgrepo.changelog
+        nodes = changelog.nodesbetween(list(missing), heads)[0]
+        if limit is not None:
+            nodes = nodes[:limit]
+        for i in xrange(0, len(nodes), batch_size):
+            batch = nodes[i:i+batch_size]
+            present = set(batch)
+            parents = set()
+            bases = []
+            for node in batch:
+                node_parents = changelog.parents(node)
+                parents.update(node_parents)
+                if not present.intersection(node_parents):
+                    bases.append(node)
+            yield bases, [node for node in batch if node not in parents]
+
+    def _fetch_changegroup(self, cg, mapping, limit=None):
+        # Only commit the idmap once the revisions it refers to have been
+        # committed to the target.
+        try:
+            with self._target_overlay.idmap.batch():
+                self.target.start_write_group()
+                try:
+                    self.addchangegroup(cg, mapping, limit=limit)
+                except:
+                    self.target.abort_write_group()
+                    raise
+                else:
+                    self.target.commit_write_group()
+        finally:
+            self._flush_source_text_metadata()
+
+    def _flush_source_text_metadata(self):
+        """Write the text metadata the source collected during the fetch.
+
+        The metadata is only a cache, so failing to write it is logged
+        rather than allowed to fail the fetch.
+        """
+        flush = getattr(self.source, "_flush_text_metadata", None)
+        if flush is None:
+            return
+        try:
+            flush()
+        except Exception:
+            trace.log_exception_quietly()
+
     def fetch(self, revision_id=None, pb=None, find_ghosts=False,
               fetch_spec=None, limit=None):
         """Fetch revisions. """
@@ -753,16 +924,20 @@ class FromHgRepository(InterRepository):
             missing = self.findmissing(heads)
             if not missing:
                 return
-            cg = self.source._hgrepo.changegroup(missing, 'pull')
             mapping = self.source.get_mapping()
-            self.target.start_write_group()
-            try:
-                self.addchangegroup(cg, mapping, limit=limit)
-            except:
-                self.target.abort_write_group()
-                raise
+            batch_size = _mod_config.GlobalStack().get('hg.fetch_batch_size')
+            if batch_size > 0 and self.source._hgrepo.local():
+                # Import the revisions in batches, each in their own write
+                # group, so memory usage doesn't grow with the size of the
+                # pull.
+                for bases, batch_heads in self._find_batches(missing, heads,
+                        batch_size, limit):
+                    cg = self.source._hgrepo.changegroupsubset(bases,
+                        batch_heads, 'pull')
+                    self._fetch_changegroup(cg, mapping)
             else:
-                self.target.commit_write_group()
+                cg = self.source._hgrepo.changegroup(missing, 'pull')
+                self._fetch_changegroup(cg, mapping, limit=limit)
 
     @staticmethod
     def is_compatible(source, target):
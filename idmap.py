@@ -16,13 +16,23 @@
 
 """Access to a map between Bazaar and Mercurial ids."""
 
+import bisect
 from collections import defaultdict
+import errno
 import mercurial.node
+import mmap
 import os
+import struct
 import threading
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from breezy import (
     errors,
+    osutils,
     registry,
     trace,
     )
@@ -41,12 +51,40 @@ def get_cache_dir():
         from breezy.config import config_dir
         ret = os.path.join(config_dir(), "hg")
     else:
+        # xdg_cache_home is determined when xdg is first imported; look at
+        # the environment again so that it can be changed later on, e.g.
+        # by the test suite.
+        xdg_cache_home = os.environ.get("XDG_CACHE_HOME",
+            os.path.join(os.path.expanduser("~"), ".cache"))
         ret = os.path.join(xdg_cache_home, "bazaar", "hg")
     if not os.path.isdir(ret):
         os.makedirs(ret)
     return ret
 
 
+class UnknownIdmapMapping(errors.BzrError):
+
+    _fmt = "The idmap refers to an unknown mapping %(mapping)r."
+
+    def __init__(self, mapping):
+        errors.BzrError.__init__(self, mapping=mapping)
+
+
+def get_mapping(name):
+    """Look up a mapping by the name that is stored in the idmap.
+
+    :param name: Name of the mapping
+    :return: Mapping instance
+    :raises UnknownIdmapMapping: if there is no mapping with that name, so
+        that lookups don't mistake a damaged entry for a missing one
+    """
+    try:
+        mapping_cls = mapping_registry.get(name)
+    except KeyError:
+        raise UnknownIdmapMapping(name)
+    return mapping_cls()
+
+
 _mapdbs = threading.local()
 def mapdbs():
     """Get a cache for this thread's db connections."""
@@ -57,8 +95,21 @@ def mapdbs():
         return _mapdbs.cache
 
 
-TDB_MAP_VERSION = 1
+TDB_MAP_VERSION = 3
 TDB_HASH_SIZE = 50000
+TDB_REVIDS_CHUNK_SIZE = 1000
+
+MMAP_MAGIC = "BHGMMAP1"
+MMAP_TABLES = ("manifest", "revid", "csid", "text", "textmeta")
+MMAP_HEADER = struct.Struct(">8s" + "QQ" * len(MMAP_TABLES))
+MMAP_RECORD = struct.Struct(">20sQI")
+MMAP_LOG_RECORD = struct.Struct(">B20sI")
+MMAP_COMPACT_THRESHOLD = 10000
+
+# Number of parameters to bind per "IN (...)" query. Keys with several
+# columns take one parameter per column. This has to stay below
+# SQLITE_MAX_VARIABLE_NUMBER, which is 999 before SQLite 3.32.
+SQLITE_LOOKUP_CHUNK_SIZE = 500
 
 
 def check_pysqlite_version(sqlite3):
@@ -84,9 +135,53 @@ except:
     raise errors.BzrError("missing sqlite library")
 
 
+class IdmapBatch(object):
+    """Context manager that groups the writes to an idmap.
+
+    Nested batches are folded into the outermost one, which commits the
+    changes when it exits normally and aborts them otherwise.
+    """
+
+    def __init__(self, idmap):
+        self.idmap = idmap
+
+    def __enter__(self):
+        if self.idmap._batch_depth == 0:
+            self.idmap.start_write_group()
+        self.idmap._batch_depth += 1
+        return self.idmap
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.idmap._batch_depth -= 1
+        if self.idmap._batch_depth == 0:
+            if exc_type is None:
+                self.idmap.commit_write_group()
+            else:
+                self.idmap.abort_write_group()
+        return False
+
+
 class BzrHgIdmap(object):
     """Caching backend."""
 
+    _batch_depth = 0
+
+    def batch(self):
+        """Group a series of writes.
+
+        :return: Context manager
+        """
+        return IdmapBatch(self)
+
+    def start_write_group(self):
+        """Start a group of writes."""
+
+    def commit_write_group(self):
+        """Commit the writes made since start_write_group()."""
+
+    def abort_write_group(self):
+        """Abort the writes made since start_write_group()."""
+
     def lookup_text_by_path_and_node(self, path, node):
         raise NotImplementedError(self.lookup_text_by_path_and_node)
 
@@ -96,18 +191,119 @@ class BzrHgIdmap(object):
     def lookup_changeset_id_by_revid(self, revid):
         raise NotImplementedError(self.lookup_changeset_id_by_revid)
 
+    def lookup_revision_by_changeset_id(self, changeset_id):
+        raise NotImplementedError(self.lookup_revision_by_changeset_id)
+
+    def lookup_texts_by_path_and_node(self, keys):
+        """Look up the Bazaar texts for a series of Mercurial file revisions.
+
+        :param keys: Iterable over (path, node) tuples
+        :return: Dictionary mapping (path, node) tuples to lists of
+            (fileid, revid) tuples. Unknown keys are omitted.
+        """
+        ret = {}
+        for (path, node) in keys:
+            texts = list(self.lookup_text_by_path_and_node(path, node))
+            if texts:
+                ret[(path, node)] = texts
+        return ret
+
+    def lookup_changeset_ids_by_revids(self, revids):
+        """Look up the Mercurial changeset ids for a series of revisions.
+
+        :param revids: Iterable over revision ids
+        :return: Dictionary mapping revision ids to (changeset id, mapping)
+            tuples. Unknown revision ids are omitted.
+        :raises UnknownIdmapMapping: if an entry refers to an unknown mapping
+        """
+        ret = {}
+        for revid in revids:
+            try:
+                ret[revid] = self.lookup_changeset_id_by_revid(revid)
+            except KeyError:
+                pass
+        return ret
+
+    def lookup_revisions_by_changeset_ids(self, changeset_ids):
+        """Look up the revision ids for a series of changeset ids.
+
+        :param changeset_ids: Iterable over 20-byte changeset ids
+        :return: Dictionary mapping changeset ids to revision ids. Unknown
+            changeset ids are omitted.
+        """
+        ret = {}
+        for changeset_id in changeset_ids:
+            try:
+                ret[changeset_id] = self.lookup_revision_by_changeset_id(
+                    changeset_id)
+            except KeyError:
+                pass
+        return ret
+
+    def lookup_revisions_by_changeset_id_prefix(self, prefix):
+        """Look up the revision ids for changeset ids with a hex prefix.
+
+        :param prefix: Lowercase hex prefix of the changeset id
+        :return: Dictionary mapping 20-byte changeset ids to revision ids
+        """
+        raise NotImplementedError(self.lookup_revisions_by_changeset_id_prefix)
+
+    def lookup_revisions_by_manifest_ids(self, manifest_ids):
+        """Look up the revision ids for a series of manifest ids.
+
+        :param manifest_ids: Iterable over 20-byte manifest ids
+        :return: Dictionary mapping manifest ids to revision ids. Unknown
+            manifest ids are omitted.
+        """
+        ret = {}
+        for manifest_id in manifest_ids:
+            try:
+                ret[manifest_id] = self.lookup_revision_by_manifest_id(
+                    manifest_id)
+            except KeyError:
+                pass
+        return ret
+
     def get_files_by_revid(self, revid):
         raise NotImplementedError(self.get_files_by_revid)
 
     def revids(self):
         raise NotImplementedError(self.revids)
 
+    def get_processed_heads(self):
+        """Return the heads whose ancestry has been added to the map.
+
+        :return: Set of revision ids
+        """
+        raise NotImplementedError(self.get_processed_heads)
+
+    def set_processed_heads(self, revids):
+        """Record the heads whose ancestry has been added to the map.
+
+        :param revids: Iterable over revision ids
+        """
+        raise NotImplementedError(self.set_processed_heads)
+
     def insert_revision(self, revid, manifest_id, changeset_id, mapping):
         raise NotImplementedError(self.insert_revision)
 
     def insert_text(self, path, node, fileid, revision):
         raise NotImplementedError(self.insert_text)
 
+    def lookup_text_metadata(self, path, node):
+        """Look up the metadata of a Mercurial file revision.
+
+        :param path: Path of the file
+        :param node: File node
+        :return: Tuple with the SHA1 and size of the text, without copy
+            metadata
+        :raises KeyError: if the metadata is not known
+        """
+        raise NotImplementedError(self.lookup_text_metadata)
+
+    def insert_text_metadata(self, path, node, sha1, size):
+        raise NotImplementedError(self.insert_text_metadata)
+
 
 class MemoryIdmap(BzrHgIdmap):
     """In-memory idmap implementation."""
@@ -115,7 +311,12 @@ class MemoryIdmap(BzrHgIdmap):
     def __init__(self):
         self._manifest_to_revid = {}
         self._revid_to_changeset_id = {}
+        self._changeset_id_to_revid = {}
+        # sorted list of the keys of _changeset_id_to_revid
+        self._changeset_ids = []
         self._path_node_text_id = defaultdict(set)
+        self._path_node_text_metadata = {}
+        self._processed_heads = set()
 
     def lookup_text_by_path_and_node(self, path, node):
         return self._path_node_text_id[(path, node)]
@@ -127,21 +328,52 @@ class MemoryIdmap(BzrHgIdmap):
         return self._manifest_to_revid[manifest_id]
 
     def lookup_changeset_id_by_revid(self, revid):
-        return self._revid_to_changeset_id[revid]
+        (changeset_id, mapping) = self._revid_to_changeset_id[revid]
+        return changeset_id, get_mapping(mapping)
+
+    def lookup_revision_by_changeset_id(self, changeset_id):
+        if len(changeset_id) == 40:
+            changeset_id = mercurial.node.bin(changeset_id)
+        return self._changeset_id_to_revid[changeset_id]
+
+    def lookup_revisions_by_changeset_id_prefix(self, prefix):
+        lo = mercurial.node.bin((prefix + "0" * 40)[:40])
+        hi = mercurial.node.bin((prefix + "f" * 40)[:40])
+        ret = {}
+        for i in xrange(bisect.bisect_left(self._changeset_ids, lo),
+                        bisect.bisect_right(self._changeset_ids, hi)):
+            changeset_id = self._changeset_ids[i]
+            ret[changeset_id] = self._changeset_id_to_revid[changeset_id]
+        return ret
 
     def revids(self):
         return set(self._manifest_to_revid.values())
 
+    def get_processed_heads(self):
+        return set(self._processed_heads)
+
+    def set_processed_heads(self, revids):
+        self._processed_heads = set(revids)
+
     def insert_text(self, path, node, fileid, revision):
         self._path_node_text_id[(path, node)].add((fileid, revision))
 
+    def lookup_text_metadata(self, path, node):
+        return self._path_node_text_metadata[(path, node)]
+
+    def insert_text_metadata(self, path, node, sha1, size):
+        self._path_node_text_metadata[(path, node)] = (sha1, size)
+
     def insert_revision(self, revid, manifest_id, changeset_id, mapping):
         if len(manifest_id) == 40:
             manifest_id = mercurial.node.bin(manifest_id)
         if len(changeset_id) == 40:
             changeset_id = mercurial.node.bin(changeset_id)
         self._manifest_to_revid[manifest_id] = revid
-        self._revid_to_changeset_id[revid] = changeset_id, mapping
+        self._revid_to_changeset_id[revid] = changeset_id, str(mapping)
+        if changeset_id not in self._changeset_id_to_revid:
+            bisect.insort(self._changeset_ids, changeset_id)
+        self._changeset_id_to_revid[changeset_id] = revid
 
 
 class TdbIdmap(BzrHgIdmap):
@@ -149,6 +381,15 @@ class TdbIdmap(BzrHgIdmap):
 
     format:
     manifest/<manifest_id> -> revid
+    revid/<revid> -> changeset_id + mapping
+    csid/<changeset_id> -> revid
+    csidprefix/<first two bytes of changeset_id> -> changeset ids
+    text/<node><path> -> "<fileid> <revid>\n"
+    textmeta/<node><path> -> "<sha1> <size>"
+    revids/count -> number of revision ids in the revids/ index
+    revids/<n> -> newline-separated revision ids, TDB_REVIDS_CHUNK_SIZE
+        per chunk
+    processed_heads -> newline-separated revision ids
     """
 
     def __init__(self, path=None):
@@ -162,13 +403,58 @@ class TdbIdmap(BzrHgIdmap):
                                           os.O_RDWR|os.O_CREAT)
             self.db = mapdbs()[path]
         try:
-            if int(self.db["version"]) != TDB_MAP_VERSION:
+            version = int(self.db["version"])
+        except KeyError:
+            self.db["version"] = str(TDB_MAP_VERSION)
+            self.db["revids/count"] = "0"
+        else:
+            if version == 1:
+                self._upgrade_from_v1()
+                version = 2
+            if version == 2:
+                self._upgrade_from_v2()
+                version = 3
+            if version != TDB_MAP_VERSION:
                 trace.warning("SHA Map is incompatible (%s -> %d), rebuilding database.",
                               self.db["version"], TDB_MAP_VERSION)
                 self.db.clear()
                 self.db["version"] = str(TDB_MAP_VERSION)
-        except KeyError:
-            self.db["version"] = str(TDB_MAP_VERSION)
+                self.db["revids/count"] = "0"
+
+    def _upgrade_from_v1(self):
+        """Add the revids/ index to a version 1 database."""
+        trace.mutter("Upgrading SHA Map from version 1 to 2.")
+        revids = [k[len("revid/"):] for k in self.db.iterkeys()
+                  if k.startswith("revid/")]
+        count = len(revids)
+        for i in xrange(0, count, TDB_REVIDS_CHUNK_SIZE):
+            chunk = revids[i:i+TDB_REVIDS_CHUNK_SIZE]
+            self.db["revids/%d" % (i / TDB_REVIDS_CHUNK_SIZE)] = \
+                "".join(["%s\n" % revid for revid in chunk])
+        self.db["revids/count"] = str(count)
+        self.db["version"] = "2"
+
+    def _upgrade_from_v2(self):
+        """Add the csid/ and csidprefix/ indexes to a version 2 database."""
+        trace.mutter("Upgrading SHA Map from version 2 to 3.")
+        for k in list(self.db.iterkeys()):
+            if k.startswith("revid/"):
+                changeset_id = self.db[k][:20]
+                self.db["csid/" + changeset_id] = k[len("revid/"):]
+                self._add_to_csid_prefix_index(changeset_id)
+        self.db["version"] = "3"
+
+    def start_write_group(self):
+        if self.path is not None:
+            self.db.transaction_start()
+
+    def commit_write_group(self):
+        if self.path is not None:
+            self.db.transaction_commit()
+
+    def abort_write_group(self):
+        if self.path is not None:
+            self.db.transaction_cancel()
 
     def get_files_by_revid(self, revid):
         raise KeyError(revid)
@@ -179,22 +465,86 @@ class TdbIdmap(BzrHgIdmap):
     def lookup_changeset_id_by_revid(self, revid):
         text = self.db["revid/" + revid]
         csid = text[:20]
-        return csid, mapping_registry.get(text[20:])
+        return csid, get_mapping(text[20:])
+
+    def lookup_revision_by_changeset_id(self, changeset_id):
+        if len(changeset_id) == 40:
+            changeset_id = mercurial.node.bin(changeset_id)
+        return self.db["csid/" + changeset_id]
+
+    def lookup_revisions_by_changeset_id_prefix(self, prefix):
+        # tdb has no ordered traversal, so changeset ids are bucketed by
+        # their first two bytes in the csidprefix/ index
+        if len(prefix) >= 4:
+            buckets = [mercurial.node.bin(prefix[:4])]
+        else:
+            extra = 4 - len(prefix)
+            buckets = [mercurial.node.bin(prefix + "%0*x" % (extra, i))
+                       for i in xrange(16 ** extra)]
+        ret = {}
+        for bucket in buckets:
+            try:
+                changeset_ids = self.db["csidprefix/" + bucket]
+            except KeyError:
+                continue
+            for i in xrange(0, len(changeset_ids), 20):
+                changeset_id = changeset_ids[i:i+20]
+                if mercurial.node.hex(changeset_id).startswith(prefix):
+                    ret[changeset_id] = self.db["csid/" + changeset_id]
+        return ret
 
     def revids(self):
         ret = set()
-        for k in self.db.iterkeys():
-            if k.startswith("manifest/"):
-                ret.add(self.db[k])
+        count = int(self.db["revids/count"])
+        for i in xrange(0, count, TDB_REVIDS_CHUNK_SIZE):
+            ret.update(
+                self.db["revids/%d" % (i / TDB_REVIDS_CHUNK_SIZE)].splitlines())
         return ret
 
+    def get_processed_heads(self):
+        try:
+            return set(self.db["processed_heads"].splitlines())
+        except KeyError:
+            return set()
+
+    def set_processed_heads(self, revids):
+        self.db["processed_heads"] = "".join(
+            ["%s\n" % revid for revid in revids])
+
+    def _add_to_revids_index(self, revid):
+        count = int(self.db["revids/count"])
+        key = "revids/%d" % (count / TDB_REVIDS_CHUNK_SIZE)
+        try:
+            chunk = self.db[key]
+        except KeyError:
+            chunk = ""
+        self.db[key] = chunk + revid + "\n"
+        self.db["revids/count"] = str(count + 1)
+
+    def _add_to_csid_prefix_index(self, changeset_id):
+        key = "csidprefix/" + changeset_id[:2]
+        try:
+            bucket = self.db[key]
+        except KeyError:
+            bucket = ""
+        self.db[key] = bucket + changeset_id
+
     def insert_revision(self, revid, manifest_id, changeset_id, mapping):
         if len(manifest_id) == 40:
             manifest_id = mercurial.node.bin(manifest_id)
         if len(changeset_id) == 40:
             changeset_id = mercurial.node.bin(changeset_id)
+        try:
+            self.db["revid/" + revid]
+        except KeyError:
+            self._add_to_revids_index(revid)
+        try:
+            self.db["csid/" + changeset_id]
+        except KeyError:
+            self._add_to_csid_prefix_index(changeset_id)
         self.db["manifest/" + manifest_id] = revid
         self.db["revid/" + revid] = changeset_id + str(mapping)
+        self.db["csid/" + changeset_id] = revid
 
     def lookup_text_by_path_and_node(self, path, node):
         try:
@@ -206,13 +556,27 @@ class TdbIdmap(BzrHgIdmap):
     def insert_text(self, path, node, fileid, revid):
         self.db["text/" + node + path] = "%s %s\n" % (fileid, revid)
 
+    def lookup_text_metadata(self, path, node):
+        (sha1, size) = self.db["textmeta/" + node + path].split(" ")
+        return (sha1, int(size))
+
+    def insert_text_metadata(self, path, node, sha1, size):
+        self.db["textmeta/" + node + path] = "%s %d" % (sha1, size)
+
 
 
 class SqliteIdmap(BzrHgIdmap):
     """Idmap that stores in SQLite.
+
+    Writes outside of a write group are committed straight away. Inside a
+    write group, new rows are kept in memory, where lookups take them into
+    account, and written with executemany() and a single commit when the
+    write group is committed. The connection is shared with other idmaps
+    for the same file, so nothing is written to it before then.
     """
 
     def __init__(self, path=None):
+        self._end_write_group()
         if path is None:
             self.db = sqlite3.connect(":memory:")
             self.db.text_factory = str
@@ -220,6 +584,7 @@ class SqliteIdmap(BzrHgIdmap):
             if not mapdbs().has_key(path):
                 mapdbs()[path] = sqlite3.connect(path)
                 mapdbs()[path].text_factory = str
+                mapdbs()[path].execute("pragma journal_mode = wal")
             self.db = mapdbs()[path]
         self.db.executescript("""
         create table if not exists revision (
@@ -239,31 +604,236 @@ class SqliteIdmap(BzrHgIdmap):
         );
         create unique index if not exists text_map_bzr_id on text_map (fileid, revid);
         create index if not exists text_map_hg_id on text_map (path, node);
+        create table if not exists text_metadata (
+            path blob not null,
+            node blob not null,
+            sha1 text not null,
+            size integer not null
+        );
+        create unique index if not exists text_metadata_hg_id on text_metadata (path, node);
+        create table if not exists processed_heads (
+            revid text not null
+        );
         """)
 
+    def start_write_group(self):
+        # revid -> (csid, manifest_id, mapping)
+        self._pending_revisions = {}
+        self._pending_changeset_ids = {}
+        self._pending_manifest_ids = {}
+        # (fileid, revid) -> (path, node), like the text_map_bzr_id index
+        self._pending_texts = {}
+        self._pending_text_keys = defaultdict(set)
+        self._pending_text_metadata = {}
+        self._pending_heads = None
+
+    def _end_write_group(self):
+        self._pending_revisions = None
+        self._pending_changeset_ids = None
+        self._pending_manifest_ids = None
+        self._pending_texts = None
+        self._pending_text_keys = None
+        self._pending_text_metadata = None
+        self._pending_heads = None
+
+    def commit_write_group(self):
+        try:
+            if self._pending_revisions:
+                self.db.executemany("insert into revision (revid, csid, manifest_id, mapping) values (?, ?, ?, ?)",
+                    [(revid, ) + row for (revid, row) in
+                     self._pending_revisions.iteritems()])
+            if self._pending_texts:
+                self.db.executemany("replace into text_map (path, node, fileid, revid) values (?, ?, ?, ?)",
+                    [(path, node, fileid, revid) for ((fileid, revid), (path, node)) in
+                     self._pending_texts.iteritems()])
+            if self._pending_text_metadata:
+                self.db.executemany("replace into text_metadata (path, node, sha1, size) values (?, ?, ?, ?)",
+                    [(path, node, sha1, size) for ((path, node), (sha1, size)) in
+                     self._pending_text_metadata.iteritems()])
+            if self._pending_heads is not None:
+                self._replace_processed_heads(self._pending_heads)
+        except:
+            # Only the rows of this write group are uncommitted
+            self.db.rollback()
+            raise
+        else:
+            self.db.commit()
+        finally:
+            self._end_write_group()
+
+    def abort_write_group(self):
+        self._end_write_group()
+
     def get_files_by_revid(self, revid):
         raise KeyError(revid)
 
     def lookup_revision_by_manifest_id(self, manifest_id):
         if len(manifest_id) == 20:
             manifest_id = mercurial.node.hex(manifest_id)
+        if self._pending_revisions is not None:
+            try:
+                return self._pending_manifest_ids[manifest_id]
+            except KeyError:
+                pass
         row = self.db.execute("select revid from revision where manifest_id = ?", (manifest_id,)).fetchone()
         if row is not None:
             return row[0]
         raise KeyError
 
     def lookup_changeset_id_by_revid(self, revid):
-        row = self.db.execute("select csid, mapping from revision where revid = ?").fetchone()
+        if self._pending_revisions is not None:
+            try:
+                (csid, manifest_id, mapping) = self._pending_revisions[revid]
+            except KeyError:
+                pass
+            else:
+                return mercurial.node.bin(csid), get_mapping(mapping)
+        row = self.db.execute("select csid, mapping from revision where revid = ?", (revid,)).fetchone()
         if row is not None:
-            return row[0], mapping_registry.get(row[1])
-        raise KeyError
+            return mercurial.node.bin(row[0]), get_mapping(row[1])
+        raise KeyError(revid)
+
+    def lookup_revision_by_changeset_id(self, changeset_id):
+        if len(changeset_id) == 20:
+            changeset_id = mercurial.node.hex(changeset_id)
+        if self._pending_revisions is not None:
+            try:
+                return self._pending_changeset_ids[changeset_id]
+            except KeyError:
+                pass
+        row = self.db.execute("select revid from revision where csid = ?", (changeset_id,)).fetchone()
+        if row is not None:
+            return row[0]
+        raise KeyError(changeset_id)
+
+    def lookup_revisions_by_changeset_ids(self, changeset_ids):
+        hex_ids = {}
+        for changeset_id in changeset_ids:
+            if len(changeset_id) == 20:
+                hex_ids[mercurial.node.hex(changeset_id)] = changeset_id
+            else:
+                hex_ids[changeset_id] = changeset_id
+        ret = {}
+        for (revid, changeset_id) in self._select_in(
+                "select revid, csid from revision where csid in (%s)",
+                [(changeset_id,) for changeset_id in hex_ids]):
+            ret[hex_ids[changeset_id]] = revid
+        if self._pending_revisions:
+            for (changeset_id, key) in hex_ids.iteritems():
+                if changeset_id in self._pending_changeset_ids:
+                    ret[key] = self._pending_changeset_ids[changeset_id]
+        return ret
+
+    def lookup_revisions_by_changeset_id_prefix(self, prefix):
+        # Every hex id that starts with prefix sorts before prefix + "g"
+        cursor = self.db.execute("select revid, csid from revision where csid >= ? and csid < ?", (prefix, prefix + "g"))
+        ret = dict((mercurial.node.bin(changeset_id), revid)
+                   for (revid, changeset_id) in cursor)
+        if self._pending_revisions:
+            for (changeset_id, revid) in self._pending_changeset_ids.iteritems():
+                if changeset_id.startswith(prefix):
+                    ret[mercurial.node.bin(changeset_id)] = revid
+        return ret
+
+    def _select_in(self, query, values, term="?", separator=", "):
+        """Run query once for every chunk of values.
+
+        :param query: Query with a %s placeholder for the list of terms
+        :param values: Sequence of parameter tuples
+        :param term: Expression to substitute for each item in values
+        :param separator: Separator to join the terms with
+        :return: Iterator over the result rows
+        """
+        if not values:
+            return
+        chunk_size = max(1, SQLITE_LOOKUP_CHUNK_SIZE // len(values[0]))
+        for i in xrange(0, len(values), chunk_size):
+            chunk = values[i:i+chunk_size]
+            params = []
+            for value in chunk:
+                params.extend(value)
+            for row in self.db.execute(
+                    query % separator.join([term] * len(chunk)), params):
+                yield row
+
+    def lookup_changeset_ids_by_revids(self, revids):
+        revids = set(revids)
+        ret = {}
+        for (revid, csid, mapping) in self._select_in(
+                "select revid, csid, mapping from revision where revid in (%s)",
+                [(revid,) for revid in revids]):
+            ret[revid] = (mercurial.node.bin(csid), get_mapping(mapping))
+        if self._pending_revisions:
+            for revid in revids:
+                if revid in self._pending_revisions:
+                    (csid, manifest_id, mapping) = self._pending_revisions[revid]
+                    ret[revid] = (mercurial.node.bin(csid),
+                                  get_mapping(mapping))
+        return ret
+
+    def lookup_revisions_by_manifest_ids(self, manifest_ids):
+        hex_ids = {}
+        for manifest_id in manifest_ids:
+            if len(manifest_id) == 20:
+                hex_ids[mercurial.node.hex(manifest_id)] = manifest_id
+            else:
+                hex_ids[manifest_id] = manifest_id
+        ret = {}
+        for (revid, manifest_id) in self._select_in(
+                "select revid, manifest_id from revision where manifest_id in (%s)",
+                [(manifest_id,) for manifest_id in hex_ids]):
+            ret[hex_ids[manifest_id]] = revid
+        if self._pending_revisions:
+            for (manifest_id, key) in hex_ids.iteritems():
+                if manifest_id in self._pending_manifest_ids:
+                    ret[key] = self._pending_manifest_ids[manifest_id]
+        return ret
+
+    def lookup_texts_by_path_and_node(self, keys):
+        keys = set(keys)
+        ret = {}
+        # "or" rather than a row value "in", so that older versions of
+        # sqlite can still use the text_map_hg_id index.
+        for (path, node, fileid, revid) in self._select_in(
+                "select path, node, fileid, revid from text_map where %s",
+                list(keys), "(path = ? and node = ?)", " or "):
+            if self._pending_texts and (fileid, revid) in self._pending_texts:
+                continue
+            ret.setdefault((path, node), []).append((fileid, revid))
+        if self._pending_texts:
+            for key in keys:
+                if self._pending_text_keys.get(key):
+                    ret.setdefault(key, []).extend(
+                        self._pending_text_keys[key])
+        return ret
 
     def revids(self):
         ret = set()
         ret.update((row for 
             (row,) in self.db.execute("select revid from revision")))
+        if self._pending_revisions:
+            ret.update(self._pending_revisions)
         return ret
 
+    def get_processed_heads(self):
+        if (self._pending_revisions is not None and
+            self._pending_heads is not None):
+            return set(self._pending_heads)
+        return set([row for (row,) in
+            self.db.execute("select revid from processed_heads")])
+
+    def _replace_processed_heads(self, revids):
+        self.db.execute("delete from processed_heads")
+        self.db.executemany("insert into processed_heads (revid) values (?)",
+            [(revid,) for revid in revids])
+
+    def set_processed_heads(self, revids):
+        if self._pending_revisions is not None:
+            self._pending_heads = set(revids)
+        else:
+            self._replace_processed_heads(revids)
+            self.db.commit()
+
     def insert_revision(self, revid, manifest_id, changeset_id, mapping):
         if len(manifest_id) == 20:
             manifest_id = mercurial.node.hex(manifest_id)
@@ -273,14 +843,488 @@ class SqliteIdmap(BzrHgIdmap):
             raise AssertionError
         if len(manifest_id) != 40:
             raise AssertionError
-        self.db.execute("insert into revision (revid, csid, manifest_id, mapping) values (?, ?, ?, ?)", (revid, changeset_id, manifest_id, str(mapping)))
+        if self._pending_revisions is not None:
+            self._pending_revisions[revid] = (changeset_id, manifest_id,
+                str(mapping))
+            self._pending_changeset_ids[changeset_id] = revid
+            self._pending_manifest_ids[manifest_id] = revid
+        else:
+            self.db.execute("insert into revision (revid, csid, manifest_id, mapping) values (?, ?, ?, ?)", (revid, changeset_id, manifest_id, str(mapping)))
+            self.db.commit()
 
     def lookup_text_by_path_and_node(self, path, node):
         cursor = self.db.execute("select fileid, revid from text_map where path = ? and node = ?", (path, node))
-        return cursor.fetchall()
+        if not self._pending_texts:
+            return cursor.fetchall()
+        ret = [text for text in cursor if text not in self._pending_texts]
+        ret.extend(self._pending_text_keys.get((path, node), ()))
+        return ret
 
     def insert_text(self, path, node, fileid, revid):
-        self.db.execute("replace into text_map (path, node, fileid, revid) values (?, ?, ?, ?)", (path, node, fileid, revid))
+        if self._pending_revisions is not None:
+            old_key = self._pending_texts.get((fileid, revid))
+            if old_key is not None:
+                self._pending_text_keys[old_key].discard((fileid, revid))
+            self._pending_texts[(fileid, revid)] = (path, node)
+            self._pending_text_keys[(path, node)].add((fileid, revid))
+        else:
+            self.db.execute("replace into text_map (path, node, fileid, revid) values (?, ?, ?, ?)", (path, node, fileid, revid))
+            self.db.commit()
+
+    def lookup_text_metadata(self, path, node):
+        if self._pending_revisions is not None:
+            try:
+                return self._pending_text_metadata[(path, node)]
+            except KeyError:
+                pass
+        row = self.db.execute("select sha1, size from text_metadata where path = ? and node = ?", (path, node)).fetchone()
+        if row is not None:
+            return (row[0], row[1])
+        raise KeyError((path, node))
+
+    def insert_text_metadata(self, path, node, sha1, size):
+        if self._pending_revisions is not None:
+            self._pending_text_metadata[(path, node)] = (sha1, size)
+        else:
+            self.db.execute("replace into text_metadata (path, node, sha1, size) values (?, ?, ?, ?)", (path, node, sha1, size))
+            self.db.commit()
+
+
+class MmapIdmap(BzrHgIdmap):
+    """Idmap that stores in memory-mapped files.
+
+    The base file starts with a header listing, for each table in
+    MMAP_TABLES, the offset and number of its records. Each table is a
+    sorted array of fixed-width (key, value offset, value length) records
+    that is searched by bisection; the values live in a heap between the
+    header and the tables.
+
+    format:
+    manifest: <manifest_id> -> revid
+    revid: sha1(revid) -> revid + "\0" + changeset_id + mapping
+    csid: <changeset_id> -> revid
+    text: sha1(path + "\0" + node) -> path + "\0" + node + "<fileid> <revid>\n"
+    textmeta: sha1(path + "\0" + node) -> path + "\0" + node + "<sha1> <size>"
+
+    New entries are appended to a log file next to the base file, which is
+    read into memory on open and merged into a new base file once it grows
+    beyond MMAP_COMPACT_THRESHOLD entries, when it is either appended to or
+    opened. Appending and compacting are serialized between processes by a
+    lock on a ".lock" file. The processed heads are kept in a separate
+    ".heads" file. Base files that are damaged or of another version are
+    removed, after which the map is rebuilt.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._map = None
+        self._tables = [(0, 0)] * len(MMAP_TABLES)
+        self._delta = [{} for t in MMAP_TABLES]
+        self._pending = None
+        self._saved_delta = None
+        self._processed_heads = None
+        self._pending_heads = None
+        if path is not None:
+            self._open_base()
+            self._read_log()
+            if sum(map(len, self._delta)) > MMAP_COMPACT_THRESHOLD:
+                # Save the next process from replaying the log again
+                try:
+                    self.compact()
+                except (IOError, OSError), e:
+                    trace.mutter("Unable to compact %s: %s", self.path, e)
+
+    def _open_base(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can not be mapped
+            m = None
+        finally:
+            f.close()
+        tables = self._parse_header(m)
+        if tables is None:
+            if m is not None:
+                m.close()
+            trace.warning("SHA Map is incompatible or damaged, rebuilding database.")
+            self._remove_files()
+            return
+        self._map = m
+        self._tables = tables
+
+    def _parse_header(self, m):
+        """Parse the header of a base file.
+
+        :param m: Mapped base file, or None if it was empty
+        :return: List with the offset and number of records of each table,
+            or None if this is not a complete base file of this version
+        """
+        if m is None or len(m) < MMAP_HEADER.size:
+            return None
+        header = MMAP_HEADER.unpack_from(m, 0)
+        if header[0] != MMAP_MAGIC:
+            return None
+        tables = zip(header[1::2], header[2::2])
+        for (offset, count) in tables:
+            if offset + count * MMAP_RECORD.size > len(m):
+                return None
+        return tables
+
+    def _lock(self):
+        """Take an exclusive lock for changing the base and log files.
+
+        :return: Lock file, which releases the lock when closed
+        """
+        f = open(self.path + ".lock", 'ab')
+        if fcntl is not None:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+        return f
+
+    def _remove_files(self):
+        """Remove the base, log and processed heads files.
+
+        As no heads are processed afterwards, all entries will be added
+        again.
+        """
+        lock = self._lock()
+        try:
+            for suffix in ("", ".log", ".heads"):
+                try:
+                    os.unlink(self.path + suffix)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        finally:
+            lock.close()
+
+    def _read_log(self):
+        """Read the log file into the in-memory delta.
+
+        :return: Number of bytes of the log that were read
+        """
+        try:
+            f = open(self.path + ".log", 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        offset = 0
+        while offset + MMAP_LOG_RECORD.size <= len(data):
+            (table, key, length) = MMAP_LOG_RECORD.unpack_from(data, offset)
+            offset += MMAP_LOG_RECORD.size
+            if offset + length > len(data):
+                # Truncated by an interrupted write
+                break
+            self._delta[table][key] = data[offset:offset+length]
+            offset += length
+        return offset
+
+    def _truncate_log(self, length):
+        """Remove the first length bytes from the log file."""
+        try:
+            f = open(self.path + ".log", 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            f.seek(length)
+            remaining = f.read()
+        finally:
+            f.close()
+        f = open(self.path + ".log.tmp", 'wb')
+        try:
+            f.write(remaining)
+        finally:
+            f.close()
+        os.rename(self.path + ".log.tmp", self.path + ".log")
+
+    def _append_log(self, records):
+        lock = self._lock()
+        try:
+            f = open(self.path + ".log", 'ab')
+            try:
+                f.write("".join(records))
+            finally:
+                f.close()
+            if sum(map(len, self._delta)) > MMAP_COMPACT_THRESHOLD:
+                self._compact()
+        finally:
+            lock.close()
+
+    def _iter_base(self, table):
+        (offset, count) = self._tables[table]
+        for i in xrange(count):
+            (key, value_offset, value_length) = MMAP_RECORD.unpack_from(
+                self._map, offset + i * MMAP_RECORD.size)
+            yield key, self._map[value_offset:value_offset+value_length]
+
+    def _lookup_base(self, table, key):
+        (offset, count) = self._tables[table]
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = offset + mid * MMAP_RECORD.size
+            mid_key = self._map[start:start+20]
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                (key, value_offset, value_length) = MMAP_RECORD.unpack_from(
+                    self._map, start)
+                return self._map[value_offset:value_offset+value_length]
+        raise KeyError(key)
+
+    def _iter_base_range(self, table, lo, hi):
+        """Iterate over the base records with lo <= key <= hi."""
+        (offset, count) = self._tables[table]
+        start, end = 0, count
+        while start < end:
+            mid = (start + end) // 2
+            mid_offset = offset + mid * MMAP_RECORD.size
+            if self._map[mid_offset:mid_offset+20] < lo:
+                start = mid + 1
+            else:
+                end = mid
+        for i in xrange(start, count):
+            (key, value_offset, value_length) = MMAP_RECORD.unpack_from(
+                self._map, offset + i * MMAP_RECORD.size)
+            if key > hi:
+                break
+            yield key, self._map[value_offset:value_offset+value_length]
+
+    def _lookup(self, table, key):
+        try:
+            return self._delta[table][key]
+        except KeyError:
+            return self._lookup_base(table, key)
+
+    def _insert(self, entries):
+        """Add entries to the map.
+
+        :param entries: List of (table, key, value) tuples, which are
+            appended to the log together
+        """
+        records = []
+        for (table, key, value) in entries:
+            self._delta[table][key] = value
+            records.append(
+                MMAP_LOG_RECORD.pack(table, key, len(value)) + value)
+        if self.path is None:
+            return
+        if self._pending is not None:
+            self._pending.extend(records)
+        else:
+            self._append_log(records)
+
+    def compact(self):
+        """Merge the log into a new base file."""
+        if self.path is None:
+            return
+        lock = self._lock()
+        try:
+            self._compact()
+        finally:
+            lock.close()
+
+    def _compact(self):
+        # Pick up the records other processes have appended to the log;
+        # only the part of the log that was read gets folded in.
+        log_length = self._read_log()
+        tables = []
+        for table in range(len(MMAP_TABLES)):
+            entries = dict(self._iter_base(table))
+            entries.update(self._delta[table])
+            tables.append(sorted(entries.iteritems()))
+        heap = []
+        records = []
+        heap_offset = MMAP_HEADER.size
+        for entries in tables:
+            table_records = []
+            for key, value in entries:
+                table_records.append(
+                    MMAP_RECORD.pack(key, heap_offset, len(value)))
+                heap.append(value)
+                heap_offset += len(value)
+            records.append(table_records)
+        header = [MMAP_MAGIC]
+        table_offset = heap_offset
+        for table_records in records:
+            header.extend([table_offset, len(table_records)])
+            table_offset += len(table_records) * MMAP_RECORD.size
+        f = open(self.path + ".tmp", 'wb')
+        try:
+            f.write(MMAP_HEADER.pack(*header))
+            f.write("".join(heap))
+            for table_records in records:
+                f.write("".join(table_records))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        os.rename(self.path + ".tmp", self.path)
+        self._truncate_log(log_length)
+        self._delta = [{} for t in MMAP_TABLES]
+        self._open_base()
+
+    def start_write_group(self):
+        self._pending = []
+        if self.path is None:
+            self._saved_delta = [dict(d) for d in self._delta]
+
+    def commit_write_group(self):
+        pending = self._pending
+        self._pending = None
+        self._saved_delta = None
+        if pending:
+            self._append_log(pending)
+        if self._pending_heads is not None:
+            self._write_processed_heads(self._pending_heads)
+            self._pending_heads = None
+
+    def abort_write_group(self):
+        self._pending = None
+        self._pending_heads = None
+        if self.path is None:
+            self._delta = self._saved_delta
+            self._saved_delta = None
+        else:
+            self._delta = [{} for t in MMAP_TABLES]
+            self._read_log()
+
+    def get_files_by_revid(self, revid):
+        raise KeyError(revid)
+
+    def lookup_revision_by_manifest_id(self, manifest_id):
+        if len(manifest_id) == 40:
+            manifest_id = mercurial.node.bin(manifest_id)
+        return self._lookup(MMAP_TABLES.index("manifest"), manifest_id)
+
+    def lookup_changeset_id_by_revid(self, revid):
+        value = self._lookup(MMAP_TABLES.index("revid"), osutils.sha(revid).digest())
+        (stored_revid, rest) = value.split("\0", 1)
+        if stored_revid != revid:
+            raise KeyError(revid)
+        return rest[:20], get_mapping(rest[20:])
+
+    def lookup_revision_by_changeset_id(self, changeset_id):
+        if len(changeset_id) == 40:
+            changeset_id = mercurial.node.bin(changeset_id)
+        return self._lookup(MMAP_TABLES.index("csid"), changeset_id)
+
+    def lookup_revisions_by_changeset_id_prefix(self, prefix):
+        table = MMAP_TABLES.index("csid")
+        lo = mercurial.node.bin((prefix + "0" * 40)[:40])
+        hi = mercurial.node.bin((prefix + "f" * 40)[:40])
+        ret = {}
+        if self._map is not None:
+            ret.update(self._iter_base_range(table, lo, hi))
+        for (changeset_id, revid) in self._delta[table].iteritems():
+            if lo <= changeset_id <= hi:
+                ret[changeset_id] = revid
+        return ret
+
+    def revids(self):
+        table = MMAP_TABLES.index("revid")
+        ret = set()
+        if self._map is not None:
+            ret.update(value.split("\0", 1)[0]
+                       for (key, value) in self._iter_base(table))
+        ret.update(value.split("\0", 1)[0]
+                   for value in self._delta[table].itervalues())
+        return ret
+
+    def get_processed_heads(self):
+        if self._pending_heads is not None:
+            return set(self._pending_heads)
+        if self._processed_heads is None:
+            self._processed_heads = set()
+            if self.path is not None:
+                try:
+                    f = open(self.path + ".heads", 'rb')
+                except IOError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                else:
+                    try:
+                        self._processed_heads.update(f.read().splitlines())
+                    finally:
+                        f.close()
+        return set(self._processed_heads)
+
+    def _write_processed_heads(self, revids):
+        self._processed_heads = set(revids)
+        if self.path is None:
+            return
+        f = open(self.path + ".heads.tmp", 'wb')
+        try:
+            f.write("".join(["%s\n" % revid for revid in revids]))
+        finally:
+            f.close()
+        os.rename(self.path + ".heads.tmp", self.path + ".heads")
+
+    def set_processed_heads(self, revids):
+        if self._pending is not None:
+            self._pending_heads = set(revids)
+        else:
+            self._write_processed_heads(set(revids))
+
+    def insert_revision(self, revid, manifest_id, changeset_id, mapping):
+        if len(manifest_id) == 40:
+            manifest_id = mercurial.node.bin(manifest_id)
+        if len(changeset_id) == 40:
+            changeset_id = mercurial.node.bin(changeset_id)
+        self._insert([
+            (MMAP_TABLES.index("manifest"), manifest_id, revid),
+            (MMAP_TABLES.index("revid"), osutils.sha(revid).digest(),
+             "%s\0%s%s" % (revid, changeset_id, mapping)),
+            (MMAP_TABLES.index("csid"), changeset_id, revid)])
+
+    def lookup_text_by_path_and_node(self, path, node):
+        prefix = "%s\0%s" % (path, node)
+        try:
+            value = self._lookup(MMAP_TABLES.index("text"),
+                osutils.sha(prefix).digest())
+        except KeyError:
+            return []
+        if not value.startswith(prefix):
+            return []
+        return [tuple(l.split(" "))
+                for l in value[len(prefix):].splitlines()]
+
+    def insert_text(self, path, node, fileid, revid):
+        prefix = "%s\0%s" % (path, node)
+        self._insert([(MMAP_TABLES.index("text"),
+            osutils.sha(prefix).digest(),
+            "%s%s %s\n" % (prefix, fileid, revid))])
+
+    def lookup_text_metadata(self, path, node):
+        prefix = "%s\0%s" % (path, node)
+        value = self._lookup(MMAP_TABLES.index("textmeta"),
+            osutils.sha(prefix).digest())
+        if not value.startswith(prefix):
+            raise KeyError((path, node))
+        (sha1, size) = value[len(prefix):].split(" ")
+        return (sha1, int(size))
+
+    def insert_text_metadata(self, path, node, sha1, size):
+        prefix = "%s\0%s" % (path, node)
+        self._insert([(MMAP_TABLES.index("textmeta"),
+            osutils.sha(prefix).digest(), "%s%s %d" % (prefix, sha1, size))])
 
 
 class BzrHgCacheFormat(object):
@@ -357,11 +1401,22 @@ class TdbBzrHgCacheFormat(BzrHgCacheFormat):
         return TdbIdmap(transport.local_abspath('idmap.tdb'))
 
 
+class MmapBzrHgCacheFormat(BzrHgCacheFormat):
+
+    def get_format_string(self):
+        return 'bzr-hg mmap cache v1\n'
+
+    def open(self, transport):
+        return MmapIdmap(transport.local_abspath('idmap.mmap'))
+
+
 formats = registry.Registry()
 formats.register(TdbBzrHgCacheFormat().get_format_string(),
     TdbBzrHgCacheFormat())
 formats.register(SqliteBzrHgCacheFormat().get_format_string(),
     SqliteBzrHgCacheFormat())
+formats.register(MmapBzrHgCacheFormat().get_format_string(),
+    MmapBzrHgCacheFormat())
 try:
     import tdb
 except ImportError:
@@ -391,7 +1446,7 @@ def migrate_ancient_formats(repo_transport):
         repo_transport.rename("hg.tdb", "hg/idmap.tdb")
 
 
-def from_repository(repository):
+def from_repository(repository, create=True):
     """Open a cache file for a repository.
 
     If the repository is remote and there is no transport available from it
@@ -399,15 +1454,26 @@ def from_repository(repository):
     (typically ~/.cache/bazaar/hg/)
 
     :param repository: A repository object
+    :param create: Whether to create the cache if it does not exist yet
+    :return: An idmap, or None if create is False and there is no cache
     """
     repo_transport = getattr(repository, "_transport", None)
     if repo_transport is not None:
-        # Migrate older cache formats
+        # Even if we don't write to this repo, we should be able
+        # to update its cache.
         repo_transport = remove_readonly_transport_decorator(repo_transport)
-        try:
-            repo_transport.mkdir("hg")
-        except errors.FileExists:
-            pass
-        else:
-            migrate_ancient_formats(repo_transport)
-    return BzrHgCacheFormat.from_repository(repository)
+        # Migrate older cache formats
+        if (create or repo_transport.has("hg-v2.db") or
+            repo_transport.has("hg.tdb")):
+            try:
+                repo_transport.mkdir("hg")
+            except errors.FileExists:
+                pass
+            else:
+                migrate_ancient_formats(repo_transport)
+        transport = repo_transport.clone("hg")
+    else:
+        transport = get_remote_cache_transport()
+    if not create and not transport.has("format"):
+        return None
+    return BzrHgCacheFormat.from_transport(transport)
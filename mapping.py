@@ -193,17 +193,21 @@ def find_matching_entry(parent_trees, path, text_sha1):
     return None
 
 
-def manifest_and_flags_from_tree(parent_trees, tree, mapping, parent_node_lookup):
-    """Generate a manifest from a Bazaar tree.
+def _add_manifest_entries(parent_trees, tree, mapping, parent_node_lookup,
+                          entries, manifest, flags, unusual_fileids):
+    """Add the manifest entries for a set of inventory entries.
 
     :param parent_trees: Parent trees
     :param tree: Tree
     :param mapping: Bzr<->Hg mapping
     :param parent_node_lookup: 2-tuple with functions to look up the nodes
         of paths in the tree's parents
+    :param entries: Iterable over (path, inventory entry) tuples
+    :param manifest: Manifest dictionary to update
+    :param flags: Flags dictionary to update
+    :param unusual_fileids: Dictionary to add unusual file ids to
     """
     assert len(parent_node_lookup) == 2
-    unusual_fileids = {}
     def get_text_parents(path):
         assert type(path) == str
         ret = []
@@ -214,9 +218,7 @@ def manifest_and_flags_from_tree(parent_trees, tree, mapping, parent_node_lookup
                 ret.append(mercurial.node.nullid)
         assert len(ret) == 2
         return tuple(ret)
-    manifest = {}
-    flags = {}
-    for path, entry in tree.iter_entries_by_dir():
+    for path, entry in entries:
         this_sha1 = entry_sha1(entry)
         prev_entry = find_matching_entry(parent_trees, path, this_sha1)
         utf8_path = path.encode("utf-8")
@@ -234,6 +236,77 @@ def manifest_and_flags_from_tree(parent_trees, tree, mapping, parent_node_lookup
         if ((mapping.generate_file_id(utf8_path) != entry.file_id or entry.kind == 'directory') and
             (parent_trees == [] or parent_trees[0].path2id(path) != entry.file_id)):
             unusual_fileids[utf8_path] = entry.file_id
+
+
+def manifest_and_flags_from_tree(parent_trees, tree, mapping, parent_node_lookup):
+    """Generate a manifest from a Bazaar tree.
+
+    :param parent_trees: Parent trees
+    :param tree: Tree
+    :param mapping: Bzr<->Hg mapping
+    :param parent_node_lookup: 2-tuple with functions to look up the nodes
+        of paths in the tree's parents
+    """
+    unusual_fileids = {}
+    manifest = {}
+    flags = {}
+    _add_manifest_entries(parent_trees, tree, mapping, parent_node_lookup,
+        tree.iter_entries_by_dir(), manifest, flags, unusual_fileids)
+    return (manifest, flags, unusual_fileids)
+
+
+def manifest_and_flags_from_delta(parent_trees, tree, mapping,
+                                  parent_node_lookup, base, delta):
+    """Generate a manifest from the manifest of a tree's left-hand parent.
+
+    Only the paths touched by delta are looked at, so the cost is
+    proportional to the size of the change rather than that of the tree.
+
+    :param parent_trees: Parent trees
+    :param tree: Tree
+    :param mapping: Bzr<->Hg mapping
+    :param parent_node_lookup: 2-tuple with functions to look up the nodes
+        of paths in the tree's parents
+    :param base: Tuple with the manifest and flags of the left-hand parent
+    :param delta: breezy.delta.TreeDelta between the left-hand parent
+        tree (or the empty tree) and tree
+    """
+    renamed_directories = [change for change in delta.renamed
+                           if change[3] == 'directory']
+    if renamed_directories:
+        # The paths of the children of a renamed directory change without
+        # them being part of the delta.
+        return manifest_and_flags_from_tree(parent_trees, tree, mapping,
+            parent_node_lookup)
+    removed = set()
+    touched = set()
+    for change in delta.removed:
+        removed.add(change[0])
+    for change in delta.added + delta.modified + delta.kind_changed:
+        touched.add(change[0])
+    for (oldpath, newpath, file_id, kind, text_modified,
+         meta_modified) in delta.renamed:
+        removed.add(oldpath)
+        touched.add(newpath)
+    (manifest, flags) = base
+    manifest = dict(manifest)
+    flags = dict(flags)
+    for path in removed | touched:
+        utf8_path = path.encode("utf-8")
+        manifest.pop(utf8_path, None)
+        flags.pop(utf8_path, None)
+    unusual_fileids = {}
+    # The root is not part of the delta, but its file id has to be recorded
+    # like that of any other directory.
+    root_id = tree.path2id("")
+    if parent_trees == [] or parent_trees[0].path2id("") != root_id:
+        unusual_fileids[""] = root_id
+    if touched:
+        _add_manifest_entries(parent_trees, tree, mapping, parent_node_lookup,
+            ((path, entry) for (path, entry) in
+                tree.iter_entries_by_dir(specific_files=sorted(touched))
+                if path in touched),
+            manifest, flags, unusual_fileids)
     return (manifest, flags, unusual_fileids)
 
 
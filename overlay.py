@@ -16,6 +16,8 @@
 
 """Overlay that allows accessing a Bazaar repository like a Mercurial one."""
 
+import time
+
 import mercurial.node
 from mercurial.revlog import (
     hash as hghash,
@@ -28,6 +30,7 @@ from breezy import (
     errors,
     lru_cache,
     revision as _mod_revision,
+    trace,
     ui,
     )
 from breezy.bzr.knit import (
@@ -59,6 +62,10 @@ from breezy.plugins.hg.parsers import (
     )
 
 
+# Number of revisions to retrieve at once when updating the idmap
+IDMAP_UPDATE_BATCH_SIZE = 100
+
+
 class changelog_wrapper(object):
 
     def __init__(self, bzrrepo, mapping):
@@ -69,11 +76,13 @@ class changelog_wrapper(object):
         return None # FIXME
 
 
-def get_overlay(bzr_repo, mapping=None):
+def get_overlay(bzr_repo, mapping=None, create=True):
     """Create an overlay for a Bazaar repository.
 
     :param bzr_repo: Bazaar repository to create an overlay for.
     :param mapping: Optional mapping to use
+    :param create: Whether to create the idmap cache if it does not exist
+        yet; if not, an empty in-memory idmap is used instead
     :return: Mercurial overlay
     """
     if mapping is None:
@@ -85,7 +94,7 @@ def get_overlay(bzr_repo, mapping=None):
     else:
         manifests = None
     return MercurialRepositoryOverlay(bzr_repo, mapping,
-        idmap_from_repository(bzr_repo), manifests)
+        idmap_from_repository(bzr_repo, create=create), manifests)
 
 
 class MercurialRepositoryOverlay(object):
@@ -101,6 +110,7 @@ class MercurialRepositoryOverlay(object):
         self.manifests_vf = manifests
         self.manifests_lru = lru_cache.LRUCache()
         self.changelog = changelog_wrapper(self.repo, self.mapping)
+        self._idmap_refreshed = None
 
     def __repr__(self):
         return "%s(%r, %r)" % (self.__class__.__name__, self.repo, self.mapping)
@@ -170,34 +180,96 @@ class MercurialRepositoryOverlay(object):
             if text_modified:
                 update_text(path, fileid, kind)
 
-    def _update_idmap(self, stop_revision=None):
-        present_revids = self.idmap.revids()
+    def _update_idmap(self, stop_revisions=None):
+        """Add the revisions that are not yet in the idmap.
+
+        Only the ancestry that is new since the last update is considered;
+        the heads that have been processed are stored in the idmap.
+
+        :param stop_revisions: Revisions to update up to, or None to update
+            all revisions in the repository
+        """
         graph = self.repo.get_graph()
-        if stop_revision is None:
-            wanted = self.repo.all_revision_ids()
+        processed_heads = self.idmap.get_processed_heads()
+        if stop_revisions is None:
+            # Also include the revisions that no branch refers to. Only the
+            # revision index is read for this.
+            all_revids = set(self.repo.all_revision_ids())
+            heads = set(all_revids)
+            for parents in self.repo.get_parent_map(all_revids).itervalues():
+                heads.difference_update(parents)
         else:
-            wanted = graph.find_unique_ancestors(stop_revision, present_revids)
-        todo = set(wanted) - present_revids - set([_mod_revision.NULL_REVISION])
-        revs = self.repo.get_revisions(todo)
+            heads = set(stop_revisions)
+        heads -= processed_heads
+        heads.discard(_mod_revision.NULL_REVISION)
+        if not heads:
+            return
+        processed_heads = set(self.repo.has_revisions(processed_heads))
+        # Walk back from all new heads at once, stopping at the processed
+        # heads and at revisions that are already in the idmap; revisions
+        # fetched from Mercurial are added to the idmap as they are
+        # fetched, without updating the processed heads.
+        wanted = set()
+        pending = set(heads)
+        while pending:
+            pending.difference_update(
+                self.idmap.lookup_changeset_ids_by_revids(pending))
+            parent_map = self.repo.get_parent_map(pending)
+            parent_map.pop(_mod_revision.NULL_REVISION, None)
+            wanted.update(parent_map)
+            pending = set()
+            for parents in parent_map.itervalues():
+                pending.update(parents)
+            pending -= wanted
+            pending -= processed_heads
+            pending.discard(_mod_revision.NULL_REVISION)
+        todo = list(graph.iter_topo_order(wanted))
+        start_time = time.time()
         pb = ui.ui_factory.nested_progress_bar()
         try:
-            for i, revid in enumerate(graph.iter_topo_order(todo)):
-                pb.update("updating cache", i, len(todo))
-                rev = self.repo.get_revision(revid)
-                (manifest_id, user, (time, timezone), desc, extra) = \
-                    self.mapping.export_revision(rev)
-                if manifest_id is None:
-                    manifest_text = self.get_manifest_text_by_revid(revid)
-                    self.remember_manifest_text(revid, rev.parent_ids, manifest_text)
-                    manifest_id = hghash(manifest_text, *as_hg_parents(rev.parent_ids[:2], self.lookup_manifest_id_by_revid))
-
-                changeset_text = self.get_changeset_text_by_revid(revid, rev,
-                    manifest_id=manifest_id)
-                changeset_id = hghash(changeset_text, *as_hg_parents(rev.parent_ids[:2], lambda x: self.lookup_changeset_id_by_revid(x)[0]))
-                self.idmap.insert_revision(revid, manifest_id, changeset_id, self.mapping)
-                self._update_texts(revid)
+            with self.idmap.batch():
+                for offset in xrange(0, len(todo), IDMAP_UPDATE_BATCH_SIZE):
+                    batch = todo[offset:offset+IDMAP_UPDATE_BATCH_SIZE]
+                    for i, rev in enumerate(self.repo.get_revisions(batch)):
+                        pb.update("updating cache", offset + i, len(todo))
+                        self._add_revision_to_idmap(rev)
+                self.idmap.set_processed_heads(
+                    graph.heads(processed_heads | heads))
         finally:
             pb.finished()
+        duration = time.time() - start_time
+        trace.mutter("added %d revisions to the idmap in %.2fs (%.1f/s)",
+                     len(todo), duration, len(todo) / max(duration, 0.001))
+
+    def _refresh_idmap(self):
+        """Add all revisions that are missing to the idmap.
+
+        Lookups of ids that the repository doesn't have would otherwise
+        scan it every time, so this is only done once per repository lock.
+        Every outermost lock starts a new transaction, which is what
+        identifies the lock.
+        """
+        transaction = self.repo.get_transaction()
+        if self._idmap_refreshed is transaction:
+            return
+        self._update_idmap()
+        if self.repo.is_locked():
+            self._idmap_refreshed = transaction
+
+    def _add_revision_to_idmap(self, rev):
+        revid = rev.revision_id
+        (manifest_id, user, date, desc, extra) = \
+            self.mapping.export_revision(rev)
+        if manifest_id is None:
+            manifest_text = self.get_manifest_text_by_revid(revid)
+            self.remember_manifest_text(revid, rev.parent_ids, manifest_text)
+            manifest_id = hghash(manifest_text, *as_hg_parents(rev.parent_ids[:2], self.lookup_manifest_id_by_revid))
+
+        changeset_text = self.get_changeset_text_by_revid(revid, rev,
+            manifest_id=manifest_id)
+        changeset_id = hghash(changeset_text, *as_hg_parents(rev.parent_ids[:2], lambda x: self.lookup_changeset_id_by_revid(x)[0]))
+        self.idmap.insert_revision(revid, manifest_id, changeset_id, self.mapping)
+        self._update_texts(revid)
 
     def __len__(self):
         # Slow...
@@ -302,13 +374,17 @@ class MercurialRepositoryOverlay(object):
         bzr_revid = self.mapping.revision_id_foreign_to_bzr(changeset_id)
         if self.repo.has_revision(bzr_revid):
             return bzr_revid
-        return self.idmap.lookup_revision(changeset_id)
+        try:
+            return self.idmap.lookup_revision_by_changeset_id(changeset_id)
+        except KeyError:
+            self._refresh_idmap()
+            return self.idmap.lookup_revision_by_changeset_id(changeset_id)
 
     def _lookup_revision_by_manifest_id(self, manifest_id):
         try:
             return self.idmap.lookup_revision_by_manifest_id(manifest_id)
         except KeyError:
-            self._update_idmap()
+            self._refresh_idmap()
             return self.idmap.lookup_revision_by_manifest_id(manifest_id)
 
     def has_hgid(self, id):
@@ -323,6 +399,29 @@ class MercurialRepositoryOverlay(object):
         (manifest, flags) = self.get_manifest_and_flags_by_revid(revid)
         return manifest[path]
 
+    def lookup_text_nodes_by_revids_and_path(self, revids, path):
+        """Look up the nodes of a file in a series of revisions.
+
+        :param revids: Iterable over revision ids
+        :param path: Path of the file
+        :return: Dictionary mapping revision ids to file nodes. Revisions
+            in which path is not present are omitted.
+        """
+        ret = {}
+        todo = []
+        for revid in revids:
+            try:
+                (manifest, flags) = self._get_cached_manifest(revid)
+            except KeyError:
+                todo.append(revid)
+            else:
+                if path in manifest:
+                    ret[revid] = manifest[path]
+        for revid, (manifest, flags) in self.get_manifest_and_flags_by_revids(todo):
+            if path in manifest:
+                ret[revid] = manifest[path]
+        return ret
+
     def lookup_manifest_id_by_revid(self, revid):
         rev = self.repo.get_revision(revid)
         return mercurial.node.bin(rev.properties['manifest'])
@@ -355,9 +454,33 @@ class MercurialRepositoryOverlay(object):
             try:
                 return self.idmap.lookup_changeset_id_by_revid(revid)
             except KeyError:
-                self._update_idmap(stop_revision=revid)
+                self._update_idmap(stop_revisions=[revid])
                 return self.idmap.lookup_changeset_id_by_revid(revid)
 
+    def lookup_changeset_ids_by_revids(self, revids):
+        """Lookup the Mercurial changeset ids for a series of revision ids.
+
+        :param revids: Iterable over revision ids
+        :return: Dictionary mapping revision ids to tuples with mercurial
+            changeset id and mapping. Unknown revisions are omitted.
+        """
+        ret = {}
+        todo = set()
+        for revid in revids:
+            try:
+                ret[revid] = self.mapping.revision_id_bzr_to_foreign(revid)
+            except errors.InvalidRevisionId:
+                todo.add(revid)
+        if not todo:
+            return ret
+        found = self.idmap.lookup_changeset_ids_by_revids(todo)
+        missing = todo - set(found)
+        if missing:
+            self._update_idmap(stop_revisions=missing)
+            found.update(self.idmap.lookup_changeset_ids_by_revids(missing))
+        ret.update(found)
+        return ret
+
     def heads(self):
         """Determine the hg heads in this repository."""
         self.repo.lock_read()
@@ -366,8 +489,9 @@ class MercurialRepositoryOverlay(object):
             parent_map = self.repo.get_parent_map(all_revs)
             all_parents = set()
             map(all_parents.update, parent_map.itervalues())
-            return set([self.lookup_changeset_id_by_revid(revid)[0]
-                        for revid in set(all_revs) - all_parents])
+            return set([csid for (csid, mapping) in
+                self.lookup_changeset_ids_by_revids(
+                    set(all_revs) - all_parents).itervalues()])
         finally:
             self.repo.unlock()
 
@@ -377,11 +501,19 @@ class MercurialRepositoryOverlay(object):
         :param ids: Mercurial revision ids
         :return: Set with the revisions that were present
         """
-        # TODO: What about round-tripped revisions?
         revids = set([self.mapping.revision_id_foreign_to_bzr(h) for h in ids])
-        return set([
+        ret = set([
             self.mapping.revision_id_bzr_to_foreign(revid)[0]
             for revid in self.repo.has_revisions(revids)])
+        # Revisions that originated in Bazaar and were pushed to Mercurial
+        # are only known by their Bazaar revision id.
+        roundtripped = self.idmap.lookup_revisions_by_changeset_ids(
+            set(ids) - ret)
+        if roundtripped:
+            present = self.repo.has_revisions(roundtripped.values())
+            ret.update([csid for (csid, revid) in roundtripped.iteritems()
+                        if revid in present])
+        return ret
 
     def changegroup(self, nodes, kind):
         """See mercurial.repo.changegroup()."""
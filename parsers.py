@@ -124,53 +124,126 @@ def parse_changeset(text):
     return (manifest, user, (time, timezone), files, desc, extra)
 
 
-def pack_chunk_iter(entries, textbase):
+def order_by_first_parent(entries, window):
+    """Reorder a series of texts so they follow their first parent.
+
+    Changegroup deltas are always against the previous text in the series,
+    so emitting a text right after its first parent keeps the deltas small
+    for interleaved histories. The first entry is never moved, as the base
+    text for its delta has already been picked. The result is still in
+    topological order.
+
+    :param entries: Iterator over (fulltext, (p1, p2), link) tuples, in
+        topological order
+    :param window: Number of entries to look ahead
+    :return: Iterator over (node, fulltext, (p1, p2), link) tuples
+    """
+    entries = iter(entries)
+    pending = []
+    pending_nodes = set()
+    last = None
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < window:
+            try:
+                (fulltext, (p1, p2), link) = entries.next()
+            except StopIteration:
+                exhausted = True
+            else:
+                node = hghash(fulltext, p1, p2)
+                pending.append((node, fulltext, (p1, p2), link))
+                pending_nodes.add(node)
+        if not pending:
+            return
+        # The oldest pending entry has all of its parents emitted already
+        chosen = 0
+        if last is not None:
+            for i, (node, fulltext, (p1, p2), link) in enumerate(pending):
+                if p1 == last and p2 not in pending_nodes:
+                    chosen = i
+                    break
+        entry = pending.pop(chosen)
+        pending_nodes.remove(entry[0])
+        last = entry[0]
+        yield entry
+
+
+def pack_chunk_iter(entries, textbase, reorder_window=0, stats=None):
     """Create a chained series of Mercurial deltas.
 
     The first entry is not packed but rather used as a base for the delta
     for the second.
 
     :param entries: Iterator over (fulltext, (p1, p2), link) tuples.
+    :param reorder_window: If not 0, the number of entries to look ahead
+        for one that has the previous entry as first parent; see
+        order_by_first_parent()
+    :param stats: Optional dictionary in which the total size of the texts
+        ("texts") and of the deltas ("deltas") are accumulated
     :return: iterator over delta chunks
     """
-    for (fulltext, (p1, p2), link) in entries:
+    if reorder_window:
+        nodes_and_entries = order_by_first_parent(entries, reorder_window)
+    else:
+        nodes_and_entries = ((hghash(fulltext, p1, p2), fulltext, (p1, p2),
+            link) for (fulltext, (p1, p2), link) in entries)
+    for (node, fulltext, (p1, p2), link) in nodes_and_entries:
         assert len(p1) == 20
         assert len(p2) == 20
-        node = hghash(fulltext, p1, p2)
         assert len(node) == 20
         assert len(link) == 20
-        delta = mercurial.mdiff.bdiff.bdiff(textbase, fulltext)
+        # A single hunk replacing the whole base text
+        fulldelta = struct.pack(">lll", 0, len(textbase), len(fulltext)) + fulltext
+        if textbase:
+            delta = mercurial.mdiff.bdiff.bdiff(textbase, fulltext)
+            if len(delta) > len(fulldelta):
+                delta = fulldelta
+        else:
+            delta = fulldelta
+        if stats is not None:
+            stats["texts"] = stats.get("texts", 0) + len(fulltext)
+            stats["deltas"] = stats.get("deltas", 0) + len(delta)
         chunk = struct.pack("20s20s20s20s", node, p1, p2, link) + delta
         yield chunk
         textbase = fulltext
 
 
-def unpack_chunk_iter(chunk_iter, lookup_base):
+def unpack_chunk_iter(chunk_iter, lookup_base, fulltext_cache=None):
     """Unpack a series of Mercurial deltas.
 
+    Every delta but the first is against the previous text in the series,
+    so only the most recent fulltext is kept around as a delta base.
+
     :param chunk_iter: Iterator over chunks to unpack
     :param lookup_base: Function to look up contents of bases for deltas.
+    :param fulltext_cache: Optional size-bounded cache (e.g. a
+        breezy.lru_cache.LRUSizeCache) that is consulted before lookup_base
+        and that reconstructed fulltexts are added to.
     :return: Iterator over (fulltext, node, (p1, p2), link) tuples.
     """
-    fulltext_cache = {}
-    base = None
+    prev_node = None
+    prev_fulltext = None
     for chunk in chunk_iter:
         node, p1, p2, link = struct.unpack("20s20s20s20s", chunk[:80])
-        if base is None:
-            base = p1
         delta = buffer(chunk, 80)
         del chunk
-        if base == mercurial.node.nullid:
+        if prev_node is not None:
+            textbase = prev_fulltext
+        elif p1 == mercurial.node.nullid:
             textbase = ""
         else:
-            try:
-                textbase = fulltext_cache[base]
-            except KeyError:
-                textbase = lookup_base(base)
+            textbase = None
+            if fulltext_cache is not None:
+                textbase = fulltext_cache.get(p1)
+            if textbase is None:
+                textbase = lookup_base(p1)
         fulltext = mercurial.mdiff.patch(textbase, delta)
+        del textbase, prev_fulltext
         yield fulltext, node, (p1, p2), link
-        fulltext_cache[node] = fulltext
-        base = node
+        if fulltext_cache is not None:
+            fulltext_cache[node] = fulltext
+        prev_node = node
+        prev_fulltext = fulltext
 
 
 def parse_manifest(fulltext):
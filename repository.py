@@ -17,9 +17,15 @@
 
 """Mercurial Repository handling."""
 
+from array import array
+import bisect
+import sys
+
 from breezy import (
     errors,
     graph as _mod_graph,
+    lru_cache,
+    trace,
     )
 from breezy.foreign import (
     ForeignRepository,
@@ -29,6 +35,13 @@ from breezy.revision import (
     NULL_REVISION,
     )
 
+from mercurial.node import (
+    bin,
+    hex,
+    nullid,
+    nullrev,
+    )
+
 from breezy.plugins.hg.commit import (
     HgCommitBuilder,
     )
@@ -42,6 +55,83 @@ from breezy.plugins.hg.tree import (
     )
 
 
+# Number of (path, file node) introductions to cache per repository
+FILE_INTRODUCTION_CACHE_SIZE = 100000
+
+# Total number of manifest entries to keep in the manifest cache
+MANIFEST_CACHE_SIZE = 1000000
+
+# Number of text metadata entries to collect before writing them to the
+# idmap
+TEXT_METADATA_FLUSH_SIZE = 1000
+
+# Name of the file in .hg/cache that stores the last left-hand history
+# that was computed
+LEFT_HAND_HISTORY_CACHE = "bzr-lefthand-history"
+
+# Name of the file in .hg/cache that stores the revnos of recently used
+# changesets
+REVNO_CACHE = "bzr-revnos"
+
+# Number of revnos to store
+REVNO_CACHE_SIZE = 100
+
+# Name of the file in .hg/cache that stores the files touched by each
+# changeset
+FILE_CHANGES_CACHE = "bzr-file-changes"
+
+
+class HgLeftHandHistory(object):
+    """Left-hand history of a Mercurial changeset, oldest revision first.
+
+    This behaves like the list of revision ids returned by
+    Branch._gen_revision_history(), so history[revno - 1] is the revision
+    id for revno. It is backed by an array of changelog revision numbers;
+    revision ids are only generated for the entries that are accessed.
+    """
+
+    def __init__(self, repository, revs):
+        self._repository = repository
+        self._revs = revs
+        self._positions = None
+
+    def __len__(self):
+        return len(self._revs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._repository._revid_for_rev(rev)
+                    for rev in self._revs[index]]
+        return self._repository._revid_for_rev(self._revs[index])
+
+    def __iter__(self):
+        for rev in self._revs:
+            yield self._repository._revid_for_rev(rev)
+
+    def __contains__(self, revid):
+        try:
+            self.index(revid)
+        except ValueError:
+            return False
+        return True
+
+    def index(self, revid):
+        """Return the position of a revision id in the history.
+
+        :raises ValueError: if revid is not part of the history
+        """
+        rev = self._repository._revs_for_revids([revid]).get(revid)
+        if rev is None or rev == nullrev:
+            raise ValueError(revid)
+        if self._positions is None:
+            self._positions = dict(
+                (rev, i) for (i, rev) in enumerate(self._revs))
+        try:
+            return self._positions[rev]
+        except KeyError:
+            raise ValueError(revid)
+
+
 class MercurialSmartRemoteNotSupported(errors.BzrError):
     _fmt = "This operation is not supported by the Mercurial smart server protocol."
 
@@ -105,6 +195,54 @@ class HgRepository(ForeignRepository):
         self._hgrepo = hgrepo
         self.base = hgdir.root_transport.base
         self._fallback_repositories = []
+        self._file_introductions = lru_cache.LRUCache(
+            FILE_INTRODUCTION_CACHE_SIZE)
+        self._file_changes = {}
+        self._file_changes_count = None
+        self._manifest_cache = lru_cache.LRUSizeCache(
+            max_size=MANIFEST_CACHE_SIZE, compute_size=len)
+        self._manifest_cache_hits = 0
+        self._manifest_cache_misses = 0
+
+    def _get_cache_vfs(self):
+        """Return the vfs to access .hg/cache with and the prefix of paths.
+
+        Mercurial before 4.4 has no cachevfs; the cache directory is
+        accessed through the repository vfs instead.
+
+        :return: Tuple with vfs and path prefix
+        """
+        cachevfs = getattr(self._hgrepo, "cachevfs", None)
+        if cachevfs is not None:
+            return (cachevfs, "")
+        return (self._hgrepo.vfs, "cache/")
+
+    def _get_manifest(self, manifest_id):
+        """Read a manifest, using the manifest cache.
+
+        The returned manifest is shared, so callers should not modify it.
+
+        :param manifest_id: Manifest node
+        :return: manifestdict
+        """
+        try:
+            manifest = self._manifest_cache[manifest_id]
+        except KeyError:
+            self._manifest_cache_misses += 1
+        else:
+            self._manifest_cache_hits += 1
+            return manifest
+        manifest = self._hgrepo.manifestlog[manifest_id].read()
+        self._manifest_cache[manifest_id] = manifest
+        return manifest
+
+    def _get_changeset_manifest(self, changeset_id):
+        """Read the manifest of a changeset, using the manifest cache.
+
+        :param changeset_id: Changeset node
+        :return: manifestdict
+        """
+        return self._get_manifest(self._hgrepo.changelog.read(changeset_id)[0])
 
     def add_fallback_repository(self, basis_url):
         raise errors.UnstackableRepositoryFormat(self._format, self.base)
@@ -151,6 +289,259 @@ class HgRepository(ForeignRepository):
 class HgLocalRepository(HgRepository):
     """Local Mercurial repository."""
 
+    _idmap = None
+
+    def __init__(self, hgrepo, hgdir, lockfiles):
+        HgRepository.__init__(self, hgrepo, hgdir, lockfiles)
+        self._pending_text_metadata = {}
+        # Revnos by changelog revision number, read from .hg/cache
+        self._revnos = None
+        # Revision ids in the default mapping, by changelog revision number
+        self._rev_revids = {}
+
+    def _revid_for_rev(self, rev):
+        """Return the revision id for a changelog revision number."""
+        try:
+            return self._rev_revids[rev]
+        except KeyError:
+            revid = self.lookup_foreign_revision_id(
+                self._hgrepo.changelog.node(rev))
+            self._rev_revids[rev] = revid
+            return revid
+
+    def _revs_for_revids(self, revids):
+        """Find the changelog revision numbers for a set of revision ids.
+
+        :param revids: Iterable over revision ids
+        :return: Dictionary mapping revision ids to revision numbers.
+            Revision ids that are not present are omitted.
+        """
+        nodemap = self._hgrepo.changelog.nodemap
+        ret = {}
+        for revid in revids:
+            if revid == NULL_REVISION:
+                ret[revid] = nullrev
+                continue
+            try:
+                hgid = mapping_registry.revision_id_bzr_to_foreign(revid)[0]
+            except errors.InvalidRevisionId:
+                continue
+            rev = nodemap.get(hgid)
+            if rev is not None:
+                ret[revid] = rev
+        return ret
+
+    def _get_idmap(self):
+        """Open the idmap used to cache data derived from Mercurial nodes.
+
+        The idmap lives in the "bzr" directory of the Mercurial cache
+        directory (.hg/cache), so it goes away with the repository.
+        """
+        if self._idmap is None:
+            from breezy.transport import (
+                get_transport,
+                )
+            from breezy.plugins.hg.idmap import (
+                BzrHgCacheFormat,
+                )
+            (cachevfs, prefix) = self._get_cache_vfs()
+            cachevfs.makedirs(prefix + "bzr")
+            self._idmap = BzrHgCacheFormat.from_transport(
+                get_transport(cachevfs.join(prefix + "bzr")))
+        return self._idmap
+
+    def _get_text_metadata(self, path, node):
+        """Look up the SHA1 and size of a file revision, if cached.
+
+        :param path: UTF8 path of the file
+        :param node: File node
+        :return: Tuple with SHA1 and size of the text without copy metadata
+        :raises KeyError: if the metadata has not been cached
+        """
+        try:
+            return self._pending_text_metadata[(path, node)]
+        except KeyError:
+            return self._get_idmap().lookup_text_metadata(path, node)
+
+    def _add_text_metadata(self, path, node, sha1, size):
+        """Cache the SHA1 and size of a file revision.
+
+        While the repository is locked the metadata is collected and
+        written in batches; otherwise nothing would write it later, so it
+        is written to the idmap directly.
+        """
+        self._pending_text_metadata[(path, node)] = (sha1, size)
+        if (not self.is_locked() or
+            len(self._pending_text_metadata) >= TEXT_METADATA_FLUSH_SIZE):
+            self._flush_text_metadata()
+
+    def _flush_text_metadata(self):
+        """Write the collected text metadata to the idmap.
+
+        The collected metadata is dropped even if writing it fails, so a
+        broken cache doesn't fail every later flush.
+        """
+        if not self._pending_text_metadata:
+            return
+        pending = self._pending_text_metadata
+        self._pending_text_metadata = {}
+        idmap = self._get_idmap()
+        with idmap.batch():
+            for ((path, node), (sha1, size)) in pending.iteritems():
+                idmap.insert_text_metadata(path, node, sha1, size)
+
+    def unlock(self):
+        try:
+            self._flush_text_metadata()
+        finally:
+            HgRepository.unlock(self)
+
+    def _read_revnos(self):
+        """Read the revnos stored in .hg/cache.
+
+        Every line has the hex id of a changeset and its revno. Changesets
+        that are no longer in the changelog are skipped.
+
+        :return: Dictionary mapping changelog revision numbers to revnos
+        """
+        revnos = {}
+        (cachevfs, prefix) = self._get_cache_vfs()
+        try:
+            data = cachevfs.read(prefix + REVNO_CACHE)
+        except (IOError, OSError):
+            return revnos
+        changelog = self._hgrepo.changelog
+        for line in data.splitlines():
+            try:
+                (node, revno) = line.split(" ")
+                revnos[changelog.rev(bin(node))] = int(revno)
+            except (ValueError, TypeError, LookupError):
+                continue
+        return revnos
+
+    def _write_revnos(self):
+        # Keep the most recent changesets, they are the likely branch tips
+        revs = sorted(self._revnos)[-REVNO_CACHE_SIZE:]
+        self._revnos = dict((rev, self._revnos[rev]) for rev in revs)
+        changelog = self._hgrepo.changelog
+        (cachevfs, prefix) = self._get_cache_vfs()
+        try:
+            f = cachevfs(prefix + REVNO_CACHE, 'wb', atomictemp=True)
+            try:
+                for rev in revs:
+                    f.write("%s %d\n" % (hex(changelog.node(rev)),
+                        self._revnos[rev]))
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            trace.mutter("unable to write revno cache: %s", e)
+
+    def _get_revno(self, hgid):
+        """Determine the length of the left-hand history of a changeset.
+
+        The revnos of recently used changesets are stored in .hg/cache, so
+        only the first parents up to the nearest of those are walked.
+
+        :param hgid: Changeset id
+        :return: Revision number
+        """
+        if hgid == nullid:
+            return 0
+        if self._revnos is None:
+            self._revnos = self._read_revnos()
+        changelog = self._hgrepo.changelog
+        start = rev = changelog.rev(hgid)
+        walked = 0
+        while rev != nullrev and rev not in self._revnos:
+            walked += 1
+            rev = changelog.parentrevs(rev)[0]
+        if rev == nullrev:
+            revno = walked
+        else:
+            revno = self._revnos[rev] + walked
+        if walked:
+            self._revnos[start] = revno
+            self._write_revnos()
+        return revno
+
+    def _read_left_hand_history(self):
+        """Read the left-hand history stored in .hg/cache.
+
+        :return: Array of changelog revision numbers, oldest first. Empty
+            if there is no cache or it does not match the changelog.
+        """
+        try:
+            (cachevfs, prefix) = self._get_cache_vfs()
+            data = cachevfs.read(prefix + LEFT_HAND_HISTORY_CACHE)
+        except (IOError, OSError):
+            return array('i')
+        if len(data) < 20 or (len(data) - 20) % 4 != 0:
+            return array('i')
+        revs = array('i')
+        revs.fromstring(data[20:])
+        if sys.byteorder == "little":
+            revs.byteswap()
+        changelog = self._hgrepo.changelog
+        if (not revs or revs[-1] >= len(changelog) or
+                changelog.node(revs[-1]) != data[:20]):
+            return array('i')
+        return revs
+
+    def _write_left_hand_history(self, revs):
+        data = array('i', revs)
+        if sys.byteorder == "little":
+            data.byteswap()
+        (cachevfs, prefix) = self._get_cache_vfs()
+        try:
+            f = cachevfs(prefix + LEFT_HAND_HISTORY_CACHE, 'wb',
+                atomictemp=True)
+            try:
+                f.write(self._hgrepo.changelog.node(revs[-1]))
+                f.write(data.tostring())
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            trace.mutter("unable to write left-hand history cache: %s", e)
+
+    def _get_left_hand_history(self, hgid):
+        """Find the left-hand history of a changeset.
+
+        The history is found by following the first parent in the
+        changelog. The walk stops as soon as it reaches a revision in the
+        history stored in .hg/cache, so only the revisions since the fork
+        point are walked. The stored history is only replaced when the
+        new history extends it.
+
+        :param hgid: Changeset id
+        :return: HgLeftHandHistory
+        """
+        if hgid == nullid:
+            return HgLeftHandHistory(self, array('i'))
+        changelog = self._hgrepo.changelog
+        cached = self._read_left_hand_history()
+        # Position of the fork point in cached
+        i = -1
+        new = array('i')
+        rev = changelog.rev(hgid)
+        while rev != nullrev:
+            if cached and rev <= cached[-1]:
+                i = bisect.bisect_left(cached, rev)
+                if i < len(cached) and cached[i] == rev:
+                    break
+                i = -1
+            new.append(rev)
+            rev = changelog.parentrevs(rev)[0]
+        if i == len(cached) - 1:
+            if not new:
+                return HgLeftHandHistory(self, cached)
+            new.reverse()
+            revs = cached + new
+            self._write_left_hand_history(revs)
+        else:
+            new.reverse()
+            revs = cached[:i+1] + new
+        return HgLeftHandHistory(self, revs)
+
     def get_revisions(self, revids):
         return [self.get_revision(r) for r in revids]
 
@@ -168,35 +559,39 @@ class HgLocalRepository(HgRepository):
         except errors.InvalidRevisionId:
             raise errors.NoSuchRevision(self, revision_id)
 
+    def _get_parents_for_rev(self, rev):
+        """Return the parent revision ids for a changelog revision number."""
+        (p1, p2) = self._hgrepo.changelog.parentrevs(rev)
+        if p1 == nullrev:
+            if p2 == nullrev:
+                return (NULL_REVISION, )
+            else:
+                return (NULL_REVISION, self._revid_for_rev(p2))
+        elif p2 == nullrev:
+            return (self._revid_for_rev(p1), )
+        else:
+            return (self._revid_for_rev(p1), self._revid_for_rev(p2))
+
     def get_parent_map(self, revids):
         ret = {}
-        for revid in revids:
-            if revid == NULL_REVISION:
+        # FIXME: what about extra (roundtripped) parents?
+        for revid, rev in self._revs_for_revids(revids).iteritems():
+            if rev == nullrev:
                 ret[revid] = ()
-                continue
-            hgrevid, mapping = self.lookup_bzr_revision_id(revid)
-            # FIXME: what about extra (roundtripped) parents?
-            hgparents = self._hgrepo.changelog.parents(hgrevid)
-            bzrparents = as_bzr_parents(hgparents, self.lookup_foreign_revision_id)
-            if bzrparents == ():
-                ret[revid] = (NULL_REVISION, )
             else:
-                ret[revid] = bzrparents
+                ret[revid] = self._get_parents_for_rev(rev)
         return ret
 
     def get_known_graph_ancestry(self, keys):
         """Get a KnownGraph instance with the ancestry of keys."""
-        # most basic implementation is a loop around get_parent_map
-        pending = set(keys)
+        revs = self._revs_for_revids(keys).values()
         parent_map = {}
-        while pending:
-            this_parent_map = self.get_parent_map(pending)
-            parent_map.update(this_parent_map)
-            pending = set()
-            map(pending.update, this_parent_map.itervalues())
-            pending = pending.difference(parent_map)
-        kg = _mod_graph.KnownGraph(parent_map)
-        return kg
+        if revs:
+            parent_map[NULL_REVISION] = ()
+        for rev in self._hgrepo.changelog.ancestors(
+                [rev for rev in revs if rev != nullrev], inclusive=True):
+            parent_map[self._revid_for_rev(rev)] = self._get_parents_for_rev(rev)
+        return _mod_graph.KnownGraph(parent_map)
 
     def get_revision(self, revision_id):
         if not type(revision_id) is str:
@@ -210,25 +605,168 @@ class HgLocalRepository(HgRepository):
             hgchange[0], hgchange[1].decode("utf-8"), hgchange[2],
             hgchange[4].decode("utf-8"), hgchange[5])[0]
 
+    def _get_file_introduction(self, path, node):
+        """Find the changeset that introduced a file revision.
+
+        This is the changeset the filelog links the file revision to.
+
+        :param path: UTF8 path of the file
+        :param node: File node
+        :return: Tuple with changeset id and the flags of the file in
+            that changeset
+        """
+        key = (path, node)
+        try:
+            return self._file_introductions[key]
+        except KeyError:
+            pass
+        filelog = self._hgrepo.file(path)
+        changeset_id = self._hgrepo.changelog.node(
+            filelog.linkrev(filelog.rev(node)))
+        manifest_id = self._hgrepo.changelog.read(changeset_id)[0]
+        # The linked changeset is the first one with this file revision,
+        # so the file is always part of its manifest delta.
+        delta = self._hgrepo.manifestlog[manifest_id].readdelta()
+        if path in delta:
+            flags = delta.flags(path)
+        else:
+            flags = self._get_manifest(manifest_id).flags(path)
+        self._file_introductions[key] = (changeset_id, flags)
+        return (changeset_id, flags)
+
+    def _read_file_changes(self):
+        """Read the index of touched files stored in .hg/cache.
+
+        Every line has the hex id of a changeset followed by a tab and the
+        NUL-separated files it touches, in changelog order.
+
+        :return: Number of changelog revisions read from the cache. Zero
+            if there is no cache or it does not match the changelog.
+        """
+        try:
+            (cachevfs, prefix) = self._get_cache_vfs()
+            data = cachevfs.read(prefix + FILE_CHANGES_CACHE)
+        except (IOError, OSError):
+            return 0
+        lines = data.split("\n")
+        # An incomplete last line means a write was interrupted
+        if lines.pop() != "" or not lines:
+            return 0
+        changelog = self._hgrepo.changelog
+        if (len(lines) > len(changelog) or
+                lines[-1][:40] != hex(changelog.node(len(lines) - 1))):
+            return 0
+        for (rev, line) in enumerate(lines):
+            files = line[41:]
+            if files:
+                for f in files.split("\0"):
+                    self._file_changes.setdefault(f, array("l")).append(rev)
+        return len(lines)
+
+    def _write_file_changes(self, lines, append):
+        (cachevfs, prefix) = self._get_cache_vfs()
+        try:
+            if append:
+                f = cachevfs(prefix + FILE_CHANGES_CACHE, 'ab')
+            else:
+                f = cachevfs(prefix + FILE_CHANGES_CACHE, 'wb',
+                    atomictemp=True)
+            try:
+                f.write("".join(lines))
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            trace.mutter("unable to write file changes cache: %s", e)
+
+    def _get_file_changes(self, path):
+        """Return the changelog revisions that touch a path.
+
+        The index of touched files is stored in .hg/cache. Only the
+        changesets that were added since it was last written are read
+        from the changelog, and then appended to it.
+
+        :param path: UTF8 path of the file
+        :return: Sorted sequence of revision numbers
+        """
+        changelog = self._hgrepo.changelog
+        if self._file_changes_count is None:
+            self._file_changes_count = self._read_file_changes()
+            append = (self._file_changes_count > 0)
+        else:
+            append = True
+        if self._file_changes_count < len(changelog):
+            lines = []
+            for rev in xrange(self._file_changes_count, len(changelog)):
+                node = changelog.node(rev)
+                files = changelog.readfiles(node)
+                for f in files:
+                    self._file_changes.setdefault(f, array("l")).append(rev)
+                lines.append("%s\t%s\n" % (hex(node), "\0".join(files)))
+            self._file_changes_count = len(changelog)
+            self._write_file_changes(lines, append)
+        return self._file_changes.get(path, ())
+
+    def _get_file_entry(self, rev, path):
+        """Return the file node and flags of a path in a changeset."""
+        manifest = self._get_changeset_manifest(self._hgrepo.changelog.node(rev))
+        return (manifest.get(path), manifest.flags(path))
+
+    def _is_file_modified_in(self, path, rev):
+        """Check whether a changeset that touches a path changes it.
+
+        A merge also touches the files it takes unchanged from its second
+        parent, so for merges the file is compared with both parents.
+
+        :param path: UTF8 path of the file
+        :param rev: Changelog revision number of a changeset touching path
+        :return: True if the file differs from the file in all parents
+        """
+        (p1, p2) = self._hgrepo.changelog.parentrevs(rev)
+        if p2 == nullrev:
+            return True
+        entry = self._get_file_entry(rev, path)
+        return (entry != self._get_file_entry(p1, path) and
+                entry != self._get_file_entry(p2, path))
+
+    def _is_file_changed_since(self, path, since, hgid):
+        """Check whether a path was changed after a changeset.
+
+        This also covers flag-only changes and removals, which don't
+        create a new file revision. Merges that only take the file from
+        one of their parents don't count as a change.
+
+        :param path: UTF8 path of the file
+        :param since: Changeset id to start after
+        :param hgid: Changeset id whose ancestry to check
+        :return: True if a changeset in the ancestry of hgid (inclusive)
+            that was added after since changes path
+        """
+        changelog = self._hgrepo.changelog
+        revs = self._get_file_changes(path)
+        last_rev = changelog.rev(hgid)
+        for i in xrange(bisect.bisect_right(revs, changelog.rev(since)),
+                        len(revs)):
+            if revs[i] > last_rev:
+                break
+            if (changelog.isancestor(changelog.node(revs[i]), hgid) and
+                    self._is_file_modified_in(path, revs[i])):
+                return True
+        return False
+
     def revision_trees(self, revids):
         for revid in revids:
             yield self.revision_tree(revid)
 
     def revision_tree(self, revision_id):
         hgid, mapping = self.lookup_bzr_revision_id(revision_id)
-        log = self._hgrepo.changelog.read(hgid)
-        manifest = self._hgrepo.manifestlog[log[0]].read()
+        manifest = self._get_changeset_manifest(hgid)
         return HgRevisionTree(self, revision_id, hgid, manifest, mapping)
 
     def has_foreign_revision(self, foreign_revid):
         return foreign_revid in self._hgrepo.changelog.nodemap
 
     def has_revisions(self, revids):
-        ret = set()
-        for revid in revids:
-            if self.has_revision(revid):
-                ret.add(revid)
-        return ret
+        return set(self._revs_for_revids(revids))
 
     def has_revision(self, revision_id):
         if revision_id == NULL_REVISION:
@@ -243,9 +781,8 @@ class HgLocalRepository(HgRepository):
         return HgCommitBuilder(self, parents, config, *args, **kwargs)
 
     def all_revision_ids(self):
-        return set([self.lookup_foreign_revision_id(
-            self._hgrepo.changelog.node(hgid))
-            for hgid in self._hgrepo.changelog])
+        return set([self._revid_for_rev(rev)
+            for rev in self._hgrepo.changelog])
 
 
 class HgRemoteRepository(HgRepository):
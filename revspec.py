@@ -19,7 +19,6 @@
 
 from breezy import version_info as breezy_version
 from breezy.errors import (
-    InvalidRevisionId,
     InvalidRevisionSpec,
     )
 from breezy.revision import (
@@ -70,28 +69,61 @@ class RevisionSpec_hg(RevisionSpec):
             return RevisionInfo(branch, None, bzr_revid)
         raise InvalidRevisionSpec(self.user_spec, branch)
 
-    def _find_short_csid(self, branch, csid):
-        import mercurial.node
-        from breezy.plugins.hg.mapping import (
-            mapping_registry,
+    def _lookup_short_csid(self, branch, csid):
+        """Look up a changeset id prefix without walking the history.
+
+        Local Mercurial repositories are searched using the changelog
+        index, other repositories using the idmap. Only revisions in the
+        ancestry of the branch match.
+
+        :return: Revision id
+        :raises InvalidRevisionSpec: if the prefix is not known or is
+            ambiguous
+        """
+        repository = branch.repository
+        mapping = getattr(branch, "mapping", None)
+        last_revision = branch.last_revision()
+        if last_revision == NULL_REVISION:
+            raise InvalidRevisionSpec(self.user_spec, branch)
+        hgrepo = getattr(repository, "_hgrepo", None)
+        if getattr(hgrepo, "changelog", None) is not None:
+            tip = repository.lookup_bzr_revision_id(last_revision)[0]
+            # A hex string is never taken for a revision number or a
+            # tag by the id() predicate.
+            try:
+                revs = list(hgrepo.revs("id(%s) and ::%n", csid, tip))
+            except LookupError:
+                raise InvalidRevisionSpec(self.user_spec, branch,
+                    extra="ambiguous changeset id prefix")
+            if not revs:
+                raise InvalidRevisionSpec(self.user_spec, branch)
+            return repository.lookup_foreign_revision_id(
+                hgrepo.changelog.node(revs[0]), mapping=mapping)
+        from breezy.plugins.hg.overlay import (
+            get_overlay,
             )
-        parse_revid = getattr(branch.repository, "lookup_bzr_revision_id",
-                              mapping_registry.parse_revision_id)
+        overlay = get_overlay(repository, mapping, create=False)
+        graph = repository.get_graph()
+        found = [revid for revid in
+            overlay.idmap.lookup_revisions_by_changeset_id_prefix(csid).itervalues()
+            if graph.is_ancestor(revid, last_revision)]
+        if len(found) > 1:
+            raise InvalidRevisionSpec(self.user_spec, branch,
+                extra="ambiguous changeset id prefix")
+        if not found:
+            raise InvalidRevisionSpec(self.user_spec, branch)
+        return found[0]
+
+    def _find_short_csid(self, branch, csid):
+        csid = csid.lower()
         branch.repository.lock_read()
         try:
-            graph = branch.repository.get_graph()
-            for revid, _ in graph.iter_ancestry([branch.last_revision()]):
-                try:
-                    foreign_revid, mapping = parse_revid(revid)
-                except InvalidRevisionId:
-                    continue
-                if mercurial.node.hex(foreign_revid).startswith(csid):
-                    if breezy_version < (2, 5):
-                        history = branch.revision_history()
-                        return RevisionInfo.from_revision_id(branch, revid, history)
-                    else:
-                        return RevisionInfo.from_revision_id(branch, revid)
-            raise InvalidRevisionSpec(self.user_spec, branch)
+            revid = self._lookup_short_csid(branch, csid)
+            if breezy_version < (2, 5):
+                history = branch.revision_history()
+                return RevisionInfo.from_revision_id(branch, revid, history)
+            else:
+                return RevisionInfo.from_revision_id(branch, revid)
         finally:
             branch.repository.unlock()
 
@@ -28,6 +28,7 @@ def test_suite():
         'test_fetch',
         'test_idmap',
         'test_mapping',
+        'test_overlay',
         'test_parsers',
         'test_pull',
         'test_push',
@@ -16,6 +16,9 @@
 
 """Tests for Mercurial branches."""
 
+from breezy import (
+    errors,
+    )
 from breezy.tests import (
     TestCase,
     TestCaseWithTransport,
@@ -70,3 +73,23 @@ class TestFileHgTags(TestCaseWithTransport):
         tags = FileHgTags(tree.branch, tree.branch.last_revision(), tree.branch)
         self.assertEquals({"tag with a space": "hg-v1:4ad63131870d4fbf2a88d7403705310b2d0b9b76"},
             tags.get_tag_dict())
+
+
+class HgLocalBranchTests(TestCaseWithTransport):
+
+    def test_revision_history(self):
+        tree = self.make_branch_and_tree(".", format=HgControlDirFormat())
+        revid1 = tree.commit("foo")
+        revid2 = tree.commit("bar")
+        branch = tree.controldir.open_branch()
+        with branch.lock_read():
+            self.assertEquals(2, branch.revision_id_to_revno(revid2))
+            self.assertEquals(revid1, branch.get_rev_id(1))
+            self.assertEquals((1, ), branch.revision_id_to_dotted_revno(revid1))
+            self.assertRaises(errors.NoSuchRevision,
+                branch.revision_id_to_revno, "hg-v1:" + "a" * 40)
+        revid3 = tree.commit("blie")
+        branch = tree.controldir.open_branch()
+        self.assertEquals([revid1, revid2, revid3],
+            list(branch._gen_revision_history()))
+        self.assertEquals(3, branch.revision_id_to_revno(revid3))
@@ -16,10 +16,16 @@
 
 """Tests for fetching from Mercurial into Bazaar."""
 
+import multiprocessing
 import os
 
+from breezy import (
+    config,
+    osutils,
+    )
 from breezy.branch import Branch
 
+from breezy.plugins.hg import fetch as _mod_fetch
 from breezy.plugins.hg.dir import HgControlDirFormat
 from breezy.plugins.hg.ui import ui as hgui
 
@@ -59,6 +65,109 @@ class TestFetching(TestCaseWithTransport):
         # Self-assurance check that history was really imported.
         self.assertPathExists("bzr/f1")
 
+    def make_hg_repo_for_workers(self):
+        self.build_tree_contents([
+            ("hg/",),
+            ("hg/f1", "f1 contents"),
+            ("hg/d1/",),
+            ("hg/d1/f2", "f2 contents"),
+        ])
+        hgrepo = mercurial.localrepo.localrepository(hgui(), "hg", create=True)
+        hgrepo[None].add(["f1", "d1/f2"])
+        hgrepo.commit("Initial commit")
+        self.build_tree_contents([("hg/d1/f2", "changed f2 contents")])
+        hgrepo.commit("Change f2")
+        return HgControlDirFormat().open(self.get_transport("hg"))
+
+    def test_fetch_with_text_workers(self):
+        config.GlobalStack().set('hg.fetch_workers', 2)
+        calls = []
+        orig_imap_bounded = _mod_fetch.imap_bounded
+        def counting_imap_bounded(pool, func, iterable, window):
+            calls.append(func)
+            return orig_imap_bounded(pool, func, iterable, window)
+        self.overrideAttr(_mod_fetch, "imap_bounded", counting_imap_bounded)
+        hgdir = self.make_hg_repo_for_workers()
+
+        bzrtree = self.make_branch_and_tree("bzr")
+        bzrtree.pull(hgdir.open_branch())
+
+        self.assertEquals([_mod_fetch.unpack_text_chain], calls)
+        self.assertFileEqual("f1 contents", "bzr/f1")
+        self.assertFileEqual("changed f2 contents", "bzr/d1/f2")
+
+    def test_fetch_with_text_workers_error(self):
+        config.GlobalStack().set('hg.fetch_workers', 2)
+        class BrokenPool(object):
+            def __init__(self, processes):
+                pass
+            def terminate(self):
+                raise RuntimeError("terminate failed")
+            def join(self):
+                pass
+        def failing_imap_bounded(pool, func, iterable, window):
+            raise ValueError("unpack failed")
+        self.overrideAttr(multiprocessing, "Pool", BrokenPool)
+        self.overrideAttr(_mod_fetch, "imap_bounded", failing_imap_bounded)
+        hgdir = self.make_hg_repo_for_workers()
+
+        bzrtree = self.make_branch_and_tree("bzr")
+        self.assertRaises(ValueError, bzrtree.pull, hgdir.open_branch())
+
+    def test_fetch_in_batches(self):
+        config.GlobalStack().set('hg.fetch_batch_size', 1)
+        ui = hgui()
+        ui.setconfig("ui", "merge", "internal:merge")
+        hgrepo = mercurial.localrepo.localrepository(ui, "hg", create=True)
+        # A--B--D
+        # |     |
+        # \--C--/
+        self.build_tree_contents([("hg/f1", "f1")])
+        hgrepo[None].add(["f1"])
+        hgrepo.commit("A")
+        self.build_tree_contents([("hg/f2", "f2")])
+        hgrepo[None].add(["f2"])
+        hgrepo.commit("B")
+        hg.update(hgrepo, 0)
+        self.build_tree_contents([("hg/f3", "f3")])
+        hgrepo[None].add(["f3"])
+        hgrepo.commit("C")
+        hg.update(hgrepo, 1)
+        hg.merge(hgrepo, 2)
+        hgrepo.commit("D")
+
+        bzrtree = self.make_branch_and_tree("bzr")
+        hgbranch = Branch.open("hg")
+        bzrtree.pull(hgbranch)
+
+        self.assertEquals(hgbranch.last_revision(),
+            bzrtree.branch.last_revision())
+        self.assertEquals(4, len(bzrtree.branch.repository.all_revision_ids()))
+        for i in range(1, 4):
+            self.assertFileEqual("f%d" % i, "bzr/f%d" % i)
+
+    def test_reuse_source_text_metadata(self):
+        hgrepo = mercurial.localrepo.localrepository(hgui(), "hg", create=True)
+        self.build_tree_contents([("hg/f1", "f1 contents")])
+        hgrepo[None].add(["f1"])
+        hgrepo.commit("Initial commit")
+        node = hgrepo["tip"]["f1"].filenode()
+
+        self.make_branch_and_tree("bzr1").pull(Branch.open("hg"))
+        hgbranch = Branch.open("hg")
+        self.assertEquals((osutils.sha_string("f1 contents"), 11),
+            hgbranch.repository._get_text_metadata("f1", node))
+
+        # A second fetch takes the SHA1 from the cache rather than adding
+        # it again.
+        added = []
+        hgbranch.repository._add_text_metadata = (
+            lambda *args: added.append(args))
+        self.make_branch_and_tree("bzr2").pull(hgbranch)
+        self.assertEquals([], added)
+        self.assertFileEqual("f1 contents", "bzr2/f1")
+        self.assertPathExists("hg/.hg/cache/bzr/format")
+
     def test_getting_existing_text_metadata(self):
         # Create Mercurial repository and Bazaar branch to import into.
         hgrepo = mercurial.localrepo.localrepository(hgui(), "hg", create=True)
@@ -15,13 +15,25 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-from breezy.tests import TestCase
+import os
+import sqlite3
+
+from breezy.tests import (
+    TestCase,
+    TestCaseInTempDir,
+    TestCaseWithTransport,
+    )
+from breezy.transport import get_transport
 
 from breezy.plugins.hg.idmap import (
     MemoryIdmap,
+    MmapIdmap,
     SqliteIdmap,
     TdbIdmap,
+    UnknownIdmapMapping,
+    from_repository,
     )
+from breezy.plugins.hg.mapping import default_mapping
 
 class IdmapTestCase(object):
 
@@ -38,6 +50,105 @@ class IdmapTestCase(object):
         self.assertEquals(set(["jelmer@voo", "jelmer@bar"]), 
             self.idmap.revids())
 
+    def test_lookup_changeset_id_by_revid(self):
+        self.idmap.insert_revision("jelmer@voo", "a" * 20, "b"*20,
+            default_mapping)
+        (csid, mapping) = self.idmap.lookup_changeset_id_by_revid("jelmer@voo")
+        self.assertEquals("b" * 20, csid)
+        self.assertEquals("hg-v1", str(mapping))
+        self.assertRaises(KeyError, self.idmap.lookup_changeset_id_by_revid,
+            "jelmer@bar")
+
+    def test_lookup_revision_by_changeset_id(self):
+        self.idmap.insert_revision("jelmer@voo", "a" * 20, "b"*20, "c" * 20)
+        self.assertEquals("jelmer@voo",
+            self.idmap.lookup_revision_by_changeset_id("b" * 20))
+        self.assertRaises(KeyError,
+            self.idmap.lookup_revision_by_changeset_id, "a" * 20)
+
+    def test_lookup_revisions_by_changeset_ids(self):
+        self.idmap.insert_revision("jelmer@voo", "a" * 20, "b"*20, "c" * 20)
+        self.assertEquals({"b" * 20: "jelmer@voo"},
+            self.idmap.lookup_revisions_by_changeset_ids(["a" * 20, "b" * 20]))
+
+    def test_lookup_revisions_by_changeset_id_prefix(self):
+        self.idmap.insert_revision("jelmer@voo", "a" * 20, "\xab" * 20, "c")
+        self.idmap.insert_revision("jelmer@bar", "b" * 20,
+            "\xab\xac" + "\x00" * 18, "c")
+        self.idmap.insert_revision("jelmer@blie", "c" * 20, "\xac" * 20, "c")
+        self.assertEquals({"\xab" * 20: "jelmer@voo"},
+            self.idmap.lookup_revisions_by_changeset_id_prefix("abab"))
+        self.assertEquals(
+            {"\xab" * 20: "jelmer@voo",
+             "\xab\xac" + "\x00" * 18: "jelmer@bar"},
+            self.idmap.lookup_revisions_by_changeset_id_prefix("ab"))
+        self.assertEquals(set(["jelmer@voo", "jelmer@bar", "jelmer@blie"]),
+            set(self.idmap.lookup_revisions_by_changeset_id_prefix(
+                "a").values()))
+        self.assertEquals({},
+            self.idmap.lookup_revisions_by_changeset_id_prefix("abad"))
+
+    def test_lookup_revisions_by_manifest_ids(self):
+        self.idmap.insert_revision("jelmer@voo", "a" * 20, "a"*20, "c" * 20)
+        self.idmap.insert_revision("jelmer@bar", "b" * 20, "b"*20, "d" * 20)
+        self.assertEquals({"a" * 20: "jelmer@voo", "b" * 20: "jelmer@bar"},
+            self.idmap.lookup_revisions_by_manifest_ids(
+                ["a" * 20, "b" * 20, "e" * 20]))
+
+    def test_lookup_changeset_ids_by_revids(self):
+        self.idmap.insert_revision("jelmer@voo", "a" * 20, "b"*20,
+            default_mapping)
+        self.assertEquals(["jelmer@voo"],
+            self.idmap.lookup_changeset_ids_by_revids(
+                ["jelmer@voo", "jelmer@bar"]).keys())
+        self.assertEquals("b" * 20,
+            self.idmap.lookup_changeset_ids_by_revids(
+                ["jelmer@voo"])["jelmer@voo"][0])
+
+    def test_lookup_changeset_ids_by_revids_unknown_mapping(self):
+        self.idmap.insert_revision("jelmer@voo", "a" * 20, "b"*20, "c" * 20)
+        self.assertRaises(UnknownIdmapMapping,
+            self.idmap.lookup_changeset_id_by_revid, "jelmer@voo")
+        self.assertRaises(UnknownIdmapMapping,
+            self.idmap.lookup_changeset_ids_by_revids, ["jelmer@voo"])
+
+    def test_lookup_texts_by_path_and_node(self):
+        self.idmap.insert_text("path", "a" * 20, "fileid", "jelmer@voo")
+        self.idmap.insert_text("other", "b" * 20, "otherid", "jelmer@bar")
+        self.assertEquals({("path", "a" * 20): [("fileid", "jelmer@voo")]},
+            dict((k, list(v)) for (k, v) in
+                self.idmap.lookup_texts_by_path_and_node(
+                    [("path", "a" * 20), ("path", "b" * 20)]).iteritems()))
+
+    def test_text_metadata(self):
+        self.assertRaises(KeyError, self.idmap.lookup_text_metadata,
+            "path", "a" * 20)
+        self.idmap.insert_text_metadata("path", "a" * 20, "b" * 40, 42)
+        self.assertEquals(("b" * 40, 42),
+            self.idmap.lookup_text_metadata("path", "a" * 20))
+
+    def test_processed_heads(self):
+        self.assertEquals(set(), self.idmap.get_processed_heads())
+        self.idmap.set_processed_heads(["jelmer@voo", "jelmer@bar"])
+        self.assertEquals(set(["jelmer@voo", "jelmer@bar"]),
+            self.idmap.get_processed_heads())
+        with self.idmap.batch():
+            self.idmap.set_processed_heads(["jelmer@blie"])
+        self.assertEquals(set(["jelmer@blie"]),
+            self.idmap.get_processed_heads())
+
+    def test_batch(self):
+        with self.idmap.batch():
+            self.idmap.insert_revision("jelmer@voo", "a" * 20, "a"*20, "c" * 20)
+            with self.idmap.batch():
+                self.idmap.insert_text("path", "b" * 20, "fileid", "jelmer@voo")
+            self.assertEquals("jelmer@voo",
+                self.idmap.lookup_revision_by_manifest_id("a" * 20))
+        self.assertEquals("jelmer@voo",
+            self.idmap.lookup_revision_by_manifest_id("a" * 20))
+        self.assertEquals([("fileid", "jelmer@voo")],
+            list(self.idmap.lookup_text_by_path_and_node("path", "b" * 20)))
+
 
 class MemoryIdmapTests(TestCase,IdmapTestCase):
 
@@ -52,6 +163,30 @@ class TdbIdmapTests(TestCase,IdmapTestCase):
         TestCase.setUp(self)
         self.idmap = TdbIdmap()
 
+    def test_revids_reinsert(self):
+        self.idmap.insert_revision("jelmer@voo", "a" * 20, "a"*20, "c" * 20)
+        self.idmap.insert_revision("jelmer@voo", "a" * 20, "a"*20, "c" * 20)
+        self.assertEquals("1", self.idmap.db["revids/count"])
+        self.assertEquals(set(["jelmer@voo"]), self.idmap.revids())
+
+    def test_upgrade_from_v1(self):
+        self.idmap.insert_revision("jelmer@voo", "a" * 20, "a"*20, "c" * 20)
+        del self.idmap.db["revids/count"]
+        del self.idmap.db["revids/0"]
+        self.idmap.db["version"] = "1"
+        self.idmap._upgrade_from_v1()
+        self.assertEquals("2", self.idmap.db["version"])
+        self.assertEquals(set(["jelmer@voo"]), self.idmap.revids())
+
+    def test_upgrade_from_v2(self):
+        self.idmap.insert_revision("jelmer@voo", "a" * 20, "b"*20, "c" * 20)
+        del self.idmap.db["csid/" + "b" * 20]
+        self.idmap.db["version"] = "2"
+        self.idmap._upgrade_from_v2()
+        self.assertEquals("3", self.idmap.db["version"])
+        self.assertEquals("jelmer@voo",
+            self.idmap.lookup_revision_by_changeset_id("b" * 20))
+
 
 class SqliteIdmapTests(TestCase,IdmapTestCase):
 
@@ -59,3 +194,215 @@ class SqliteIdmapTests(TestCase,IdmapTestCase):
         TestCase.setUp(self)
         self.idmap = SqliteIdmap()
 
+    def test_lookup_texts_by_path_and_node_chunked(self):
+        from breezy.plugins.hg import idmap as _mod_idmap
+        self.overrideAttr(_mod_idmap, "SQLITE_LOOKUP_CHUNK_SIZE", 4)
+        executed = []
+        class CountingConnection(object):
+            def __init__(self, db):
+                self._db = db
+            def __getattr__(self, name):
+                return getattr(self._db, name)
+            def execute(self, query, params=()):
+                executed.append(len(params))
+                return self._db.execute(query, params)
+        keys = [("path%d" % i, "a" * 20) for i in range(5)]
+        for (path, node) in keys:
+            self.idmap.insert_text(path, node, path + "-id", "jelmer@voo")
+        self.idmap.db = CountingConnection(self.idmap.db)
+        self.assertEquals(5,
+            len(self.idmap.lookup_texts_by_path_and_node(keys)))
+        self.assertEquals([4, 4, 2], executed)
+
+    def test_batch_abort(self):
+        def insert():
+            with self.idmap.batch():
+                self.idmap.insert_revision("jelmer@voo", "a" * 20, "a"*20,
+                    "c" * 20)
+                raise ValueError
+        self.assertRaises(ValueError, insert)
+        self.assertRaises(KeyError, self.idmap.lookup_revision_by_manifest_id,
+            "a" * 20)
+
+
+class SqliteIdmapFileTests(TestCaseInTempDir):
+
+    def setUp(self):
+        TestCaseInTempDir.setUp(self)
+        # Connections are shared by path
+        self.path = os.path.abspath("idmap.db")
+
+    def count_revisions(self):
+        db = sqlite3.connect(self.path)
+        try:
+            return db.execute("select count(*) from revision").fetchone()[0]
+        finally:
+            db.close()
+
+    def test_write_outside_batch(self):
+        idmap = SqliteIdmap(self.path)
+        idmap.insert_revision("jelmer@voo", "a" * 20, "a"*20, "c" * 20)
+        self.assertEquals(1, self.count_revisions())
+
+    def test_abort_keeps_other_writes(self):
+        idmap1 = SqliteIdmap(self.path)
+        idmap2 = SqliteIdmap(self.path)
+        self.assertIs(idmap1.db, idmap2.db)
+        idmap1.start_write_group()
+        idmap1.insert_revision("jelmer@voo", "a" * 20, "a"*20, "c" * 20)
+        self.assertEquals("jelmer@voo",
+            idmap1.lookup_revision_by_manifest_id("a" * 20))
+        idmap2.insert_revision("jelmer@bar", "b" * 20, "b"*20, "c" * 20)
+        idmap1.abort_write_group()
+        self.assertEquals(set(["jelmer@bar"]), idmap1.revids())
+        self.assertEquals(1, self.count_revisions())
+
+
+class MmapIdmapTests(TestCase,IdmapTestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.idmap = MmapIdmap()
+
+    def test_batch_abort(self):
+        def insert():
+            with self.idmap.batch():
+                self.idmap.insert_revision("jelmer@voo", "a" * 20, "a"*20,
+                    "c" * 20)
+                raise ValueError
+        self.assertRaises(ValueError, insert)
+        self.assertRaises(KeyError, self.idmap.lookup_revision_by_manifest_id,
+            "a" * 20)
+
+
+class MmapIdmapFileTests(TestCaseInTempDir):
+
+    def test_reopen(self):
+        idmap = MmapIdmap("idmap.mmap")
+        idmap.insert_revision("jelmer@voo", "a" * 20, "b" * 20, "c" * 20)
+        idmap.insert_text("path", "d" * 20, "fileid", "jelmer@voo")
+        idmap = MmapIdmap("idmap.mmap")
+        self.assertEquals("jelmer@voo",
+            idmap.lookup_revision_by_manifest_id("a" * 20))
+        self.assertEquals([("fileid", "jelmer@voo")],
+            list(idmap.lookup_text_by_path_and_node("path", "d" * 20)))
+
+    def test_compact(self):
+        idmap = MmapIdmap("idmap.mmap")
+        with idmap.batch():
+            for i in range(10):
+                idmap.insert_revision("rev%d" % i, chr(i) * 20,
+                    chr(i + 10) * 20, "c" * 20)
+        idmap.compact()
+        self.assertEquals("", open("idmap.mmap.log").read())
+        idmap.insert_revision("rev10", "a" * 20, "b" * 20, "c" * 20)
+        idmap = MmapIdmap("idmap.mmap")
+        self.assertEquals(set(["rev%d" % i for i in range(11)]),
+            idmap.revids())
+        self.assertEquals("rev5",
+            idmap.lookup_revision_by_manifest_id(chr(5) * 20))
+        self.assertEquals("rev10",
+            idmap.lookup_revision_by_manifest_id("a" * 20))
+        self.assertRaises(KeyError, idmap.lookup_revision_by_manifest_id,
+            "e" * 20)
+
+    def test_compact_keeps_other_appends(self):
+        idmap1 = MmapIdmap("idmap.mmap")
+        idmap2 = MmapIdmap("idmap.mmap")
+        idmap1.insert_revision("rev1", "a" * 20, "b" * 20, "c" * 20)
+        idmap2.insert_revision("rev2", "d" * 20, "e" * 20, "c" * 20)
+        idmap1.compact()
+        idmap = MmapIdmap("idmap.mmap")
+        self.assertEquals(set(["rev1", "rev2"]), idmap.revids())
+
+    def test_incompatible_base(self):
+        idmap = MmapIdmap("idmap.mmap")
+        idmap.insert_revision("rev1", "a" * 20, "b" * 20, "c" * 20)
+        idmap.set_processed_heads(["rev1"])
+        idmap.compact()
+        f = open("idmap.mmap", 'r+b')
+        try:
+            f.write("BHGMMAP0")
+        finally:
+            f.close()
+        idmap = MmapIdmap("idmap.mmap")
+        self.assertEquals(set(), idmap.get_processed_heads())
+        self.assertEquals(set(), idmap.revids())
+        self.assertPathDoesNotExist("idmap.mmap")
+
+    def test_empty_base(self):
+        open("idmap.mmap", 'wb').close()
+        idmap = MmapIdmap("idmap.mmap")
+        self.assertEquals(set(), idmap.revids())
+        idmap.insert_revision("rev1", "a" * 20, "b" * 20, "c" * 20)
+        idmap.compact()
+        idmap = MmapIdmap("idmap.mmap")
+        self.assertEquals(set(["rev1"]), idmap.revids())
+
+    def test_truncated_base(self):
+        idmap = MmapIdmap("idmap.mmap")
+        idmap.insert_revision("rev1", "a" * 20, "b" * 20, "c" * 20)
+        idmap.compact()
+        f = open("idmap.mmap", 'r+b')
+        try:
+            f.truncate(os.path.getsize("idmap.mmap") - 1)
+        finally:
+            f.close()
+        idmap = MmapIdmap("idmap.mmap")
+        self.assertEquals(set(), idmap.revids())
+        self.assertPathDoesNotExist("idmap.mmap")
+
+    def test_compact_on_open(self):
+        idmap = MmapIdmap("idmap.mmap")
+        with idmap.batch():
+            for i in range(5):
+                idmap.insert_revision("rev%d" % i, chr(i) * 20,
+                    chr(i + 10) * 20, "c" * 20)
+        from breezy.plugins.hg import idmap as _mod_idmap
+        self.overrideAttr(_mod_idmap, "MMAP_COMPACT_THRESHOLD", 10)
+        idmap = MmapIdmap("idmap.mmap")
+        self.assertEquals("", open("idmap.mmap.log").read())
+        self.assertEquals(set(["rev%d" % i for i in range(5)]),
+            idmap.revids())
+
+    def test_insert_revision_appends_once(self):
+        idmap = MmapIdmap("idmap.mmap")
+        appends = []
+        orig_append_log = idmap._append_log
+        def append_log(records):
+            appends.append(len(records))
+            return orig_append_log(records)
+        idmap._append_log = append_log
+        idmap.insert_revision("rev1", "a" * 20, "b" * 20, "c" * 20)
+        self.assertEquals([3], appends)
+
+
+class FromRepositoryTests(TestCaseWithTransport):
+
+    def make_readonly_repository(self):
+        self.build_tree(["repo/"])
+        class Repository(object):
+            _transport = get_transport("readonly+" + self.get_url("repo"))
+        return Repository()
+
+    def test_no_cache(self):
+        repository = self.make_readonly_repository()
+        self.assertIs(None, from_repository(repository, create=False))
+        self.assertPathDoesNotExist("repo/hg")
+
+    def test_create_readonly(self):
+        repository = self.make_readonly_repository()
+        idmap = from_repository(repository)
+        self.assertPathExists("repo/hg/format")
+        self.assertIsNot(None, from_repository(repository, create=False))
+
+    def test_migrate_without_create(self):
+        repository = self.make_readonly_repository()
+        db = sqlite3.connect("repo/hg-v2.db")
+        db.execute("create table old (revid text)")
+        db.commit()
+        db.close()
+        idmap = from_repository(repository, create=False)
+        self.assertIsInstance(idmap, SqliteIdmap)
+        self.assertPathExists("repo/hg/idmap.db")
+        self.assertPathDoesNotExist("repo/hg-v2.db")
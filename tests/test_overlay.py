@@ -0,0 +1,114 @@
+# Copyright (C) 2009 Jelmer Vernooij <jelmer@samba.org>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Tests for the Mercurial overlay of Bazaar repositories."""
+
+from breezy.tests import (
+    TestCaseWithTransport,
+    )
+
+from breezy.plugins.hg.mapping import (
+    default_mapping,
+    )
+from breezy.plugins.hg.overlay import (
+    MercurialRepositoryOverlay,
+    )
+
+
+class UpdateIdmapTests(TestCaseWithTransport):
+
+    def setUp(self):
+        super(UpdateIdmapTests, self).setUp()
+        self.tree = self.make_branch_and_tree(".")
+        self.overlay = MercurialRepositoryOverlay(self.tree.branch.repository,
+            default_mapping)
+        self.added = []
+        add_revision_to_idmap = self.overlay._add_revision_to_idmap
+        def add(rev):
+            self.added.append(rev.revision_id)
+            return add_revision_to_idmap(rev)
+        self.overlay._add_revision_to_idmap = add
+
+    def update_idmap(self):
+        del self.added[:]
+        repo = self.tree.branch.repository
+        repo.lock_read()
+        try:
+            self.overlay._update_idmap()
+        finally:
+            repo.unlock()
+        return self.added
+
+    def test_incremental(self):
+        revid1 = self.tree.commit("one")
+        revid2 = self.tree.commit("two")
+        self.assertEquals([revid1, revid2], self.update_idmap())
+        self.assertEquals(set([revid2]),
+            self.overlay.idmap.get_processed_heads())
+        self.assertEquals([], self.update_idmap())
+        revid3 = self.tree.commit("three")
+        self.assertEquals([revid3], self.update_idmap())
+        self.assertEquals(set([revid3]),
+            self.overlay.idmap.get_processed_heads())
+
+
+class RefreshIdmapTests(TestCaseWithTransport):
+
+    def setUp(self):
+        super(RefreshIdmapTests, self).setUp()
+        self.tree = self.make_branch_and_tree(".")
+        self.repo = self.tree.branch.repository
+        self.overlay = MercurialRepositoryOverlay(self.repo, default_mapping)
+        self.added = []
+        def add(rev):
+            self.added.append(rev.revision_id)
+        self.overlay._add_revision_to_idmap = add
+
+    def test_unreferenced_revisions(self):
+        revid1 = self.tree.commit("one")
+        revid2 = self.tree.commit("two")
+        self.tree.branch.set_last_revision_info(1, revid1)
+        self.repo.lock_read()
+        self.addCleanup(self.repo.unlock)
+        self.overlay._update_idmap()
+        self.assertEquals([revid1, revid2], self.added)
+        self.assertEquals(set([revid2]),
+            self.overlay.idmap.get_processed_heads())
+
+    def test_refresh_once_while_locked(self):
+        self.tree.commit("one")
+        updates = []
+        update_idmap = self.overlay._update_idmap
+        def update(stop_revisions=None):
+            updates.append(stop_revisions)
+            return update_idmap(stop_revisions)
+        self.overlay._update_idmap = update
+        self.repo.lock_read()
+        try:
+            self.assertRaises(KeyError,
+                self.overlay.lookup_revision_by_changeset_id, "a" * 20)
+            self.assertRaises(KeyError,
+                self.overlay.lookup_revision_by_changeset_id, "b" * 20)
+            self.assertEquals([None], updates)
+        finally:
+            self.repo.unlock()
+        self.repo.lock_read()
+        try:
+            self.assertRaises(KeyError,
+                self.overlay.lookup_revision_by_changeset_id, "a" * 20)
+        finally:
+            self.repo.unlock()
+        self.assertEquals([None, None], updates)
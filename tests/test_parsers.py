@@ -15,13 +15,20 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 import mercurial
+from mercurial.revlog import (
+    hash as hghash,
+    )
+import struct
 
 from breezy.plugins.hg.parsers import (
     decode_str,
     deserialize_file_text,
     format_changeset,
+    order_by_first_parent,
+    pack_chunk_iter,
     parse_changeset,
     serialize_file_text,
+    unpack_chunk_iter,
     )
 from breezy.tests import (
     TestCase,
@@ -121,6 +128,71 @@ commit
 message"""))
 
 
+class UnpackChunkIterTests(TestCase):
+
+    def setUp(self):
+        super(UnpackChunkIterTests, self).setUp()
+        self.base_node = "b" * 20
+        self.link = "l" * 20
+        self.texts = ["foo\nbar\n", "foo\nbla\n", "foo\nbla\nbar\n"]
+        self.chunks = list(pack_chunk_iter(
+            [(text, (self.base_node, mercurial.node.nullid), self.link)
+             for text in self.texts], "base\n"))
+
+    def test_roundtrip(self):
+        looked_up = []
+        def lookup_base(node):
+            looked_up.append(node)
+            return "base\n"
+        self.assertEquals(self.texts,
+            [fulltext for (fulltext, node, parents, link) in
+             unpack_chunk_iter(iter(self.chunks), lookup_base)])
+        self.assertEquals([self.base_node], looked_up)
+
+    def test_fulltext_cache(self):
+        cache = {self.base_node: "base\n"}
+        entries = list(unpack_chunk_iter(iter(self.chunks),
+            self.fail, cache))
+        self.assertEquals(self.texts, [e[0] for e in entries])
+        for (fulltext, node, parents, link) in entries:
+            self.assertEquals(fulltext, cache[node])
+
+
+class PackChunkIterTests(TestCase):
+
+    def test_fulltext_delta(self):
+        text = "something completely different\n"
+        stats = {}
+        (chunk, ) = pack_chunk_iter(
+            [(text, ("b" * 20, mercurial.node.nullid), "l" * 20)],
+            "base\n", stats=stats)
+        self.assertEquals(struct.pack(">lll", 0, 5, len(text)) + text,
+            chunk[80:])
+        self.assertEquals({"texts": len(text), "deltas": 12 + len(text)},
+            stats)
+
+
+class OrderByFirstParentTests(TestCase):
+
+    def test_follows_first_parent(self):
+        nullid = mercurial.node.nullid
+        base = ("base", (nullid, nullid), "l" * 20)
+        base_node = hghash("base", nullid, nullid)
+        other = ("other", (nullid, nullid), "l" * 20)
+        child = ("child", (base_node, nullid), "l" * 20)
+        self.assertEquals(["base", "child", "other"],
+            [fulltext for (node, fulltext, parents, link) in
+             order_by_first_parent([base, other, child], 10)])
+
+    def test_keeps_first(self):
+        nullid = mercurial.node.nullid
+        entries = [("a", (nullid, nullid), "l" * 20),
+                   ("b", (nullid, nullid), "l" * 20)]
+        self.assertEquals(["a", "b"],
+            [fulltext for (node, fulltext, parents, link) in
+             order_by_first_parent(entries, 10)])
+
+
 class TextSerializers(TestCase):
 
     def test_serialize(self):
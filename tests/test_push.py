@@ -16,7 +16,12 @@
 
 """Tests for pushing revisions into Mercurial repositories."""
 
+import tempfile
 
+from breezy import (
+    config,
+    debug,
+    )
 from breezy.tests import (
     TestCase,
     TestCaseWithTransport,
@@ -25,11 +30,22 @@ from breezy.tests import (
 from mercurial.node import nullid
 
 from breezy.plugins.hg.changegroup import (
+    ChangegroupCache,
+    ChunkStringIO,
     chunkify,
+    dchangegroup,
     dinventories,
     drevisions,
     extract_base,
+    manifest_size,
+    pack_text_chain,
+    spool_manifests,
+    text_chain,
     text_contents,
+    unspool_manifests,
+    )
+from breezy.plugins.hg.parsers import (
+    pack_chunk_iter,
     )
 from breezy.plugins.hg.mapping import default_mapping
 from breezy.plugins.hg.overlay import get_overlay
@@ -44,6 +60,27 @@ class ChunkifyTests(TestCase):
         self.assertEquals("\0\0\0\x08abcd", chunkify("abcd"))
 
 
+class ChunkStringIOTests(TestCase):
+
+    def test_read_all(self):
+        f = ChunkStringIO(iter(["foo", "", "barbla"]))
+        self.assertEquals(chunkify("foo") + chunkify("") + chunkify("barbla"),
+            f.read())
+        self.assertEquals("", f.read())
+
+    def test_read_partial(self):
+        f = ChunkStringIO(iter(["foo", "barbla"]))
+        self.assertEquals(chunkify("foo")[:2], f.read(2))
+        self.assertEquals(chunkify("foo")[2:] + chunkify("barbla")[:6],
+            f.read(len("foo") + 8))
+        self.assertEquals(chunkify("barbla")[6:], f.read(100))
+        self.assertEquals("", f.read(100))
+
+    def test_read_empty(self):
+        f = ChunkStringIO(iter([]))
+        self.assertEquals("", f.read(4))
+
+
 class ExtractBaseTests(TestCase):
 
     def test_empty(self):
@@ -57,6 +94,41 @@ class ExtractBaseTests(TestCase):
         self.assertEquals(["a", "b"], list(entries))
 
 
+class SpoolManifestsTests(TestCase):
+
+    def test_roundtrip(self):
+        manifests = [
+            ("base", (nullid, nullid), "base-revid"),
+            ("a\0" + "1" * 40 + "\n", ("b" * 20, nullid), "revid-a"),
+            ("b\0" + "2" * 40 + "\n", ("c" * 20, nullid), "revid-b")]
+        spool = tempfile.TemporaryFile()
+        self.addCleanup(spool.close)
+        chunks = spool_manifests(iter(manifests), spool)
+        self.assertEquals(["revid-a", "revid-b"],
+            [revid for (revid, size) in chunks])
+        changelog_ids = {"revid-a": "d" * 20, "revid-b": "e" * 20}
+        self.assertEquals(
+            list(pack_chunk_iter(iter([
+                (manifests[1][0], manifests[1][1], "d" * 20),
+                (manifests[2][0], manifests[2][1], "e" * 20)]), "base")),
+            list(unspool_manifests(spool, chunks, changelog_ids)))
+
+
+class ChangegroupCacheTests(TestCaseWithTransport):
+
+    def test_manifest_size(self):
+        self.assertEquals(43 + 45 + 1,
+            manifest_size(({"a": nullid, "bcd": nullid}, {"a": "x"})))
+
+    def test_manifests_by_size(self):
+        repo = self.make_repository('.')
+        cache = ChangegroupCache(repo, [])
+        for i in range(30):
+            cache.manifests["rev%d" % i] = ({"f": nullid}, {})
+        # Small manifests are not limited by their number
+        self.assertEquals(30, len(cache.manifests))
+
+
 class DrevisionsTests(TestCaseWithTransport):
 
     def setUp(self):
@@ -125,6 +197,28 @@ class DinventoriesTests(TestCaseWithTransport):
              ('', ('\x00' * 20, '\x00' * 20), revid),
              ], self.dinvs(["null:", revid], {revid:"manifestid"}, {revid:{}}))
 
+    def test_root_only_first_revision(self):
+        self.overrideAttr(debug, "debug_flags", set(["check"]))
+        self.tree.set_root_id("my-root-id")
+        revid = self.tree.commit("foo")
+        fileids = {}
+        self.dinvs(["null:", revid], {}, {}, fileids)
+        self.assertEquals({"": "my-root-id"}, fileids[revid])
+
+    def test_incremental(self):
+        self.overrideAttr(debug, "debug_flags", set(["check"]))
+        self.build_tree_contents([('a', 'a'), ('b', 'b'), ('d/', ),
+            ('d/c', 'c')])
+        self.tree.add(['a', 'b', 'd', 'd/c'])
+        revid1 = self.tree.commit("first")
+        self.build_tree_contents([('a', 'new a')])
+        self.tree.remove(['b'])
+        self.tree.rename_one('d/c', 'e')
+        revid2 = self.tree.commit("second")
+        manifests = self.dinvs(["null:", revid1, revid2], {}, {}, {})
+        self.assertEquals(["a", "e"],
+            [l.split("\0")[0] for l in manifests[2][0].splitlines()])
+
 
 class TextContentsTests(TestCaseWithTransport):
 
@@ -158,3 +252,80 @@ class TextContentsTests(TestCaseWithTransport):
         self.assertEquals((nullid, nullid), parents)
         self.assertEquals(
             'uVY\xc9\x0e\xee\xc9]\xba\x97\x8c\xb0v\xb6\xaa\xb1\xa0/\xb3\x13', node)
+
+
+class PackTextChainTests(TestCaseWithTransport):
+
+    def test_same_as_serial(self):
+        tree = self.make_branch_and_tree('.')
+        overlay = get_overlay(tree.branch.repository, default_mapping)
+        self.build_tree_contents([('path', 'contents')])
+        tree.add(['path'], ['fileid-a'])
+        rev1 = tree.commit('msg')
+        self.build_tree_contents([('path', 'new contents')])
+        rev2 = tree.commit('msg')
+        keys = [('fileid-a', rev1), ('fileid-a', rev2)]
+        changelog_ids = {rev1: "a" * 20, rev2: "b" * 20}
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        repo = tree.branch.repository
+        entries = text_contents(repo, "path", keys, overlay)
+        textbase = entries.next()
+        expected = list(pack_chunk_iter(
+            ((record.get_bytes_as('fulltext'), parents,
+              changelog_ids[record.key[1]])
+             for (record, parents, node) in entries), textbase))
+        (path, chunks, stats) = pack_text_chain(repo,
+            *text_chain(repo, "path", keys, overlay, changelog_ids))
+        self.assertEquals("path", path)
+        self.assertEquals(expected, chunks)
+        self.assertEquals(len("contents") + len("new contents"),
+            stats["texts"])
+
+    def test_key_set(self):
+        tree = self.make_branch_and_tree('.')
+        overlay = get_overlay(tree.branch.repository, default_mapping)
+        self.build_tree_contents([('path', 'contents')])
+        tree.add(['path'], ['fileid-a'])
+        rev1 = tree.commit('msg')
+        self.build_tree_contents([('path', 'new contents')])
+        rev2 = tree.commit('msg')
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        repo = tree.branch.repository
+        keys = set([('fileid-a', rev2), ('fileid-a', rev1)])
+        entries = text_contents(repo, "path", keys, overlay)
+        self.assertEquals("", entries.next())
+        self.assertEquals([('fileid-a', rev1), ('fileid-a', rev2)],
+            [record.key for (record, parents, node) in entries])
+        (path, sorted_keys, text_nodes, links) = text_chain(repo, "path",
+            keys, overlay, {rev1: "a" * 20, rev2: "b" * 20})
+        self.assertEquals([('fileid-a', rev1), ('fileid-a', rev2)],
+            sorted_keys)
+        self.assertEquals({rev1: "a" * 20, rev2: "b" * 20}, links)
+
+
+class ChangegroupWorkersTests(TestCaseWithTransport):
+
+    def make_changegroup(self, workers):
+        config.GlobalStack().set('hg.push_workers', workers)
+        repo = self.tree.branch.repository
+        repo.lock_read()
+        try:
+            (cg, changelog_ids) = dchangegroup(repo, default_mapping,
+                self.revids)
+            return cg.read()
+        finally:
+            repo.unlock()
+
+    def test_same_output(self):
+        self.tree = self.make_branch_and_tree('.')
+        self.build_tree_contents([('f1', 'f1 contents'), ('d1/',),
+            ('d1/f2', 'f2 contents')])
+        self.tree.add(['f1', 'd1', 'd1/f2'])
+        self.revids = [self.tree.commit('msg')]
+        self.build_tree_contents([('f1', 'new f1 contents')])
+        self.revids.append(self.tree.commit('msg'))
+        serial = self.make_changegroup(0)
+        self.assertEquals(serial, self.make_changegroup(2))
+        self.assertContainsRe(serial, "d1/f2")
@@ -16,13 +16,22 @@
 
 """Tests for HgRepository."""
 
+import os
+
+from breezy import osutils
+from breezy.branch import Branch
+
 from breezy.plugins.hg.dir import (
     HgControlDirFormat,
     )
+from breezy.plugins.hg.ui import ui as hgui
 from breezy.tests import (
     TestCaseWithTransport,
     )
 
+from mercurial import hg
+import mercurial.localrepo
+
 
 class ForeignTestsRepositoryFactory(object):
 
@@ -43,3 +52,329 @@ class HgRepositoryTests(TestCaseWithTransport):
         revid = tree.commit("foo")
         self.assertEquals(set([revid]),
             tree.branch.repository.all_revision_ids())
+
+    def test_iter_entries_by_dir_specific_files(self):
+        tree = self.make_branch_and_tree(".", format="hg")
+        self.build_tree_contents([
+            ("f1", "f1 contents"),
+            ("d1/",),
+            ("d1/f2", "f2 contents"),
+            ("d2/",),
+            ("d2/f3", "f3 contents"),
+            ])
+        tree.add(["f1", "d1", "d1/f2", "d2", "d2/f3"])
+        revid = tree.commit("foo")
+        revtree = tree.branch.repository.revision_tree(revid)
+        self.assertEquals(["d1", "d1/f2"],
+            [p for (p, ie) in revtree.iter_entries_by_dir(
+                specific_files=["d1"])])
+        self.assertEquals(["", "d1", "d1/f2"],
+            [p for (p, ie) in revtree.iter_entries_by_dir(
+                specific_files=["d1/f2"], yield_parents=True)])
+        entries = dict(revtree.iter_entries_by_dir(specific_files=["d2"]))
+        self.assertEquals(revtree.get_file_sha1("d2/f3"),
+            entries["d2/f3"].text_sha1)
+        self.assertEquals(len("f3 contents"), entries["d2/f3"].text_size)
+
+    def test_revision_tree_manifest_cache(self):
+        tree = self.make_branch_and_tree(".", format="hg")
+        self.build_tree_contents([("f1", "f1 contents")])
+        tree.add(["f1"])
+        revid = tree.commit("foo")
+        repo = tree.branch.repository
+        repo.revision_tree(revid)
+        misses = repo._manifest_cache_misses
+        hits = repo._manifest_cache_hits
+        repo.revision_tree(revid)
+        self.assertEquals(misses, repo._manifest_cache_misses)
+        self.assertEquals(hits + 1, repo._manifest_cache_hits)
+
+    def test_get_parent_map(self):
+        tree = self.make_branch_and_tree(".", format="hg")
+        revid1 = tree.commit("foo")
+        revid2 = tree.commit("bar")
+        repo = tree.branch.repository
+        self.assertEquals({
+            revid1: ("null:", ),
+            revid2: (revid1, ),
+            "null:": ()},
+            repo.get_parent_map([revid1, revid2, "null:",
+                                 "hg-v1:" + "a" * 40, "unknown"]))
+
+    def test_has_revisions(self):
+        tree = self.make_branch_and_tree(".", format="hg")
+        revid = tree.commit("foo")
+        self.assertEquals(set([revid, "null:"]),
+            tree.branch.repository.has_revisions(
+                [revid, "null:", "hg-v1:" + "a" * 40, "unknown"]))
+
+    def test_get_known_graph_ancestry(self):
+        tree = self.make_branch_and_tree(".", format="hg")
+        revid1 = tree.commit("foo")
+        revid2 = tree.commit("bar")
+        revid3 = tree.commit("blie")
+        kg = tree.branch.repository.get_known_graph_ancestry([revid2])
+        self.assertEquals(["null:", revid1, revid2], kg.topo_sort())
+
+    def test_last_revision_info(self):
+        tree = self.make_branch_and_tree(".", format="hg")
+        self.assertEquals((0, "null:"), tree.branch.last_revision_info())
+        revid1 = tree.commit("foo")
+        revid2 = tree.commit("bar")
+        revid3 = tree.commit("blie")
+        branch = tree.controldir.open_branch()
+        self.assertEquals((3, revid3), branch.last_revision_info())
+        repo = branch.repository
+        hgid1 = repo.lookup_bzr_revision_id(revid1)[0]
+        self.assertEquals(1, repo._get_revno(hgid1))
+
+    def test_left_hand_history_cache(self):
+        tree = self.make_branch_and_tree(".", format="hg")
+        revid1 = tree.commit("foo")
+        revid2 = tree.commit("bar")
+        repo = tree.branch.repository
+        hgid1 = repo.lookup_bzr_revision_id(revid1)[0]
+        hgid2 = repo.lookup_bzr_revision_id(revid2)[0]
+        self.assertEquals([revid1, revid2],
+            list(repo._get_left_hand_history(hgid2)))
+        self.assertEquals([0, 1], list(repo._read_left_hand_history()))
+        # A shorter history is derived from the stored one, without
+        # replacing it
+        self.assertEquals([revid1], list(repo._get_left_hand_history(hgid1)))
+        self.assertEquals([0, 1], list(repo._read_left_hand_history()))
+        revid3 = tree.commit("blie")
+        hgid3 = repo.lookup_bzr_revision_id(revid3)[0]
+        self.assertEquals([revid1, revid2, revid3],
+            list(repo._get_left_hand_history(hgid3)))
+        self.assertEquals([0, 1, 2], list(repo._read_left_hand_history()))
+
+
+class HgRevisionTreeTests(TestCaseWithTransport):
+
+    def make_hg_repository(self):
+        ui = hgui()
+        ui.setconfig("ui", "merge", "internal:merge")
+        return mercurial.localrepo.localrepository(ui, "hg", create=True)
+
+    def test_root_revision(self):
+        hgrepo = self.make_hg_repository()
+        self.build_tree_contents([("hg/d1/",), ("hg/d1/f1", "f1")])
+        hgrepo[None].add(["d1/f1"])
+        hgrepo.commit("A")
+        self.build_tree_contents([("hg/f2", "f2")])
+        hgrepo[None].add(["f2"])
+        hgrepo.commit("B")
+        branch = Branch.open("hg")
+        revtree = branch.repository.revision_tree(branch.last_revision())
+        self.assertEquals(branch.last_revision(),
+            revtree.get_file_revision(""))
+        # The root revision is known without looking at any files.
+        self.assertEquals({}, revtree._introduced_cls)
+
+    def test_nested_directory_revision(self):
+        hgrepo = self.make_hg_repository()
+        self.build_tree_contents([
+            ("hg/d1/",), ("hg/d1/f1", "f1"), ("hg/d2/",), ("hg/d2/f2", "f2")])
+        hgrepo[None].add(["d1/f1", "d2/f2"])
+        hgrepo.commit("A")
+        self.build_tree_contents([("hg/d1/d2/",), ("hg/d1/d2/f3", "f3")])
+        hgrepo[None].add(["d1/d2/f3"])
+        hgrepo.commit("B")
+        self.build_tree_contents([("hg/d1/d2/f3", "changed f3")])
+        hgrepo.commit("C")
+        branch = Branch.open("hg")
+        repo = branch.repository
+        revid_a = repo.lookup_foreign_revision_id(hgrepo.changelog.node(0))
+        revid_b = repo.lookup_foreign_revision_id(hgrepo.changelog.node(1))
+        revtree = repo.revision_tree(branch.last_revision())
+        self.assertEquals(revid_b, revtree.get_file_revision("d1/d2"))
+        self.assertEquals(revid_a, revtree.get_file_revision("d1"))
+        self.assertEquals(revid_a, revtree.get_file_revision("d2"))
+        # The revisions of all directories are determined at once.
+        self.assertEquals({"d1": revid_a, "d1/d2": revid_b, "d2": revid_a},
+            revtree._directories)
+
+    def test_merged_directory_revision(self):
+        hgrepo = self.make_hg_repository()
+        # A--B--D
+        # |     |
+        # \--C--/
+        self.build_tree_contents([("hg/f1", "f1")])
+        hgrepo[None].add(["f1"])
+        hgrepo.commit("A")
+        self.build_tree_contents([("hg/d1/",), ("hg/d1/f2", "f2")])
+        hgrepo[None].add(["d1/f2"])
+        hgrepo.commit("B")
+        hg.update(hgrepo, 0)
+        self.build_tree_contents([("hg/d1/",), ("hg/d1/f3", "f3")])
+        hgrepo[None].add(["d1/f3"])
+        hgrepo.commit("C")
+        hg.update(hgrepo, 1)
+        hg.merge(hgrepo, 2)
+        hgrepo.commit("D")
+        branch = Branch.open("hg")
+        repo = branch.repository
+        cl_b = hgrepo.changelog.node(1)
+        cl_c = hgrepo.changelog.node(2)
+        revtree = repo.revision_tree(branch.last_revision())
+        # Neither B nor C is an ancestor of the other, so the one with
+        # the lowest revision id wins.
+        best = min([cl_b, cl_c], key=repo.lookup_foreign_revision_id)
+        self.assertEquals(best, revtree._pick_best_creator_cl(cl_b, cl_c))
+        self.assertEquals(best, revtree._pick_best_creator_cl(cl_c, cl_b))
+        self.assertEquals(repo.lookup_foreign_revision_id(best),
+            revtree.get_file_revision("d1"))
+        # An ancestor always wins.
+        cl_a = hgrepo.changelog.node(0)
+        self.assertEquals(cl_a, revtree._pick_best_creator_cl(cl_c, cl_a))
+        self.assertEquals(cl_a, revtree._pick_best_creator_cl(cl_a, cl_b))
+
+    def test_file_revision_flags_reverted(self):
+        hgrepo = self.make_hg_repository()
+        self.build_tree_contents([("hg/f1", "f1")])
+        hgrepo[None].add(["f1"])
+        hgrepo.commit("A")
+        os.chmod("hg/f1", 0755)
+        hgrepo.commit("B")
+        os.chmod("hg/f1", 0644)
+        hgrepo.commit("C")
+        repo = Branch.open("hg").repository
+        revids = [repo.lookup_foreign_revision_id(hgrepo.changelog.node(i))
+                  for i in range(3)]
+        for revid in revids:
+            revtree = repo.revision_tree(revid)
+            self.assertEquals(revid, revtree.get_file_revision("f1"))
+
+    def test_file_revision_readded(self):
+        hgrepo = self.make_hg_repository()
+        self.build_tree_contents([("hg/f1", "f1"), ("hg/f2", "f2")])
+        hgrepo[None].add(["f1", "f2"])
+        hgrepo.commit("A")
+        hgrepo[None].forget(["f1"])
+        os.unlink("hg/f1")
+        hgrepo.commit("B")
+        self.build_tree_contents([("hg/f1", "f1")])
+        hgrepo[None].add(["f1"])
+        hgrepo.commit("C")
+        repo = Branch.open("hg").repository
+        revid_a = repo.lookup_foreign_revision_id(hgrepo.changelog.node(0))
+        revid_c = repo.lookup_foreign_revision_id(hgrepo.changelog.node(2))
+        revtree = repo.revision_tree(revid_c)
+        self.assertEquals(revid_c, revtree.get_file_revision("f1"))
+        self.assertEquals(revid_a, revtree.get_file_revision("f2"))
+
+    def test_file_changes_cache(self):
+        hgrepo = self.make_hg_repository()
+        self.build_tree_contents([("hg/f1", "f1"), ("hg/f2", "f2")])
+        hgrepo[None].add(["f1", "f2"])
+        hgrepo.commit("A")
+        self.build_tree_contents([("hg/f1", "changed f1")])
+        hgrepo.commit("B")
+        repo = Branch.open("hg").repository
+        self.assertEquals([0, 1], list(repo._get_file_changes("f1")))
+        self.build_tree_contents([("hg/f2", "changed f2")])
+        hgrepo.commit("C")
+        # A new repository object reads the index from .hg/cache and
+        # only reads the new changesets from the changelog
+        repo = Branch.open("hg").repository
+        changelog = repo._hgrepo.changelog
+        read = []
+        self.overrideAttr(changelog, "readfiles",
+            lambda node: read.append(node) or
+                changelog.__class__.readfiles(changelog, node))
+        self.assertEquals([0, 2], list(repo._get_file_changes("f2")))
+        self.assertEquals([changelog.node(2)], read)
+        self.assertEquals(3, repo._read_file_changes())
+
+    def test_revno_cache(self):
+        hgrepo = self.make_hg_repository()
+        for i in range(3):
+            self.build_tree_contents([("hg/f1", "f1 %d" % i)])
+            if i == 0:
+                hgrepo[None].add(["f1"])
+            hgrepo.commit("rev %d" % i)
+        repo = Branch.open("hg").repository
+        self.assertEquals(3, repo._get_revno(hgrepo.changelog.node(2)))
+        self.assertEquals({2: 3}, repo._read_revnos())
+        # The stored revnos are used by new repository objects, and only
+        # the changesets since then are walked
+        self.build_tree_contents([("hg/f1", "f1 3")])
+        hgrepo.commit("rev 3")
+        repo = Branch.open("hg").repository
+        changelog = repo._hgrepo.changelog
+        walked = []
+        self.overrideAttr(changelog, "parentrevs",
+            lambda rev: walked.append(rev) or
+                changelog.__class__.parentrevs(changelog, rev))
+        self.assertEquals(3, repo._get_revno(changelog.node(2)))
+        self.assertEquals([], walked)
+        self.assertEquals(4, repo._get_revno(changelog.node(3)))
+        self.assertEquals([3], walked)
+        self.assertEquals(2, repo._get_revno(changelog.node(1)))
+        self.assertEquals({1: 2, 2: 3, 3: 4}, repo._read_revnos())
+
+    def test_text_metadata_unlocked(self):
+        hgrepo = self.make_hg_repository()
+        self.build_tree_contents([("hg/f1", "f1 contents")])
+        hgrepo[None].add(["f1"])
+        hgrepo.commit("A")
+        node = hgrepo["tip"]["f1"].filenode()
+        branch = Branch.open("hg")
+        revtree = branch.repository.revision_tree(branch.last_revision())
+        revtree.get_file_sha1("f1")
+        # Without a lock the metadata is written to the idmap right away
+        self.assertEquals({}, branch.repository._pending_text_metadata)
+        repo = Branch.open("hg").repository
+        self.assertEquals((osutils.sha_string("f1 contents"), 11),
+            repo._get_idmap().lookup_text_metadata("f1", node))
+
+    def test_unlock_flush_fails(self):
+        self.make_hg_repository()
+        repo = Branch.open("hg").repository
+        def broken_idmap():
+            raise IOError("broken")
+        self.overrideAttr(repo, "_get_idmap", broken_idmap)
+        repo.lock_read()
+        repo._add_text_metadata("f1", "a" * 20, "sha1", 1)
+        self.assertRaises(IOError, repo.unlock)
+        self.assertFalse(repo.is_locked())
+        self.assertEquals({}, repo._pending_text_metadata)
+
+    def test_cache_without_cachevfs(self):
+        hgrepo = self.make_hg_repository()
+        self.build_tree_contents([("hg/f1", "f1")])
+        hgrepo[None].add(["f1"])
+        hgrepo.commit("A")
+        repo = Branch.open("hg").repository
+        self.overrideAttr(repo._hgrepo, "cachevfs", None)
+        self.assertEquals([0], list(repo._get_file_changes("f1")))
+        self.assertPathExists("hg/.hg/cache/bzr-file-changes")
+        repo._get_idmap()
+        self.assertPathExists("hg/.hg/cache/bzr/format")
+
+    def test_file_revision_merged(self):
+        hgrepo = self.make_hg_repository()
+        # A--C--D
+        # |     |
+        # \--B--/
+        self.build_tree_contents([("hg/f1", "f1"), ("hg/f2", "f2")])
+        hgrepo[None].add(["f1", "f2"])
+        hgrepo.commit("A")
+        self.build_tree_contents([("hg/f1", "changed f1")])
+        os.chmod("hg/f1", 0755)
+        hgrepo.commit("B")
+        hg.update(hgrepo, 0)
+        self.build_tree_contents([("hg/f2", "changed f2")])
+        hgrepo.commit("C")
+        hg.merge(hgrepo, 1)
+        hgrepo.commit("D")
+        repo = Branch.open("hg").repository
+        cl_b = hgrepo.changelog.node(1)
+        cl_d = hgrepo.changelog.node(3)
+        # D lists f1 because its flags differ from C, but it takes the
+        # file from B unchanged
+        self.assertTrue("f1" in hgrepo.changelog.read(cl_d)[3])
+        self.assertFalse(repo._is_file_changed_since("f1", cl_b, cl_d))
+        revtree = repo.revision_tree(repo.lookup_foreign_revision_id(cl_d))
+        self.assertEquals(repo.lookup_foreign_revision_id(cl_b),
+            revtree.get_file_revision("f1"))
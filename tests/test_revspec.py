@@ -65,3 +65,75 @@ class RevisionSpecTests(TestCaseWithTransport):
         revspec = RevisionSpec.from_string("hg:%s" % text)
         self.assertRaises(InvalidRevisionSpec, revspec.as_revision_id,
             tree.branch)
+
+    def test_bzr_branch_search_idmap(self):
+        from breezy.plugins.hg.idmap import from_repository
+        tree = self.make_branch_and_tree(".")
+        revid = tree.commit("acommit")
+        idmap = from_repository(tree.branch.repository)
+        with idmap.batch():
+            idmap.insert_revision(revid, "a" * 20, "\xab" * 20, "hg-v1")
+        revspec = RevisionSpec.from_string("hg:abab")
+        self.assertEquals(revid, revspec.as_revision_id(tree.branch))
+
+    def test_bzr_branch_search_no_idmap(self):
+        tree = self.make_branch_and_tree(".")
+        tree.commit("acommit")
+        revspec = RevisionSpec.from_string("hg:abab")
+        self.assertRaises(InvalidRevisionSpec, revspec.as_revision_id,
+            tree.branch)
+        # Looking up a revision doesn't create a cache
+        self.assertFalse(tree.branch.repository._transport.has("hg"))
+
+    def test_bzr_branch_search_idmap_outside_ancestry(self):
+        from breezy.plugins.hg.idmap import from_repository
+        tree = self.make_branch_and_tree(".")
+        revid1 = tree.commit("acommit")
+        revid2 = tree.commit("anothercommit")
+        tree.branch.set_last_revision_info(1, revid1)
+        idmap = from_repository(tree.branch.repository)
+        with idmap.batch():
+            idmap.insert_revision(revid2, "a" * 20, "\xab" * 20, "hg-v1")
+        revspec = RevisionSpec.from_string("hg:abab")
+        self.assertRaises(InvalidRevisionSpec, revspec.as_revision_id,
+            tree.branch)
+
+    def test_bzr_branch_search_idmap_ambiguous(self):
+        from breezy.plugins.hg.idmap import from_repository
+        tree = self.make_branch_and_tree(".")
+        revid1 = tree.commit("acommit")
+        revid2 = tree.commit("anothercommit")
+        idmap = from_repository(tree.branch.repository)
+        with idmap.batch():
+            idmap.insert_revision(revid1, "a" * 20, "\xab" * 20, "hg-v1")
+            idmap.insert_revision(revid2, "b" * 20, "\xab\xcd" * 10, "hg-v1")
+        revspec = RevisionSpec.from_string("hg:ab")
+        self.assertRaises(InvalidRevisionSpec, revspec.as_revision_id,
+            tree.branch)
+        revspec = RevisionSpec.from_string("hg:abcd")
+        self.assertEquals(revid2, revspec.as_revision_id(tree.branch))
+
+    def test_search_not_revision_number(self):
+        import mercurial.localrepo
+        from mercurial.node import hex
+        from breezy.branch import Branch
+        from breezy.plugins.hg.ui import ui as hgui
+        hgrepo = mercurial.localrepo.localrepository(hgui(), "hg",
+            create=True)
+        self.build_tree_contents([("hg/f1", "f1")])
+        hgrepo[None].add(["f1"])
+        hgrepo.commit("A", user="foo", date="0 0")
+        self.build_tree_contents([("hg/f1", "f2")])
+        hgrepo.commit("B", user="foo", date="0 0")
+        branch = Branch.open("hg")
+        nodes = [hgrepo.changelog.node(rev) for rev in range(2)]
+        # A revision number is not taken for a changeset id prefix
+        prefix = [d for d in "01"
+                  if not [n for n in nodes if hex(n).startswith(d)]][0]
+        revspec = RevisionSpec.from_string("hg:%s" % prefix)
+        self.assertRaises(InvalidRevisionSpec, revspec.as_revision_id,
+            branch)
+        revspec = RevisionSpec.from_string("hg:%s" % hex(nodes[0])[:6])
+        self.assertEquals(
+            branch.repository.lookup_foreign_revision_id(nodes[0]),
+            revspec.as_revision_id(branch))
@@ -32,6 +32,10 @@ from breezy.revision import (
 
 from breezy.revisiontree import RevisionTree
 
+from breezy.plugins.hg.util import (
+    lazy_attribute,
+    )
+
 import mercurial.node
 
 import posixpath
@@ -42,10 +46,16 @@ class HgTreeDirectory(TreeDirectory):
     kind = 'directory'
     executable = False
 
-    def __init__(self, file_id, basename, parent_id):
+    def __init__(self, file_id, basename, parent_id, tree=None, path=None):
         self.file_id = file_id
         self.name = basename
         self.parent_id = parent_id
+        self._tree = tree
+        self._path = path
+
+    @lazy_attribute
+    def revision(self):
+        return self._tree._get_dir_last_modified(self._path)
 
 
 class HgTreeLink(TreeLink):
@@ -53,21 +63,51 @@ class HgTreeLink(TreeLink):
     kind = 'link'
     executable = False
 
-    def __init__(self, file_id, basename, parent_id):
+    def __init__(self, file_id, basename, parent_id, tree=None, path=None):
         self.file_id = file_id
         self.name = basename
         self.parent_id = parent_id
+        self._tree = tree
+        self._path = path
+
+    @lazy_attribute
+    def symlink_target(self):
+        return self._tree.get_symlink_target(self._path, self.file_id)
+
+    @lazy_attribute
+    def revision(self):
+        return self._tree.get_file_revision(self._path, self.file_id)
 
 
 class HgTreeFile(TreeFile):
 
     kind = 'file'
 
-    def __init__(self, file_id, basename, parent_id):
+    def __init__(self, file_id, basename, parent_id, tree=None, path=None):
         self.file_id = file_id
         self.name = basename
         self.parent_id = parent_id
         self.executable = False
+        self._tree = tree
+        self._path = path
+
+    def _read_text(self):
+        (self.text_sha1, self.text_size) = self._tree._get_file_metadata(
+            self._path)
+
+    @lazy_attribute
+    def text_sha1(self):
+        self._read_text()
+        return self.text_sha1
+
+    @lazy_attribute
+    def text_size(self):
+        self._read_text()
+        return self.text_size
+
+    @lazy_attribute
+    def revision(self):
+        return self._tree.get_file_revision(self._path, self.file_id)
 
 
 class HgRevisionTree(RevisionTree):
@@ -78,13 +118,14 @@ class HgRevisionTree(RevisionTree):
         self._revision_id = revision_id
         self._manifest = manifest
         self._mapping = mapping
-        self._ancestry_cache = {}
         self._hgid = hgid
         # each directory is a key - i.e. 'foo'
-        # the value is the current chosen revision value for it.
-        self._directories = {}
-        self._known_manifests = {}
-        self._all_relevant_revisions = None
+        # the value is the chosen revision value for it. None until the
+        # revisions of all directories have been determined.
+        self._directories = None
+        # each file path is a key, the value the changeset it was
+        # introduced in.
+        self._introduced_cls = {}
 
     def _has_directory(self, path):
         # FIXME
@@ -117,7 +158,31 @@ class HgRevisionTree(RevisionTree):
             raise errors.NoSuchFile(path)
 
     def get_file_sha1(self, path, file_id=None, stat_value=None):
-        return osutils.sha_string(self.get_file_text(path, file_id))
+        return self._get_file_metadata(path)[0]
+
+    def get_file_size(self, path, file_id=None):
+        return self._get_file_metadata(path)[1]
+
+    def _get_file_metadata(self, path):
+        """Return the SHA1 and size of a file.
+
+        These are cached per file revision by the repository.
+
+        :return: Tuple with SHA1 and size
+        """
+        utf8_path = path.encode("utf-8")
+        try:
+            node = self._manifest[utf8_path]
+        except KeyError:
+            raise errors.NoSuchFile(path)
+        try:
+            return self._repository._get_text_metadata(utf8_path, node)
+        except KeyError:
+            pass
+        text = self.get_file_text(path)
+        sha1 = osutils.sha_string(text)
+        self._repository._add_text_metadata(utf8_path, node, sha1, len(text))
+        return (sha1, len(text))
 
     def get_file_mtime(self, path, file_id=None):
         revid = self.get_file_revision(path, file_id)
@@ -144,36 +209,38 @@ class HgRevisionTree(RevisionTree):
             parent_id = None
         else:
             parent_id = self.path2id(posixpath.dirname(path))
-        ie = HgTreeDirectory(self.path2id(path), posixpath.basename(path), parent_id)
-        ie.revision = self._get_dir_last_modified(path)
-        return ie
+        return HgTreeDirectory(self.path2id(path), posixpath.basename(path),
+            parent_id, self, path)
 
     def _get_file_ie(self, path, flags):
         file_id = self.path2id(path)
         parent_id = self.path2id(posixpath.dirname(path))
         if 'l' in flags:
-            ie = HgTreeLink(file_id, posixpath.basename(path), parent_id)
-            ie.symlink_target = self.get_symlink_target(path, file_id)
+            ie = HgTreeLink(file_id, posixpath.basename(path), parent_id,
+                self, path)
         else:
-            ie = HgTreeFile(file_id, posixpath.basename(path), parent_id)
-            text = self.get_file_text(path, file_id)
-            ie.text_sha1 = osutils.sha_string(text)
-            ie.text_size = len(text)
+            ie = HgTreeFile(file_id, posixpath.basename(path), parent_id,
+                self, path)
             ie.executable = ('x' in flags)
-        ie.revision = self.get_file_revision(path, file_id)
         return ie
 
     def iter_entries_by_dir(self, specific_files=None, yield_parents=False):
-        # FIXME: Support specific_file_ids and yield_parents
         if specific_files is not None:
-            raise NotImplementedError(self.iter_entries_by_dir)
+            specific_files = [p.encode("utf-8") for p in specific_files]
+            if "" in specific_files:
+                specific_files = None
         directories = set()
         for p in self._manifest:
+            if (specific_files is not None and
+                not osutils.is_inside_any(specific_files, p)):
+                continue
             parent = posixpath.dirname(p)
             while not parent in directories:
-                decoded_parent = parent.decode("utf-8")
-                yield decoded_parent, self._get_dir_ie(decoded_parent)
                 directories.add(parent)
+                if (specific_files is None or yield_parents or
+                    osutils.is_inside_any(specific_files, parent)):
+                    decoded_parent = parent.decode("utf-8")
+                    yield decoded_parent, self._get_dir_ie(decoded_parent)
                 if parent == "":
                     break
                 parent = posixpath.dirname(parent)
@@ -181,45 +248,30 @@ class HgRevisionTree(RevisionTree):
             decoded_path = p.decode("utf-8")
             yield decoded_path, self._get_file_ie(decoded_path, fflags)
 
-    def _pick_best_creator_revision(self, revision_a, revision_b):
-        """Picks the best creator revision from a and b.
+    def _pick_best_creator_cl(self, cl_a, cl_b):
+        """Picks the best creator changeset from a and b.
 
         If a is an ancestor of b, a wins, and vice verca.
-        If neither is an ancestor of the other, the lowest value wins.
+        If neither is an ancestor of the other, the one with the lowest
+        revision id wins.
         """
-        # TODO make this much faster - use a local cache of the ancestry
-        # sets.
-        if revision_a in self._get_ancestry(revision_b):
-            return revision_a
-        elif revision_b in self._get_ancestry(revision_a):
-            return revision_b
-        elif revision_a < revision_b:
-            return revision_a
+        if cl_a == cl_b:
+            return cl_a
+        changelog = self._repository._hgrepo.changelog
+        # Revision numbers are a topological order, so only the changeset
+        # with the lower number can be an ancestor of the other.
+        if changelog.rev(cl_a) > changelog.rev(cl_b):
+            (cl_a, cl_b) = (cl_b, cl_a)
+        if changelog.isancestor(cl_a, cl_b):
+            return cl_a
+        revision_a = self._repository.lookup_foreign_revision_id(cl_a,
+            self._mapping)
+        revision_b = self._repository.lookup_foreign_revision_id(cl_b,
+            self._mapping)
+        if revision_a < revision_b:
+            return cl_a
         else:
-            return revision_b
-
-    def _get_ancestry(self, some_revision_id):
-        try:
-            return self._ancestry_cache[some_revision_id]
-        except KeyError:
-            pass
-        if self._all_relevant_revisions is None:
-            graph = self._repository.get_graph()
-            ancestry = graph.find_unique_ancestors(self._revision_id, [])
-            self._all_relevant_revisions = self._repository.get_parent_map(ancestry)
-        assert some_revision_id in self._all_relevant_revisions
-        ancestry = set()
-        # add what can be reached from some_revision_id
-        # TODO: must factor this trivial iteration in breezy.graph cleanly.
-        pending = set([some_revision_id])
-        while len(pending) > 0:
-            node = pending.pop()
-            ancestry.add(node)
-            for parent_id in self._all_relevant_revisions[node]:
-                if parent_id not in ancestry:
-                    pending.add(parent_id)
-        self._ancestry_cache[some_revision_id] = ancestry
-        return ancestry
+            return cl_b
 
     def get_file_revision(self, path, file_id=None):
         utf8_path = path.encode("utf-8")
@@ -232,22 +284,72 @@ class HgRevisionTree(RevisionTree):
             raise errors.NoSuchId(self, file_id)
 
     def _get_dir_last_modified(self, path):
-        revision = self._directories.get(path)
-        if revision is not None:
-            return revision
         utf8_path = path.encode("utf-8")
-        revision = self._revision_id
-        for p in self._manifest:
-            if p.startswith(utf8_path+"/"):
-                file_revision = self._get_file_introduced_revision(p)
-                revision = self._pick_best_creator_revision(revision, file_revision)
-        self._directories[utf8_path] = revision
-        return revision
+        if utf8_path == "":
+            # The root always has the revision of the tree itself.
+            return self._revision_id
+        if self._directories is None:
+            self._directories = self._find_directory_revisions()
+        return self._directories[utf8_path]
+
+    def _find_directory_revisions(self):
+        """Determine the revisions of all directories.
+
+        The revision of a directory is the best creator (see
+        _pick_best_creator_cl) of the files below it. The manifest is
+        walked once in sorted order, so the files below a directory are
+        seen together; when the walk leaves a directory its creator is
+        folded into its parent.
+
+        :return: Dictionary mapping UTF8 directory paths to revision ids
+        """
+        creators = {}
+        # Directories containing the current path, with their creator so
+        # far, outermost first
+        stack = [["", None]]
+        def fold(d, cl):
+            if cl is None:
+                return
+            if d[1] is None:
+                d[1] = cl
+            else:
+                d[1] = self._pick_best_creator_cl(d[1], cl)
+        def leave():
+            (d, cl) = stack.pop()
+            creators[d] = cl
+            fold(stack[-1], cl)
+        for p in sorted(self._manifest):
+            parent = posixpath.dirname(p)
+            while not osutils.is_inside(stack[-1][0], parent):
+                leave()
+            entered = []
+            while parent != stack[-1][0]:
+                entered.append([parent, None])
+                parent = posixpath.dirname(parent)
+            stack.extend(reversed(entered))
+            fold(stack[-1], self._get_file_introduced_cl(p))
+        while len(stack) > 1:
+            leave()
+        return dict(
+            (d, self._repository.lookup_foreign_revision_id(cl, self._mapping))
+            for (d, cl) in creators.iteritems())
 
     def _get_file_last_modified_cl(self, path):
         """Find the mercurial changeset in which path was last changed."""
         hg_file_flags = self._manifest.flags(path)
         hg_file_revision = self._manifest.get(path)
+        # Usually this is the changeset the filelog links the file revision
+        # to. Fall back to walking the history if that changeset is not
+        # in our ancestry or if the file has been touched since, e.g. to
+        # change its flags or to remove and re-add it.
+        (linked_cl, linked_flags) = self._repository._get_file_introduction(
+            path, hg_file_revision)
+        if (linked_flags == hg_file_flags and
+            self._repository._hgrepo.changelog.isancestor(linked_cl, self._hgid) and
+            not self._repository._is_file_changed_since(
+                path, linked_cl, self._hgid)):
+            return self._repository.lookup_foreign_revision_id(linked_cl,
+                self._mapping)
         current_manifest = self._manifest
         # cls - changelogs
         parent_cls = set(self._repository._hgrepo.changelog.parents(self._hgid))
@@ -259,10 +361,7 @@ class HgRevisionTree(RevisionTree):
             # the nullid isn't useful.
             if current_cl == mercurial.node.nullid:
                 continue
-            if current_cl not in self._known_manifests:
-                current_manifest_id = self._repository._hgrepo.changelog.read(current_cl)[0]
-                self._known_manifests[current_cl] = self._repository._hgrepo.manifestlog[current_manifest_id].read()
-            current_manifest = self._known_manifests[current_cl]
+            current_manifest = self._repository._get_changeset_manifest(current_cl)
             done_cls.add(current_cl)
             if (current_manifest.get(path, None) != hg_file_revision or
                 current_manifest.flags(path) != hg_file_flags):
@@ -274,7 +373,48 @@ class HgRevisionTree(RevisionTree):
                     parent_cls.add(parent_cl)
         return self._repository.lookup_foreign_revision_id(good_id, self._mapping)
 
-    def _get_file_introduced_revision(self, path):
+    def _get_file_introduced_cl(self, path):
+        """Find the mercurial changeset in which path was introduced.
+
+        This is the changeset the root of the filelog history of the file
+        revision in this tree is linked to. If there are several roots,
+        the best creator (see _pick_best_creator_cl) wins.
+        """
+        try:
+            return self._introduced_cls[path]
+        except KeyError:
+            pass
+        hgrepo = self._repository._hgrepo
+        changelog = hgrepo.changelog
+        filelog = hgrepo.file(path)
+        pending = [filelog.rev(self._manifest[path])]
+        seen = set(pending)
+        cl = None
+        while pending:
+            filerev = pending.pop()
+            parents = [p for p in filelog.parentrevs(filerev)
+                       if p != mercurial.node.nullrev]
+            if not parents:
+                root_cl = changelog.node(filelog.linkrev(filerev))
+                if not changelog.isancestor(root_cl, self._hgid):
+                    # The same file revision was introduced elsewhere
+                    # first; the filelog can't tell us where it was
+                    # introduced in our ancestry.
+                    cl = self._walk_file_introduced_cl(path)
+                    break
+                if cl is None:
+                    cl = root_cl
+                else:
+                    cl = self._pick_best_creator_cl(cl, root_cl)
+            for parent in parents:
+                if parent not in seen:
+                    seen.add(parent)
+                    pending.append(parent)
+        self._introduced_cls[path] = cl
+        return cl
+
+    def _walk_file_introduced_cl(self, path):
+        """Find the changeset path was introduced in by walking history."""
         parent_cl_ids = set([(None, self._hgid)])
         good_id = self._hgid
         done_cls = set()
@@ -283,10 +423,7 @@ class HgRevisionTree(RevisionTree):
             # the nullid isn't useful.
             if current_cl_id == mercurial.node.nullid:
                 continue
-            if current_cl_id not in self._known_manifests:
-                current_manifest_id = self._repository._hgrepo.changelog.read(current_cl_id)[0]
-                self._known_manifests[current_cl_id] = self._repository._hgrepo.manifestlog[current_manifest_id].read()
-            current_manifest = self._known_manifests[current_cl_id]
+            current_manifest = self._repository._get_changeset_manifest(current_cl_id)
             done_cls.add(current_cl_id)
             if current_manifest.get(path, None) is None:
                 # file is not in current manifest: its a tail, cut here.
@@ -300,7 +437,7 @@ class HgRevisionTree(RevisionTree):
             for parent_cl in self._repository._hgrepo.changelog.parents(current_cl_id):
                 if parent_cl not in done_cls:
                     parent_cl_ids.add((current_cl_id, parent_cl))
-        return self._repository.lookup_foreign_revision_id(good_id, self._mapping)
+        return good_id
 
     def has_id(self, file_id):
         path = self.id2path(file_id)
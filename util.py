@@ -19,7 +19,12 @@
 
 """
 
-from collections import defaultdict
+from collections import (
+    defaultdict,
+    deque,
+    )
+
+from breezy import trace
 
 class lazydict(defaultdict):
 
@@ -29,3 +34,60 @@ class lazydict(defaultdict):
     def __missing__(self, key):
         self[key] = value = self.default_factory(key)
         return value
+
+
+class lazy_attribute(object):
+    """Attribute that is computed on first access.
+
+    The computed value is stored on the instance, so the function is only
+    called once. Assigning to the attribute overrides it.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = self.func(obj)
+        obj.__dict__[self.__name__] = value
+        return value
+
+
+def imap_bounded(pool, func, iterable, window):
+    """Ordered variant of Pool.imap with a bounded number of pending tasks.
+
+    Unlike Pool.imap, the iterable is consumed in the calling thread, so it
+    is safe for it to read from streams or repositories that are not
+    shareable between threads or processes.
+
+    :param pool: multiprocessing (or ThreadPool) pool to submit tasks to
+    :param func: Function to apply to each item
+    :param iterable: Iterable over items
+    :param window: Maximum number of tasks in flight
+    :return: Iterator over the results, in the same order as iterable
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def terminate_pool(pool):
+    """Stop the workers of a pool and wait for them to exit.
+
+    This is usually called while an exception is propagating, so errors
+    raised while terminating are logged rather than allowed to replace it.
+
+    :param pool: multiprocessing (or ThreadPool) pool to terminate
+    """
+    try:
+        pool.terminate()
+        pool.join()
+    except Exception:
+        trace.log_exception_quietly()